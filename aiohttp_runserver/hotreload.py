@@ -0,0 +1,90 @@
+import importlib
+import os
+import sys
+import types
+
+from .imports import module_file
+
+
+def invalidate_templates(env, paths):
+    """
+    Drop templates compiled from any of paths from a jinja environment's cache so they're recompiled on next use.
+
+    :return: number of templates dropped
+    """
+    if env is None or env.cache is None:
+        return 0
+    paths = {os.path.realpath(p) for p in paths}
+    stale = [key for key, template in list(env.cache.items())
+             if template.filename and os.path.realpath(template.filename) in paths]
+    for key in stale:
+        del env.cache[key]
+    return len(stale)
+
+
+def _app_references(app):
+    """
+    Objects the app holds on to: route handlers, middlewares, signal handlers and values stored on the app.
+    """
+    refs = list(app.values()) + list(app.middlewares)
+    for name in ('on_startup', 'on_response_prepare', 'on_shutdown', 'on_cleanup'):
+        refs.extend(getattr(app, name, ()))
+    routes = getattr(app.router, 'routes', None)
+    if routes is not None:
+        refs.extend(route.handler for route in routes())
+    return refs
+
+
+def _restart_reason(module, project_modules, app_refs, app_file):
+    """
+    Why reloading module in place wouldn't be enough, or None if it can be.
+
+    importlib.reload re-executes the module in its existing namespace, so only code which looks names up on the
+    module at call time sees the new versions. Anything which took a reference to one of its functions, classes or
+    instances keeps the old one.
+    """
+    name = module.__name__
+    if module_file(module) == app_file:
+        return 'app module changed'
+    if hasattr(module, '__path__'):
+        return 'package {} changed'.format(name)
+    for ref in app_refs:
+        if getattr(ref, '__module__', None) == name:
+            return 'app refers to {}.{}'.format(name, getattr(ref, '__qualname__', type(ref).__name__))
+    for other in project_modules:
+        if other is module:
+            continue
+        for attr, value in list(vars(other).items()):
+            if not isinstance(value, types.ModuleType) and getattr(value, '__module__', None) == name:
+                return '{} imports {} from {}'.format(other.__name__, attr, name)
+    return None
+
+
+def reload_modules(app, paths, roots, app_path):
+    """
+    Reload changed project modules in place if none of them are referenced from elsewhere, ie. they're leaves of
+    the import graph as far as the running app is concerned.
+
+    :param paths: changed python files
+    :param roots: directories containing the project's modules
+    :return: None if the modules were reloaded or weren't imported, otherwise why the server should be restarted
+    """
+    prefixes = tuple(os.path.join(os.path.realpath(r), '') for r in roots)
+    project_modules = [m for m in list(sys.modules.values()) if (module_file(m) or '').startswith(prefixes)]
+    by_file = {module_file(m): m for m in project_modules}
+    modules = [by_file[p] for p in map(os.path.realpath, paths) if p in by_file]
+
+    app_refs = _app_references(app)
+    app_file = os.path.realpath(app_path)
+    for module in modules:
+        reason = _restart_reason(module, project_modules, app_refs, app_file)
+        if reason:
+            return reason
+
+    for module in modules:
+        try:
+            importlib.reload(module)
+        except Exception as e:
+            # the restarted server will report the error properly
+            return 'error reloading {}: {}: {}'.format(module.__name__, e.__class__.__name__, e)
+    return None
@@ -0,0 +1,149 @@
+import copy
+import os
+import pkgutil
+import py_compile
+import sys
+import time
+
+from .logs import dft_logger
+
+# number of modules listed by the import profile summary, the full profile is logged with --verbose
+PROFILE_SUMMARY_COUNT = 5
+
+
+def module_file(module):
+    """
+    :return: real path of the file a module was loaded from, or None for builtin and namespace modules
+    """
+    path = getattr(module, '__file__', None)
+    return path and os.path.realpath(path)
+
+
+def precompile(path):
+    """
+    Compile a python file to bytecode where the import system will look for it, so the next import of it is a
+    cache hit. Errors are ignored, the server will report them when it imports the file.
+
+    :return: True if the file was compiled
+    """
+    try:
+        py_compile.compile(path, doraise=True)
+    except (py_compile.PyCompileError, OSError):
+        return False
+    return True
+
+
+def warm_finders(paths):
+    """
+    Create the path finder for each directory containing one of paths and have it list the directory, so
+    processes forked afterwards find those modules without re-listing directories.
+
+    :param paths: python files, eg. the project files imported by the last server
+    """
+    dirs = {}
+    for path in paths:
+        dir_path, name = os.path.split(path)
+        dirs.setdefault(dir_path, []).append(os.path.splitext(name)[0])
+        if name.startswith('__init__.'):
+            # the package itself is found in its parent directory
+            parent, package = os.path.split(dir_path)
+            dirs.setdefault(parent, []).append(package)
+    for dir_path, names in dirs.items():
+        # also caches the finder in sys.path_importer_cache
+        finder = pkgutil.get_importer(dir_path)
+        find_spec = getattr(finder, 'find_spec', None)
+        if find_spec is None:
+            continue
+        for name in names:
+            # FileFinder only uses the last part of the name, nothing is imported
+            find_spec(name)
+
+
+class ImportProfiler:
+    """
+    Meta path finder which times executing each module imported while it's installed, similar to
+    "python -X importtime": self time excludes the time spent importing other modules, cumulative time includes it.
+
+    Specs are found with the finders after it on sys.meta_path and a copy returned with the loader replaced by a
+    _TimedLoader for that module, loader instances are often shared between modules so aren't touched. Assumes
+    imports happen in one thread.
+    """
+    def __init__(self):
+        # (module name, self seconds, cumulative seconds) in the order imports finished
+        self.timings = []
+        # time spent importing children of each module being executed
+        self._stack = []
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        finders = sys.meta_path[sys.meta_path.index(self) + 1:]
+        for finder in finders:
+            find_spec = getattr(finder, 'find_spec', None)
+            if find_spec is None:
+                # legacy finder, leave the rest of the search to the import system
+                return None
+            spec = find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+
+        loader = spec.loader
+        # builtin and frozen importers are classes shared by all their modules
+        if loader is None or isinstance(loader, type) or not hasattr(loader, 'exec_module'):
+            return spec
+        timed_spec = copy.copy(spec)
+        timed_spec.loader = _TimedLoader(self, spec)
+        return timed_spec
+
+    def time_exec(self, spec, module):
+        start = time.perf_counter()
+        self._stack.append(0)
+        try:
+            spec.loader.exec_module(module)
+        finally:
+            cumulative = time.perf_counter() - start
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += cumulative
+            self.timings.append((spec.name, cumulative - children, cumulative))
+
+    def report(self):
+        """
+        Log the total time spent importing and the slowest modules by self time, plus every module at debug level.
+        """
+        if not self.timings:
+            return
+        total = sum(self_time for _, self_time, _ in self.timings)
+        slowest = sorted(self.timings, key=lambda t: t[1], reverse=True)[:PROFILE_SUMMARY_COUNT]
+        dft_logger.info('imported %d modules in %0.3fs, slowest: %s', len(self.timings), total,
+                        ', '.join('{} {:0.0f}ms'.format(name, self_time * 1000) for name, self_time, _ in slowest))
+        dft_logger.debug('import time: self [ms] | cumulative | module\n%s', '\n'.join(
+            '{:18.1f} | {:10.1f} | {}'.format(self_time * 1000, cumulative * 1000, name)
+            for name, self_time, cumulative in self.timings
+        ))
+
+
+class _TimedLoader:
+    """
+    Stands in for one module's loader while it's imported, executing it with ImportProfiler.time_exec and
+    delegating everything else to the real loader.
+    """
+    def __init__(self, profiler, spec):
+        self._profiler = profiler
+        self._spec = spec
+
+    def __getattr__(self, name):
+        return getattr(self._spec.loader, name)
+
+    def exec_module(self, module):
+        # the module only ever sees its real spec and loader
+        module.__spec__ = self._spec
+        module.__loader__ = self._spec.loader
+        self._profiler.time_exec(self._spec, module)
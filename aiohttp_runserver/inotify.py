@@ -0,0 +1,118 @@
+import os
+import time
+
+from watchdog.observers.inotify import InotifyEmitter
+from watchdog.observers.inotify_buffer import InotifyBuffer
+from watchdog.observers.inotify_c import Inotify, InotifyConstants, InotifyEvent, WATCHDOG_ALL_EVENTS
+from watchdog.utils import BaseThread, unicode_paths
+from watchdog.utils.delayed_queue import DelayedQueue
+
+from .logs import dft_logger
+
+
+class PrunedInotify(Inotify):
+    """
+    Inotify which never adds watches to directories for which `prune(path)` is true, neither when the watch
+    is first registered nor when directories are created later, so ignored trees don't use up
+    max_user_watches.
+
+    Replaces watchdog's recursive handling (pinned to 0.8.3) which watches every directory under the root.
+    """
+    def __init__(self, path, recursive=False, event_mask=WATCHDOG_ALL_EVENTS, prune=None):
+        self._recursive = recursive
+        self._prune = prune or (lambda p: False)
+        # recursion is handled here rather than by Inotify so that new directories are also pruned
+        try:
+            super().__init__(path, False, event_mask)
+        except OSError:
+            # eg. max_user_watches reached while adding watches, don't leak the inotify instance
+            if getattr(self, '_inotify_fd', None) is not None:
+                os.close(self._inotify_fd)
+            raise
+
+    @property
+    def watch_count(self):
+        return len(self._wd_for_path)
+
+    def _walk(self, path):
+        for root, dirnames, filenames in os.walk(path):
+            dirnames[:] = [
+                d for d in dirnames
+                if not os.path.islink(os.path.join(root, d)) and not self._pruned(os.path.join(root, d))
+            ]
+            yield root, dirnames, filenames
+
+    def _pruned(self, path):
+        return self._prune(unicode_paths.decode(path))
+
+    def _add_dir_watch(self, path, recursive, mask):
+        if not os.path.isdir(path):
+            raise OSError('Path is not a directory')
+        if not self._recursive:
+            self._add_watch(path, mask)
+            return
+        for root, _, _ in self._walk(path):
+            self._add_watch(root, mask)
+
+    def read_events(self, *args, **kwargs):
+        events = super().read_events(*args, **kwargs)
+        if not self._recursive:
+            return events
+        new_events = []
+        with self._lock:
+            for event in events:
+                if event.is_directory and event.is_create and not self._pruned(event.src_path):
+                    new_events.extend(self._watch_new_directory(event.src_path))
+        return events + new_events
+
+    def _watch_new_directory(self, path):
+        """
+        Add watches to a new directory and simulate create events for anything created in it before the watch
+        existed, eg. "mkdir -p foo/bar; touch foo/bar/spam".
+        """
+        events = []
+        try:
+            self._add_watch(path, self._event_mask)
+        except OSError:
+            return events
+        for root, dirnames, filenames in self._walk(path):
+            for dirname in dirnames:
+                full_path = os.path.join(root, dirname)
+                try:
+                    wd = self._add_watch(full_path, self._event_mask)
+                except OSError:
+                    continue
+                mask = InotifyConstants.IN_CREATE | InotifyConstants.IN_ISDIR
+                events.append(InotifyEvent(wd, mask, 0, dirname, full_path))
+            parent_wd = self._wd_for_path.get(root)
+            if parent_wd is None:
+                continue
+            for filename in filenames:
+                full_path = os.path.join(root, filename)
+                events.append(InotifyEvent(parent_wd, InotifyConstants.IN_CREATE, 0, filename, full_path))
+        return events
+
+
+class PrunedInotifyBuffer(InotifyBuffer):
+    def __init__(self, path, recursive=False, prune=None):
+        BaseThread.__init__(self)
+        self._queue = DelayedQueue(self.delay)
+        self._inotify = PrunedInotify(path, recursive, prune=prune)
+        self.start()
+
+    @property
+    def watch_count(self):
+        return self._inotify.watch_count
+
+
+class PrunedInotifyEmitter(InotifyEmitter):
+    def __init__(self, *args, prune=None, **kwargs):
+        self._prune = prune
+        super().__init__(*args, **kwargs)
+
+    def on_thread_start(self):
+        start = time.monotonic()
+        path = unicode_paths.encode(self.watch.path)
+        self._inotify = PrunedInotifyBuffer(path, self.watch.is_recursive, self._prune)
+        dft_logger.debug('watching %s with %d inotify watches, registered in %0.3fs',
+                         self.watch.path, self._inotify.watch_count, time.monotonic() - start)
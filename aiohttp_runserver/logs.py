@@ -1,6 +1,12 @@
-import re
-import click
+import atexit
 import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+import click
 
 dft_logger = logging.getLogger('aiohttp_runserver.default')
 main_access_logger = logging.getLogger('aiohttp.access')
@@ -13,70 +19,232 @@ LOG_COLOURS = {
 }
 
 
-class DefaultHandler(logging.Handler):
+def _ansi(fg):
+    """
+    Escape codes to start and reset a foreground colour, worked out once rather than calling click.style per record.
+    """
+    start, reset = click.style('\0', fg=fg).split('\0')
+    return start, reset
+
+
+TIME_STYLE, RESET = _ansi('magenta')
+LEVEL_STYLES = {level: _ansi(colour)[0] for level, colour in LOG_COLOURS.items()}
+ERROR_STYLE = _ansi('red')[0]
+SLOW_STYLE = LEVEL_STYLES[logging.WARN]
+_time_cache = [None, '']
+
+
+def _timestamp(created):
+    """
+    Styled "[HH:MM:SS] " for a record, only formatted once per second. Only called from the writer thread.
+    """
+    second = int(created)
+    if second != _time_cache[0]:
+        _time_cache[0] = second
+        _time_cache[1] = '{}[{}]{} '.format(TIME_STYLE, time.strftime('%H:%M:%S', time.localtime(second)), RESET)
+    return _time_cache[1]
+
+
+def _styled_message(record):
+    msg = record.message
+    if record.exc_text:
+        msg = '{}\n{}'.format(msg, record.exc_text)
+    return '{}{}{}'.format(LEVEL_STYLES.get(record.levelno, ERROR_STYLE), msg, RESET)
+
+
+class LogWriter:
+    """
+    Background thread which formats queued records and writes them to the terminal in batches, so logging doesn't
+    block the event loops with terminal writes.
+
+    Threads don't survive fork, so the thread and queue are recreated the first time a record is logged in a new
+    process.
+    """
+    max_batch = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    def put(self, handler, record):
+        if self._pid != os.getpid():
+            self._start()
+        self._queue.put((handler, record))
+
+    def flush(self, timeout=1):
+        """
+        Wait for records logged so far to be written.
+        """
+        if self._pid != os.getpid():
+            return
+        done = threading.Event()
+        self._queue.put((None, done))
+        done.wait(timeout)
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            threading.Thread(target=self._run, args=(self._queue,), name='log-writer', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self, q):
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines, flushed = [], []
+            for handler, record in batch:
+                if handler is None:
+                    flushed.append(record)
+                    continue
+                try:
+                    lines.append(handler.format_line(record))
+                except Exception:
+                    handler.handleError(record)
+            if lines:
+                click.echo('\n'.join(lines))
+            for done in flushed:
+                done.set()
+
+
+LOG_WRITER = LogWriter()
+atexit.register(LOG_WRITER.flush)
+
+
+def flush_logs():
+    LOG_WRITER.flush()
+
+
+class BackgroundHandler(logging.Handler):
+    """
+    Passes records to LOG_WRITER which calls format_line and writes the result in its own thread. The message is
+    interpolated straight away in case its arguments change.
+    """
     def emit(self, record):
-        log_entry = self.format(record)
-        colour = LOG_COLOURS.get(record.levelno, 'red')
-        m = re.match('^(\[.*?\])', log_entry)
-        if m:
-            time = click.style(m.groups()[0], fg='magenta')
-            msg = click.style(log_entry[m.end():], fg=colour)
-            click.echo(time + msg)
-        else:
-            click.secho(log_entry, fg=colour)
-
-
-class AuxiliaryLogHandler(logging.Handler):
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        LOG_WRITER.put(self, record)
+
+    def format_line(self, record):
+        raise NotImplementedError
+
+
+class DefaultHandler(BackgroundHandler):
+    def format_line(self, record):
+        return _timestamp(record.created) + _styled_message(record)
+
+
+class AuxiliaryLogHandler(BackgroundHandler):
     prefix = click.style('◆', fg='blue')
 
-    def emit(self, record):
-        log_entry = self.format(record)
-        colour = LOG_COLOURS.get(record.levelno, 'red')
-        m = re.match('^(\[.*?\] )', log_entry)
-        time = click.style(m.groups()[0], fg='magenta')
-        msg = log_entry[m.end():]
-        if record.levelno == logging.INFO and msg.startswith('>'):
-            msg = '{prefix} {msg}'.format(prefix=self.prefix, msg=msg[2:])
-        else:
-            msg = click.style(msg, fg=colour)
-        click.echo(time + msg)
-
-
-class MainAccessLogHandler(logging.Handler):
+    def format_line(self, record):
+        if record.levelno == logging.INFO and record.message.startswith('>'):
+            return '{}{} {}'.format(_timestamp(record.created), self.prefix, record.message[2:])
+        return _timestamp(record.created) + _styled_message(record)
+
+
+class MainAccessLogHandler(BackgroundHandler):
     prefix = click.style('●', fg='blue')
 
-    def emit(self, record):
-        log_entry = self.format(record)
-        m = re.match('^(\[.*?\] )', log_entry)
-        time = click.style(m.groups()[0], fg='magenta')
-        msg = log_entry[m.end():]
-        method, path, _, code, size = msg.split(' ')
-        size = fmt_size(int(size))
-        msg = '{prefix} {method} {path} {code} {size}'.format(prefix=self.prefix, method=method, path=path,
-                                                              code=code, size=size)
-        click.echo(time + msg)
+    def format_line(self, record):
+        status = getattr(record, 'status', None)
+        if status is None:
+            # eg. a summary from AccessLog
+            return _timestamp(record.created) + _styled_message(record)
+        duration = '{:0.0f}ms'.format(record.duration * 1000)
+        if record.slow:
+            duration = SLOW_STYLE + duration + RESET
+        return '{}{} {} {} {} {} {}'.format(_timestamp(record.created), self.prefix, record.method, record.path,
+                                            status, fmt_size(record.size), duration)
+
+
+class AccessLog:
+    """
+    Used by servers as aiohttp's access logger: aiohttp's message is split into fields once and logged as a
+    structured record for MainAccessLogHandler.
+
+    With limit set at most that many requests are logged each second, the rest are counted by status and
+    summarised at the end of the second. Requests taking at least slow seconds are highlighted.
+    """
+    format = '%r %s %b %D'
+
+    def __init__(self, limit=None, loop=None, slow=None):
+        self._limit = limit
+        self._loop = loop
+        self._slow = slow
+        self._second = None
+        self._count = 0
+        self._skipped = Counter()
+        self._summary_handle = None
+
+    def info(self, message):
+        request_line, status, size, microseconds = message.rsplit(' ', 3)
+        if self._limit is not None:
+            second = int(self._loop.time())
+            if second != self._second:
+                self._summarise()
+                self._second, self._count = second, 0
+            self._count += 1
+            if self._count > self._limit:
+                self._skipped[status] += 1
+                if self._summary_handle is None:
+                    self._summary_handle = self._loop.call_at(second + 1, self._summarise)
+                return
+
+        if not main_access_logger.isEnabledFor(logging.INFO):
+            return
+        method, path = (request_line.split(' ', 2) + [''])[:2]
+        duration = int(microseconds) / 1e6
+        fields = {
+            'method': method,
+            'path': path,
+            'status': status,
+            'size': int(size),
+            'duration': duration,
+            'slow': self._slow is not None and duration >= self._slow,
+        }
+        # skips logger.info's stack walk to find the caller, it's always aiohttp
+        record = main_access_logger.makeRecord(main_access_logger.name, logging.INFO, __name__, 0, message, None,
+                                               None, extra=fields)
+        main_access_logger.handle(record)
+
+    def exception(self, *args, **kwargs):
+        main_access_logger.exception(*args, **kwargs)
+
+    def _summarise(self):
+        if self._summary_handle is not None:
+            self._summary_handle.cancel()
+            self._summary_handle = None
+        if self._skipped:
+            by_status = ', '.join('{} {}'.format(count, status) for status, count in sorted(self._skipped.items()))
+            main_access_logger.info('%d more requests not logged: %s', sum(self._skipped.values()), by_status)
+            self._skipped.clear()
 
 
 def setup_logging(verbose=False):
     log_level = logging.DEBUG if verbose else logging.INFO
-    formatter = logging.Formatter('[%(asctime)s] %(message)s', datefmt='%H:%M:%S')
-
-    # for h in dft_logger.handlers:
-    #     if isinstance(h, DefaultHandler):
-    #         return
-    dft_hdl = DefaultHandler()
-    dft_hdl.setFormatter(formatter)
-    dft_logger.addHandler(dft_hdl)
+
+    # servers forked from the preloading process inherit its handlers
+    for h in dft_logger.handlers:
+        if isinstance(h, DefaultHandler):
+            return
+    dft_logger.addHandler(DefaultHandler())
     dft_logger.setLevel(log_level)
 
-    aux_hdl = AuxiliaryLogHandler()
-    aux_hdl.setFormatter(formatter)
-    aux_logger.addHandler(aux_hdl)
+    aux_logger.addHandler(AuxiliaryLogHandler())
     aux_logger.setLevel(log_level)
 
-    main_hdl = MainAccessLogHandler()
-    main_hdl.setFormatter(formatter)
-    main_access_logger.addHandler(main_hdl)
+    main_access_logger.addHandler(MainAccessLogHandler())
     main_access_logger.setLevel(logging.DEBUG)
 
 
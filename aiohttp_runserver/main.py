@@ -1,14 +1,35 @@
 import os
+from collections import OrderedDict
 from pathlib import Path
 from pprint import pformat
 
 import click
-from watchdog.observers import Observer
 
 from aiohttp_runserver import VERSION
 from .logs import dft_logger, setup_logging, AuxiliaryLogHandler
-from .serve import create_auxiliary_app, import_string
-from .watch import CodeFileEventHandler, StaticFileEventEventHandler, AllCodeEventEventHandler
+from .metrics import WATCH_ROOTS
+from .observers import start_observer, watch_counts
+from .serve import IGNORE, RESTART, WATCH_POLICIES, create_auxiliary_app, import_string, ports_in_use
+from .watch import (CODE, STATIC, TEMPLATE, AllCodeEventEventHandler, CodeFileEventHandler, IgnoredDirectories,
+                    PathMatcher, StaticFileEventEventHandler, WatchDispatcher)
+
+
+def _watch_roots(config):
+    """
+    :return: every watched root with its policy, static_path is reported as its own root; and the roots the
+      observer needs to watch, nested roots are covered by their parent
+    """
+    stat_roots = OrderedDict([(config['code_path'], RESTART)])
+    if config['static_path']:
+        stat_roots.setdefault(config['static_path'], 'static')
+    for path, policy in config['watch']:
+        if policy != IGNORE:
+            stat_roots.setdefault(path, policy)
+    roots = []
+    for path in sorted(stat_roots, key=len):
+        if not path.startswith(tuple(os.path.join(r, '') for r in roots)):
+            roots.append(path)
+    return stat_roots, roots
 
 
 def run_apps(**config):
@@ -19,23 +40,41 @@ def run_apps(**config):
         static_path=static_path and str(Path(static_path).resolve()),
     )
     dft_logger.debug('config:\n%s', pformat(config))
+    in_use = ports_in_use(config['main_port'], config['aux_port'])
+    if in_use:
+        raise click.ClickException('port {} already in use, is another server running?'.format(in_use[0]))
 
     aux_app = create_auxiliary_app(**config)
 
-    observer = Observer()
     code_file_eh = CodeFileEventHandler(aux_app, config)
-    dft_logger.debug('starting CodeFileEventHandler to watch %s', config['code_path'])
-    observer.schedule(code_file_eh, config['code_path'], recursive=True)
-
-    all_code_file_eh = AllCodeEventEventHandler(aux_app, config)
-    observer.schedule(all_code_file_eh, config['code_path'], recursive=True)
+    all_code_file_eh = AllCodeEventEventHandler(aux_app, config, code_file_eh)
+    # code changes restart the server which prompts browsers to reload once it's ready, changed templates are
+    # picked up by the running server so only need the reload
+    consumers = {
+        CODE: [code_file_eh],
+        TEMPLATE: [all_code_file_eh],
+    }
+    event_handlers = [code_file_eh, all_code_file_eh]
 
     static_path = config['static_path']
     if static_path:
         static_file_eh = StaticFileEventEventHandler(aux_app, config)
-        dft_logger.debug('starting StaticFileEventEventHandler to watch %s', static_path)
-        observer.schedule(static_file_eh, static_path, recursive=True)
-    observer.start()
+        consumers[STATIC] = [static_file_eh]
+        event_handlers.append(static_file_eh)
+
+    watch = config['watch']
+    stat_roots, roots = _watch_roots(config)
+
+    matcher = PathMatcher(static_path, watch)
+    dispatcher = WatchDispatcher(aux_app, matcher, consumers, stat_roots.items())
+    prune = IgnoredDirectories(matcher, roots, keep=static_path,
+                               ignore=[path for path, policy in watch if policy == IGNORE])
+    observer = start_observer(dispatcher, roots, prune, polling=config['poll'])
+    for root, count in watch_counts(observer).items():
+        if root in aux_app[WATCH_ROOTS]:
+            aux_app[WATCH_ROOTS][root].watches = count
+    for path, policy in watch:
+        dft_logger.info('watching %s, policy %s', path, policy)
 
     loop = aux_app.loop
     handler = aux_app.make_handler(access_log=None)
@@ -58,6 +97,8 @@ def run_apps(**config):
         loop.create_task(aux_app.close_websockets())
         observer.stop()
         observer.join()
+        for eh in event_handlers:
+            eh.close()
         srv.close()
         loop.run_until_complete(srv.wait_closed())
         loop.run_until_complete(aux_app.shutdown())
@@ -70,11 +111,49 @@ static_url_help = 'URL path to serve static files from, default "/static/".'
 livereload_help = 'Whether to inject livereload.js into html page footers to autoreload on changes.'
 port_help = 'Port to serve app from, default 8000.'
 aux_port_help = 'Port to serve auxiliary app (reload and static) on, default 8001.'
+preload_help = ('Import dependencies once in a long lived process and fork the server from it on each reload, '
+                'rather than starting from scratch, unix only.')
+workers_help = ('Number of server processes sharing the port, restarted together on changes, default 1. '
+                'Allows load testing with multiple cores.')
+debounce_help = 'Seconds without further changes to wait before reloading, default 0.1.'
+max_wait_help = 'Maximum seconds to delay reloading while changes keep arriving, default 1.'
+warmup_help = ('Compile changed modules to bytecode while waiting to reload and, with --preload, populate import '
+               'caches for the modules the last server imported before forking the next.')
+hot_reload_help = ('Reload changed modules in the running server rather than restarting it, when nothing else '
+                   'holds on to their functions or classes.')
+profile_imports_help = ('Report the time taken to import each module when the server starts, '
+                        'like "python -X importtime".')
+access_log_limit_help = ('Log at most this many requests per second from the app, the rest are summarised once a '
+                         'second by status. Default no limit.')
+profile_requests_help = ('Time requests to the app by route and sample the event loop\'s stack during slow requests, '
+                         'results are logged and available from the aux server at /_runserver/metrics.')
+slow_request_help = 'Seconds after which a request counts as slow, default 0.5.'
+block_threshold_help = ('Report code which blocks the app\'s event loop for longer than this many seconds, by call '
+                        'site. Totals are available from the aux server at /_runserver/metrics.')
+watch_help = ('Extra directory to watch as PATH[:POLICY], may be repeated. Policy is "restart" (default): python '
+              'files count as project code; "reload": any change reloads the browser; or "ignore": not watched, eg. '
+              'a large directory inside another root.')
+poll_help = 'Poll for file changes rather than using inotify etc., useful on network and container bind mounts.'
 verbose_help = 'Enable verbose output.'
 
 static_path_type = click.Path(exists=True, dir_okay=True, file_okay=False)
 
 
+def parse_watch(ctx, param, value):
+    """
+    Parse --watch values into (absolute path, policy), the path must be an existing directory.
+    """
+    roots = []
+    for option in value:
+        path, sep, policy = option.rpartition(':')
+        if not sep or policy not in WATCH_POLICIES:
+            path, policy = option, RESTART
+        if not os.path.isdir(path):
+            raise click.BadParameter('directory "{}" does not exist'.format(path))
+        roots.append((str(Path(path).resolve()), policy))
+    return roots
+
+
 @click.command()
 @click.version_option(VERSION, '-V', '--version', prog_name='aiohttp-runserver')
 @click.argument('app-path', type=click.Path(exists=True, dir_okay=False, file_okay=True), required=True)
@@ -84,6 +163,19 @@ static_path_type = click.Path(exists=True, dir_okay=True, file_okay=False)
 @click.option('--livereload/--no-livereload', default=True, help=livereload_help)
 @click.option('-p', '--port', 'main_port', default=8000, help=port_help)
 @click.option('--aux-port', default=8001, help=aux_port_help)
+@click.option('--preload/--no-preload', default=False, help=preload_help)
+@click.option('--workers', default=1, type=click.IntRange(1), help=workers_help)
+@click.option('--debounce', default=0.1, help=debounce_help)
+@click.option('--max-wait', default=1.0, help=max_wait_help)
+@click.option('--warmup/--no-warmup', default=False, help=warmup_help)
+@click.option('--hot-reload', is_flag=True, help=hot_reload_help)
+@click.option('--profile-imports', is_flag=True, help=profile_imports_help)
+@click.option('--access-log-limit', type=click.IntRange(0), help=access_log_limit_help)
+@click.option('--profile-requests', is_flag=True, help=profile_requests_help)
+@click.option('--slow-request', default=0.5, help=slow_request_help)
+@click.option('--block-threshold', type=float, help=block_threshold_help)
+@click.option('--watch', multiple=True, callback=parse_watch, metavar='PATH[:POLICY]', help=watch_help)
+@click.option('--poll', is_flag=True, help=poll_help)
 @click.option('-v', '--verbose', is_flag=True, help=verbose_help)
 def cli(**config):
     """
@@ -0,0 +1,226 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+
+from .logs import dft_logger
+
+# key of the aux app's ReloadMetrics
+METRICS = 'metrics'
+# key of the aux app's dict of {watched root: RootStats}
+WATCH_ROOTS = 'watch_roots'
+# key of the aux app's dict of {worker index: {'pid': pid, 'requests': requests handled}} for the current servers,
+# with --profile-requests each also has 'routes' latency histograms and recent 'slow_requests', with
+# --block-threshold 'blocking' stats for each call site which has blocked its loop
+WORKER_REQUESTS = 'worker_requests'
+
+# stages of a reload in the order they normally happen, each is timed from the filesystem event which started it
+DEBOUNCE = 'debounce'
+STOPPED = 'stopped'
+IMPORTING = 'importing'
+APP_FACTORY = 'app_factory'
+BOUND = 'bound'
+BROADCAST = 'broadcast'
+RECONNECT = 'reconnect'
+STAGES = (DEBOUNCE, STOPPED, IMPORTING, APP_FACTORY, BOUND, BROADCAST, RECONNECT)
+
+# seconds
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# a reload's summary is logged once a browser reconnects, once it's broadcast if no browsers are connected or
+# after this long
+TIMELINE_TIMEOUT = 10
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed buckets, like a prometheus histogram. Not thread safe.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.count and self.sum / self.count,
+            'buckets': OrderedDict([(str(b), c) for b, c in zip(self.buckets, self.counts)] + [('+Inf', self.count)]),
+        }
+
+
+class ReloadMetrics:
+    """
+    Times each stage of a reload from the filesystem event which caused it and keeps a histogram per stage.
+
+    A timeline starts with the first event while none is open; each stage is recorded once per timeline, by
+    whichever handler gets there first. Stages can be recorded from any thread, times are time.monotonic() which
+    is system wide so server processes can report their own. A timeline's stages are added to the histograms when
+    it's closed, a reload whose server failed to start is discarded so it's not counted.
+    """
+    def __init__(self, loop):
+        self._loop = loop
+        self._lock = threading.Lock()
+        self.histograms = OrderedDict((stage, Histogram()) for stage in STAGES)
+        self.reloads = 0
+        # (start time, {stage: latency}) of the reload in progress
+        self._timeline = None
+
+    def event(self):
+        """
+        Called when a filesystem event which will cause a reload is received.
+        """
+        with self._lock:
+            if self._timeline is not None:
+                return
+            timeline = self._timeline = time.monotonic(), OrderedDict()
+            self.reloads += 1
+        self._loop.call_soon_threadsafe(self._loop.call_later, TIMELINE_TIMEOUT, self._close, timeline)
+
+    def record(self, stage, at=None):
+        """
+        Record a stage of the reload in progress being reached.
+
+        :param stage: one of STAGES
+        :param at: time.monotonic() when the stage was reached, defaults to now
+        """
+        with self._lock:
+            if self._timeline is None:
+                return
+            start, stages = timeline = self._timeline
+            if stage in stages:
+                return
+            stages[stage] = (at or time.monotonic()) - start
+        if stage == RECONNECT:
+            self._loop.call_soon_threadsafe(self._close, timeline)
+
+    def finish(self):
+        """
+        Called in the loop when the reload in progress is complete without a browser to reconnect.
+        """
+        self._close(self._timeline)
+
+    def discard(self):
+        """
+        Called when the reload in progress has failed, the next event starts a new timeline.
+        """
+        with self._lock:
+            timeline, self._timeline = self._timeline, None
+        if timeline is not None:
+            dft_logger.debug('reload failed, discarding its timings')
+
+    def as_dict(self):
+        with self._lock:
+            return OrderedDict([
+                ('reloads', self.reloads),
+                ('stages', OrderedDict((stage, h.as_dict()) for stage, h in self.histograms.items())),
+            ])
+
+    def _close(self, timeline):
+        with self._lock:
+            if timeline is None or self._timeline is not timeline:
+                return
+            self._timeline = None
+            _, stages = timeline
+            for stage, latency in stages.items():
+                self.histograms[stage].observe(latency)
+        ordered = sorted(stages.items(), key=lambda item: item[1])
+        dft_logger.info('reload timings: %s', ', '.join('{} {:0.0f}ms'.format(s, t * 1000) for s, t in ordered))
+
+
+def _prometheus_roots(roots):
+    lines = [
+        '# HELP runserver_watch_events_total Filesystem events seen under each watched root.',
+        '# TYPE runserver_watch_events_total counter',
+    ]
+    for root, stats in roots.items():
+        lines.append('runserver_watch_events_total{{root="{}",policy="{}"}} {}'.format(
+            root.replace('"', '\\"'), stats['policy'], stats['events']))
+    lines.append('# TYPE runserver_watches gauge')
+    for root, stats in roots.items():
+        if stats['watches'] is not None:
+            lines.append('runserver_watches{{root="{}"}} {}'.format(root.replace('"', '\\"'), stats['watches']))
+    return lines
+
+
+def _prometheus(data, reload_stats, workers, roots):
+    lines = [
+        '# HELP runserver_reloads_total Reloads started by filesystem events.',
+        '# TYPE runserver_reloads_total counter',
+        'runserver_reloads_total {}'.format(data['reloads']),
+        '# HELP runserver_reload_stage_seconds Time from filesystem event to each stage of a reload.',
+        '# TYPE runserver_reload_stage_seconds histogram',
+    ]
+    for stage, h in data['stages'].items():
+        for bound, count in h['buckets'].items():
+            lines.append('runserver_reload_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage, bound, count))
+        lines.append('runserver_reload_stage_seconds_sum{{stage="{}"}} {}'.format(stage, h['sum']))
+        lines.append('runserver_reload_stage_seconds_count{{stage="{}"}} {}'.format(stage, h['count']))
+    lines += [
+        '# HELP runserver_worker_requests_total Requests handled by each server worker since it started.',
+        '# TYPE runserver_worker_requests_total counter',
+    ]
+    for index, worker in workers.items():
+        lines.append('runserver_worker_requests_total{{worker="{}",pid="{}"}} {}'.format(
+            index, worker['pid'], worker['requests']))
+    lines += [
+        '# HELP runserver_request_seconds Request latency by route, with --profile-requests.',
+        '# TYPE runserver_request_seconds histogram',
+    ]
+    for index, worker in workers.items():
+        for route, h in worker.get('routes', {}).items():
+            labels = 'worker="{}",route="{}"'.format(index, route.replace('"', '\\"'))
+            for bound, count in h['buckets'].items():
+                lines.append('runserver_request_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, count))
+            lines.append('runserver_request_seconds_sum{{{}}} {}'.format(labels, h['sum']))
+            lines.append('runserver_request_seconds_count{{{}}} {}'.format(labels, h['count']))
+    lines += [
+        '# HELP runserver_loop_blocked_seconds_total Time each call site has blocked the event loop, with '
+        '--block-threshold.',
+        '# TYPE runserver_loop_blocked_seconds_total counter',
+    ]
+    blocking = [(index, site, stats) for index, worker in workers.items()
+                for site, stats in worker.get('blocking', {}).items()]
+    for index, site, stats in blocking:
+        lines.append('runserver_loop_blocked_seconds_total{{worker="{}",site="{}"}} {}'.format(
+            index, site.replace('"', '\\"'), stats['total']))
+    lines.append('# TYPE runserver_loop_blocked_total counter')
+    for index, site, stats in blocking:
+        lines.append('runserver_loop_blocked_total{{worker="{}",site="{}"}} {}'.format(
+            index, site.replace('"', '\\"'), stats['count']))
+    lines += _prometheus_roots(roots)
+    for name, value in reload_stats.items():
+        if value is not None:
+            lines += [
+                '# TYPE runserver_reload_queue_{} gauge'.format(name),
+                'runserver_reload_queue_{} {}'.format(name, value),
+            ]
+    return '\n'.join(lines) + '\n'
+
+
+async def metrics_handler(request):
+    """
+    Reload stage histograms, reload queue stats, events for each watched root and requests handled by each worker,
+    plus request timings and loop blocking with --profile-requests and --block-threshold, as JSON or in
+    prometheus' text format with ?format=prometheus.
+    """
+    data = request.app[METRICS].as_dict()
+    reload_stats = request.app.reload_queue.stats()
+    workers = request.app[WORKER_REQUESTS]
+    roots = OrderedDict((root, stats.as_dict()) for root, stats in request.app[WATCH_ROOTS].items())
+    if request.GET.get('format') == 'prometheus':
+        return web.Response(text=_prometheus(data, reload_stats, workers, roots), content_type='text/plain')
+    data['reload_queue'] = reload_stats
+    data['workers'] = workers
+    data['roots'] = roots
+    return web.Response(text=json.dumps(data, indent=2), content_type='application/json')
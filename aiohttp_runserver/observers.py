@@ -0,0 +1,110 @@
+import time
+from functools import partial
+
+from watchdog.events import FileCreatedEvent, FileDeletedEvent, FileModifiedEvent
+from watchdog.observers import Observer
+from watchdog.observers.api import DEFAULT_EMITTER_TIMEOUT, BaseObserver, EventEmitter
+from watchdog.utils import UnsupportedLibc, platform
+
+from .logs import dft_logger
+from .polling import CREATED, DELETED, MODIFIED, PollingIndex
+
+if platform.is_linux():
+    try:
+        from .inotify import PrunedInotifyEmitter
+    except UnsupportedLibc:  # pragma: no cover
+        PrunedInotifyEmitter = None
+else:  # pragma: no cover
+    PrunedInotifyEmitter = None
+
+
+class PollingEmitter(EventEmitter):
+    """
+    Emitter for filesystems where inotify isn't available or has run out of watches, eg. network mounts or
+    bind mounts in containers.
+
+    The poll interval adapts: it grows while nothing changes, drops back as soon as something does and is kept
+    well above the time a scan takes so big trees don't keep a core busy.
+    """
+    min_interval = 0.5
+    max_interval = 2
+    event_classes = {
+        CREATED: FileCreatedEvent,
+        MODIFIED: FileModifiedEvent,
+        DELETED: FileDeletedEvent,
+    }
+
+    def __init__(self, event_queue, watch, timeout=DEFAULT_EMITTER_TIMEOUT, prune=None):
+        super().__init__(event_queue, watch, timeout)
+        self._prune = prune
+        self._index = None
+        self._interval = self.min_interval
+
+    def on_thread_start(self):
+        start = time.monotonic()
+        self._index = PollingIndex(self.watch.path, self._prune)
+        dft_logger.debug('polling %s, indexed %d files in %d directories in %0.3fs', self.watch.path,
+                         self._index.file_count, self._index.dir_count, time.monotonic() - start)
+
+    def queue_events(self, timeout):
+        if self.stopped_event.wait(self._interval):
+            return
+        start = time.monotonic()
+        changes = self._index.scan()
+        scan_time = time.monotonic() - start
+        for change, path in changes:
+            self.queue_event(self.event_classes[change](path))
+
+        if changes:
+            self._interval = self.min_interval
+        else:
+            self._interval = min(self._interval * 1.5, self.max_interval)
+        self._interval = max(self._interval, scan_time * 5)
+
+
+def create_observer(prune, polling=False):
+    """
+    Create an observer which skips directories for which prune(path) is true when registering watches, on
+    platforms other than linux watchdog's default observer is used unless polling is requested.
+    """
+    if polling:
+        return BaseObserver(emitter_class=partial(PollingEmitter, prune=prune))
+    if PrunedInotifyEmitter is None:  # pragma: no cover
+        return Observer()
+    return BaseObserver(emitter_class=partial(PrunedInotifyEmitter, prune=prune))
+
+
+def start_observer(handler, roots, prune, polling=False):
+    """
+    Watch roots recursively with handler, falling back to polling if the native observer can't be started eg.
+    because max_user_watches has been reached.
+
+    :return: the running observer
+    """
+    observer = create_observer(prune, polling)
+    for root in roots:
+        observer.schedule(handler, root, recursive=True)
+    try:
+        observer.start()
+    except OSError as e:
+        if polling:
+            raise
+        dft_logger.warning('unable to watch for changes natively (%s), falling back to polling', e)
+        observer.stop()
+        return start_observer(handler, roots, prune, polling=True)
+    return observer
+
+
+def watch_counts(observer):
+    """
+    :return: {root: number of inotify watches, or directories polled} for each root the observer is watching
+    """
+    counts = {}
+    for emitter in observer.emitters:
+        inotify = getattr(emitter, '_inotify', None)
+        index = getattr(emitter, '_index', None)
+        if inotify is not None:
+            counts[emitter.watch.path] = inotify.watch_count
+        elif index is not None:
+            counts[emitter.watch.path] = index.dir_count
+    return counts
@@ -0,0 +1,148 @@
+import os
+import time
+
+CREATED, MODIFIED, DELETED = 'created', 'modified', 'deleted'
+
+# directories modified this recently are listed again on the next scan regardless of their mtime, in case
+# another change happened within the filesystem's timestamp resolution (same idea as git's "racy git" check)
+RACY_NS = 2 * 10 ** 9
+
+
+def _file_state(st):
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class PollingIndex:
+    """
+    In memory index of the files under a directory used to find changes by polling.
+
+    Each scan stats every known directory and only lists those whose mtime has changed, so creating, deleting and
+    renaming files is found without walking the tree; known files are then stat'ed to compare
+    (inode, mtime_ns, size) with the index.
+    """
+    def __init__(self, root, prune=None):
+        """
+        :param root: directory to index
+        :param prune: callable returning True for directories which should not be indexed
+        """
+        self.root = root
+        self._prune = prune or (lambda path: False)
+        # file path: (inode, mtime_ns, size)
+        self._files = {}
+        # directory path: (mtime_ns or None to force listing it, file names, sub-directory names)
+        self._dirs = {}
+        self._index_tree(root, None)
+
+    @property
+    def file_count(self):
+        return len(self._files)
+
+    @property
+    def dir_count(self):
+        return len(self._dirs)
+
+    def scan(self):
+        """
+        Compare the filesystem with the index and update it.
+
+        :return: list of (change, path) tuples where change is one of CREATED, MODIFIED or DELETED
+        """
+        changes = []
+        for dir_path in list(self._dirs):
+            if dir_path not in self._dirs:
+                # removed along with its parent
+                continue
+            try:
+                mtime = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                self._remove_tree(dir_path, changes)
+                continue
+            if mtime != self._dirs[dir_path][0]:
+                self._rescan_dir(dir_path, changes)
+
+        for path, state in self._files.items():
+            try:
+                new_state = _file_state(os.stat(path))
+            except OSError:
+                # deleted since its directory was checked, found on the next scan
+                continue
+            if new_state != state:
+                self._files[path] = new_state
+                changes.append((MODIFIED, path))
+        return changes
+
+    def _list_dir(self, dir_path):
+        """
+        :return: tuple (mtime_ns, file names, sub-directory names), mtime is None if the directory was modified too
+          recently to rely on it.
+        """
+        files, dirs = set(), set()
+        mtime = os.stat(dir_path).st_mtime_ns
+        for entry in os.scandir(dir_path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not self._prune(entry.path):
+                        dirs.add(entry.name)
+                elif entry.is_file():
+                    files.add(entry.name)
+            except OSError:
+                pass
+        if int(time.time() * 10 ** 9) - mtime < RACY_NS:
+            mtime = None
+        return mtime, files, dirs
+
+    def _add_file(self, path, changes):
+        try:
+            self._files[path] = _file_state(os.stat(path))
+        except OSError:
+            return
+        if changes is not None:
+            changes.append((CREATED, path))
+
+    def _index_tree(self, root, changes):
+        stack = [root]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                entry = self._list_dir(dir_path)
+            except OSError:
+                continue
+            self._dirs[dir_path] = entry
+            _, files, dirs = entry
+            for name in files:
+                self._add_file(os.path.join(dir_path, name), changes)
+            stack.extend(os.path.join(dir_path, name) for name in dirs)
+
+    def _remove_tree(self, root, changes):
+        stack = [root]
+        while stack:
+            dir_path = stack.pop()
+            entry = self._dirs.pop(dir_path, None)
+            if entry is None:
+                continue
+            _, files, dirs = entry
+            for name in files:
+                path = os.path.join(dir_path, name)
+                if self._files.pop(path, None) is not None:
+                    changes.append((DELETED, path))
+            stack.extend(os.path.join(dir_path, name) for name in dirs)
+
+    def _rescan_dir(self, dir_path, changes):
+        try:
+            new_mtime, files, dirs = self._list_dir(dir_path)
+        except OSError:
+            self._remove_tree(dir_path, changes)
+            return
+        _, old_files, old_dirs = self._dirs[dir_path]
+        self._dirs[dir_path] = new_mtime, files, dirs
+
+        for name in files - old_files:
+            self._add_file(os.path.join(dir_path, name), changes)
+        for name in old_files - files:
+            path = os.path.join(dir_path, name)
+            if self._files.pop(path, None) is not None:
+                changes.append((DELETED, path))
+        for name in dirs - old_dirs:
+            self._index_tree(os.path.join(dir_path, name), changes)
+        for name in old_dirs - dirs:
+            self._remove_tree(os.path.join(dir_path, name), changes)
@@ -0,0 +1,238 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+from .logs import dft_logger, main_access_logger
+from .metrics import Histogram
+
+# key of the RequestTimer in the main app when --profile-requests is used
+REQUEST_TIMER = 'aiohttp_runserver_request_timer'
+
+# seconds
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# how often the loop's stack is sampled while requests are in flight
+SAMPLE_INTERVAL = 0.005
+# frames kept from the innermost end of each sampled stack
+STACK_DEPTH = 8
+# slow requests kept for the aux server, and stacks listed for each
+SLOW_REQUESTS_KEPT = 20
+SLOW_REQUEST_STACKS = 5
+
+
+def _route_name(request):
+    route = request.match_info.route
+    info = route.get_info()
+    path = info.get('path') or info.get('formatter') or info.get('prefix')
+    if path is None:
+        # eg. 404 and 405 responses
+        return 'unmatched'
+    return '{} {}'.format(route.method, path)
+
+
+def _is_idle(frame):
+    # the loop is waiting in its selector for something to do
+    return frame.f_code.co_filename.endswith(os.sep + 'selectors.py')
+
+
+def _stack(frame):
+    stack = []
+    while frame is not None and len(stack) < STACK_DEPTH:
+        code = frame.f_code
+        stack.append('{}:{} {}'.format(code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    return tuple(stack)
+
+
+class RequestTimer:
+    """
+    Timing middleware for the main app: keeps a latency histogram per route and profiles requests which take
+    longer than slow.
+
+    While any request is in flight a thread samples the stack of the thread running the loop every
+    SAMPLE_INTERVAL. Samples where the loop is waiting in its selector count as idle, the rest are code running
+    on, and so blocking, the loop. Since requests share the loop a request's samples show what the loop was doing
+    while the request was in flight, not necessarily the request's own code.
+    """
+    def __init__(self, slow):
+        self._slow = slow
+        self._loop_thread = threading.get_ident()
+        # route name: Histogram
+        self.routes = OrderedDict()
+        self.slow_requests = deque(maxlen=SLOW_REQUESTS_KEPT)
+        # incremented with each request so reporting can tell when anything's changed
+        self.requests = 0
+        # Counter of samples taken while each in flight request was, keyed by its id
+        self._in_flight = {}
+        self._active = threading.Event()
+        self._closed = False
+        self._sampler = None
+
+    async def middleware(self, app, handler):
+        async def timing_middleware(request):
+            samples = Counter()
+            self._in_flight[id(samples)] = samples
+            self._active.set()
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='request-sampler', daemon=True)
+                self._sampler.start()
+            start = time.monotonic()
+            try:
+                return await handler(request)
+            finally:
+                duration = time.monotonic() - start
+                del self._in_flight[id(samples)]
+                if not self._in_flight:
+                    self._active.clear()
+                self._record(request, duration, samples)
+        return timing_middleware
+
+    def close(self):
+        self._closed = True
+        self._active.set()
+
+    def as_dict(self):
+        return {
+            'routes': OrderedDict((route, h.as_dict()) for route, h in self.routes.items()),
+            'slow_requests': list(self.slow_requests),
+        }
+
+    def _record(self, request, duration, samples):
+        self.requests += 1
+        # the sampler may still be adding to it
+        samples = Counter(samples)
+        route = _route_name(request)
+        histogram = self.routes.get(route)
+        if histogram is None:
+            histogram = self.routes[route] = Histogram(REQUEST_BUCKETS)
+        histogram.observe(duration)
+        if duration < self._slow:
+            return
+
+        total = sum(samples.values())
+        idle = samples.pop(None, 0)
+        busy = total - idle
+        stacks = samples.most_common(SLOW_REQUEST_STACKS)
+        self.slow_requests.append(OrderedDict([
+            ('route', route),
+            ('method', request.method),
+            ('path', request.path_qs),
+            ('duration', duration),
+            ('samples', total),
+            ('loop_busy', total and busy / total),
+            ('stacks', [{'count': count, 'frames': list(stack)} for stack, count in stacks]),
+        ]))
+        if stacks:
+            main_access_logger.warning('slow request %s %s %0.0fms, loop busy %0.0f%% of it, mostly at %s',
+                                       request.method, request.path_qs, duration * 1000, busy / total * 100,
+                                       stacks[0][0][0])
+        else:
+            main_access_logger.warning('slow request %s %s %0.0fms, loop idle while waiting', request.method,
+                                       request.path_qs, duration * 1000)
+
+    def _sample(self):
+        while True:
+            self._active.wait()
+            if self._closed:
+                return
+            time.sleep(SAMPLE_INTERVAL)
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            stack = None if _is_idle(frame) else _stack(frame)
+            for samples in list(self._in_flight.values()):
+                samples[stack] += 1
+
+
+def _call_site(frame, code_path):
+    """
+    The innermost frame in the project's own code, or the innermost frame if none are.
+    """
+    innermost = frame
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(code_path) and 'site-packages' not in filename:
+            break
+        frame = frame.f_back
+    frame = frame or innermost
+    code = frame.f_code
+    return '{}:{} {}'.format(os.path.relpath(code.co_filename, code_path), frame.f_lineno, code.co_name)
+
+
+class LoopWatchdog:
+    """
+    Thread which pings the loop every threshold / 2 seconds and, whenever the loop takes longer than threshold to
+    respond, samples the stack of the loop's thread until it does.
+
+    Each episode of blocking is attributed to the call site seen in most of its samples, sites are kept with the
+    number of times and total time they blocked the loop, the longest time and the last stack seen there.
+    """
+    def __init__(self, loop, threshold, code_path):
+        self._loop = loop
+        self._threshold = threshold
+        self._interval = threshold / 2
+        self._code_path = os.path.join(code_path, '')
+        self._loop_thread = threading.get_ident()
+        self._last_seen = time.monotonic()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        # site: {'count', 'total', 'max', 'stack'}
+        self.sites = {}
+        # incremented with each episode so reporting can tell when anything's changed
+        self.episodes = 0
+
+    def start(self):
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def as_dict(self):
+        with self._lock:
+            sites = sorted(self.sites.items(), key=lambda item: item[1]['total'], reverse=True)
+            return OrderedDict((site, dict(stats)) for site, stats in sites)
+
+    def _ping(self):
+        self._last_seen = time.monotonic()
+
+    def _watch(self):
+        # site: number of samples, while the loop is blocked
+        samples = Counter()
+        stacks = {}
+        blocked_since = None
+        while not self._stopped.wait(self._interval):
+            now = time.monotonic()
+            last_seen = self._last_seen
+            if now - last_seen < self._threshold:
+                if blocked_since is not None:
+                    self._record(last_seen - blocked_since, samples, stacks)
+                    samples.clear()
+                    stacks.clear()
+                    blocked_since = None
+            else:
+                if blocked_since is None:
+                    blocked_since = last_seen
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    site = _call_site(frame, self._code_path)
+                    samples[site] += 1
+                    stacks[site] = _stack(frame)
+            try:
+                self._loop.call_soon_threadsafe(self._ping)
+            except RuntimeError:
+                # loop closed
+                return
+
+    def _record(self, duration, samples, stacks):
+        if not samples:
+            return
+        site = samples.most_common(1)[0][0]
+        with self._lock:
+            stats = self.sites.setdefault(site, {'count': 0, 'total': 0, 'max': 0, 'stack': None})
+            stats['count'] += 1
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+            stats['stack'] = list(stacks[site])
+            self.episodes += 1
+        dft_logger.warning('event loop blocked for %0.0fms at %s', duration * 1000, site)
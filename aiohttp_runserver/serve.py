@@ -1,26 +1,100 @@
 import os
 import sys
 import asyncio
+import gzip
+import html
 import json
+import mimetypes
+import signal
+import socket
+import threading
+import time
+import traceback
+import zlib
+from collections import OrderedDict, namedtuple
 from pathlib import Path
+from stat import S_ISREG
 
 from importlib import import_module
 
 from aiohttp import web, MsgType
-from aiohttp.hdrs import LAST_MODIFIED
+from aiohttp.hdrs import ACCEPT_ENCODING, CACHE_CONTROL, CONTENT_ENCODING, ETAG, IF_NONE_MATCH, VARY
 from aiohttp.web_exceptions import HTTPNotModified, HTTPNotFound
 from aiohttp.web_urldispatcher import StaticRoute
-from .logs import aux_logger, fmt_size, setup_logging
+from .hotreload import invalidate_templates, reload_modules
+from .imports import ImportProfiler
+from .logs import AccessLog, aux_logger, flush_logs, fmt_size, setup_logging
+from .profiling import REQUEST_TIMER, LoopWatchdog, RequestTimer
+from .metrics import (APP_FACTORY, BOUND, BROADCAST, IMPORTING, METRICS, RECONNECT, WATCH_ROOTS, WORKER_REQUESTS,
+                      ReloadMetrics, metrics_handler)
 
-LIVE_RELOAD_SNIPPET = b'\n<script src="%s/livereload.js"></script>\n'
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+LIVE_RELOAD_SNIPPET = b'\n<script src="%s"></script>\n'
+LIVE_RELOAD_JS_PATH = Path(__file__).absolute().parent / 'livereload.js'
+BODY_END = b'</body>'
+# bytes held back after a streamed "</body>" in case it isn't the last, more than that and it's taken to be part of
+# the page, eg. in an inline script, so streaming isn't held up
+MAX_BODY_TAIL = 4096
 JINJA_ENV = 'aiohttp_jinja2_environment'
+# with SO_REUSEPORT a new server can bind main_port while the old one is still serving
+REUSE_PORT = hasattr(socket, 'SO_REUSEPORT')
+# how often the server checks for newly imported modules, eg. modules imported lazily by views
+IMPORTS_REPORT_INTERVAL = 2
+# how often each server reports the number of requests it has handled
+REQUESTS_REPORT_INTERVAL = 1
+# what happens when files under a --watch root change: restart the server (python files, templates reload the
+# browser as for code_path), reload the browser (any file) or nothing as the directory isn't watched at all
+RESTART, RELOAD, IGNORE = 'restart', 'reload', 'ignore'
+WATCH_POLICIES = RESTART, RELOAD, IGNORE
+
+
+def ports_in_use(*ports):
+    """
+    Ports something is already listening on. Servers set SO_REUSEPORT so would otherwise bind main_port
+    alongside another runserver and the kernel would share connections between the two.
+    """
+    in_use = []
+    for port in ports:
+        sock = socket.socket()
+        # without SO_REUSEPORT, so only fails if something has bound the port, not for connections in TIME_WAIT
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(('0.0.0.0', port))
+        except OSError:
+            in_use.append(port)
+        finally:
+            sock.close()
+    return in_use
+
+
+def project_roots(config):
+    """
+    Directories whose python files belong to the project rather than its dependencies: code_path and --watch roots
+    with the restart policy, eg. local packages installed in editable mode.
+
+    :return: absolute paths each ending with a separator
+    """
+    roots = [config['code_path']] + [path for path, policy in config['watch'] if policy == RESTART]
+    return [os.path.join(os.path.abspath(r), '') for r in roots]
+
+
+def _live_reload_snippet(config):
+    aux_server = 'http://localhost:{aux_port}'.format(**config)
+    # versioned so browsers can cache the script indefinitely
+    script_url = '{}/livereload.js?v={}'.format(aux_server, _livereload_js_version())
+    return LIVE_RELOAD_SNIPPET % script_url.encode()
 
 
 def modify_main_app(app, **config):
     aux_server = 'http://localhost:{aux_port}'.format(**config)
-    live_reload_snippet = LIVE_RELOAD_SNIPPET % aux_server.encode()
     livereload_enabled = config['livereload']
     aux_logger.debug('livereload enabled: %s', '✓' if livereload_enabled else '✖')
+    if livereload_enabled:
+        live_reload_snippet = _live_reload_snippet(config)
 
     if JINJA_ENV in app:
         static_url = '{}/{}'.format(aux_server, config['static_url'].strip('/'))
@@ -31,114 +105,582 @@ def modify_main_app(app, **config):
 
     async def on_prepare(request, response):
         if livereload_enabled and 'text/html' in response.content_type:
-            response.body += live_reload_snippet
+            inject_snippet(response, live_reload_snippet)
     app.on_response_prepare.append(on_prepare)
 
+    if config['profile_requests']:
+        timer = app[REQUEST_TIMER] = RequestTimer(config['slow_request'])
+        # outermost so the user's middlewares are timed too
+        app.middlewares.insert(0, timer.middleware)
+
+        async def on_shutdown(app):
+            timer.close()
+        app.on_shutdown.append(on_shutdown)
+
+
+class SnippetInjector:
+    """
+    Inserts a snippet before the last "</body>" of a streamed response as chunks are written, or at the end if
+    there isn't one.
+
+    Chunks are passed straight through up to the latest "</body>", which is held back with whatever follows it until
+    a later one is written or the response ends. A chunk ending with what might be the start of "</body>" has that
+    part held back until the next write.
+    """
+    def __init__(self, response, snippet):
+        self._write = response.write
+        self._write_eof = response.write_eof
+        self._snippet = snippet
+        self._held = b''
+        self._done = False
+
+    def write(self, data):
+        if self._done or not data:
+            return self._write(data)
+        if self._held:
+            data, self._held = self._held + data, b''
+        index = data.rfind(BODY_END)
+        if index != -1 and len(data) - index <= MAX_BODY_TAIL:
+            data, self._held = data[:index], data[index:]
+        else:
+            for n in range(min(len(BODY_END) - 1, len(data)), 0, -1):
+                if data.endswith(BODY_END[:n]):
+                    data, self._held = data[:-n], data[-n:]
+                    break
+        if data:
+            return self._write(data)
+
+    async def write_eof(self):
+        if not self._done:
+            self._done = True
+            if self._held.startswith(BODY_END):
+                self._write(self._snippet)
+                self._write(self._held)
+            else:
+                if self._held:
+                    self._write(self._held)
+                self._write(self._snippet)
+        await self._write_eof()
+
+
+def _inject_into_body(response, snippet):
+    body = response.body
+    index = body.rfind(BODY_END)
+    # slicing would copy the whole page since aiohttp only writes bytes, but if nothing except "</html>" follows
+    # "</body>" the snippet can go at the very end: browsers parse it as the last child of <body> either way
+    append = index == -1 or body[index + len(BODY_END):].strip().lower() in {b'', b'</html>'}
+    write = response.write
+
+    def write_body(data):
+        if data is not body:
+            return write(data)
+        if append:
+            write(body)
+            return write(snippet)
+        write(body[:index])
+        write(snippet)
+        return write(body[index:])
+    response.write = write_body
+
 
-def serve_main_app(**config):
+def inject_snippet(response, snippet):
+    """
+    Add snippet to an html response as it's written without copying the body, called when the response is
+    prepared so Content-Length can still be updated.
+
+    The snippet goes before the last "</body>", or at the end if there isn't one, whether the response is streamed
+    or has a body.
+    """
+    if CONTENT_ENCODING in response.headers:
+        # already compressed by the view
+        return
+    if isinstance(response, web.Response) and response.body is not None:
+        _inject_into_body(response, snippet)
+    else:
+        injector = SnippetInjector(response, snippet)
+        response.write = injector.write
+        response.write_eof = injector.write_eof
+    if response.content_length is not None:
+        response.content_length += len(snippet)
+
+
+def _report_imports(conn, roots, loop, module_count=None):
+    """
+    Send the parent the list of project files this server has imported so it can ignore changes to other files,
+    resent whenever the number of imported modules changes.
+
+    :param roots: project_roots()
+    """
+    if len(sys.modules) != module_count:
+        module_count = len(sys.modules)
+        prefixes = tuple(roots)
+        paths = filter(None, (getattr(m, '__file__', None) for m in list(sys.modules.values())))
+        files = [p for p in map(os.path.abspath, paths) if p.startswith(prefixes)]
+        try:
+            conn.send(('imports', files))
+        except OSError:
+            # parent has gone away
+            return
+    loop.call_later(IMPORTS_REPORT_INTERVAL, _report_imports, conn, roots, loop, module_count)
+
+
+def _report_requests(conn, loop, counter, reported=0):
+    """
+    Send the parent the number of requests this server has handled whenever it changes.
+    """
+    if counter[0] != reported:
+        reported = counter[0]
+        try:
+            conn.send(('stats', {'requests': reported}))
+        except OSError:
+            return
+    loop.call_later(REQUESTS_REPORT_INTERVAL, _report_requests, conn, loop, counter, reported)
+
+
+def _report_timings(conn, loop, timer, reported=0):
+    """
+    Send the parent this server's route latency histograms and slow requests whenever there are new requests.
+    """
+    if timer.requests != reported:
+        reported = timer.requests
+        try:
+            conn.send(('stats', timer.as_dict()))
+        except OSError:
+            return
+    loop.call_later(REQUESTS_REPORT_INTERVAL, _report_timings, conn, loop, timer, reported)
+
+
+def _report_blocking(conn, loop, watchdog, reported=0):
+    """
+    Send the parent the call sites which have blocked this server's loop whenever there are new ones.
+    """
+    if watchdog.episodes != reported:
+        reported = watchdog.episodes
+        try:
+            conn.send(('stats', {'blocking': watchdog.as_dict()}))
+        except OSError:
+            return
+    loop.call_later(REQUESTS_REPORT_INTERVAL, _report_blocking, conn, loop, watchdog, reported)
+
+
+def _on_control(conn, loop, app, config):
+    """
+    Called when the parent sends a command to update the running server in place: "templates" drops changed
+    templates from the jinja cache, "modules" reloads changed modules if that's enough. Each is answered with
+    "hot_reloaded" and None, or why the server needs restarting instead.
+    """
+    try:
+        command, paths = conn.recv()
+    except (EOFError, OSError):
+        loop.remove_reader(conn.fileno())
+        return
+    start = time.monotonic()
+    if command == 'templates':
+        count = invalidate_templates(app.get(JINJA_ENV), paths)
+        aux_logger.debug('dropped %d cached templates', count)
+        reason = None
+    else:
+        reason = reload_modules(app, paths, project_roots(config), config['app_path'])
+        if reason is None:
+            aux_logger.debug('reloaded %d changed modules in %0.3fs', len(paths), time.monotonic() - start)
+    try:
+        conn.send(('hot_reloaded', reason))
+    except OSError:
+        pass
+
+
+def _count_requests(app):
+    counter = [0]
+
+    async def on_prepare(request, response):
+        counter[0] += 1
+    app.on_response_prepare.append(on_prepare)
+    return counter
+
+
+def _start_main_app(conn, sock, timings, config):
     setup_logging(config['verbose'])
     app_factory, _ = import_string(config['app_path'], config['app_factory'])
 
     loop = asyncio.new_event_loop()
     app = app_factory(loop=loop)
+    timings[APP_FACTORY] = time.monotonic()
 
     if app is None:
         raise TypeError('"app" may not be none')
 
     modify_main_app(app, **config)
-    handler = app.make_handler(access_log_format='%r %s %b')
-    srv = loop.run_until_complete(loop.create_server(handler, '0.0.0.0', config['main_port']))
+    if conn:
+        _report_imports(conn, project_roots(config), loop)
+        _report_requests(conn, loop, _count_requests(app))
+        if REQUEST_TIMER in app:
+            _report_timings(conn, loop, app[REQUEST_TIMER])
+    access_log = AccessLog(config['access_log_limit'], loop, config['slow_request'])
+    handler = app.make_handler(access_log=access_log, access_log_format=AccessLog.format)
+    if sock:
+        server = loop.create_server(handler, sock=sock)
+    else:
+        server = loop.create_server(handler, '0.0.0.0', config['main_port'], reuse_port=REUSE_PORT)
+    srv = loop.run_until_complete(server)
+    timings[BOUND] = time.monotonic()
+    return loop, app, handler, srv
+
+
+def serve_main_app(conn=None, sock=None, **config):
+    """
+    Run the main app, this is the target of the server process.
+
+    :param conn: optional pipe to the parent process used to report which files have been imported and when
+      the server is ready along with how long each stage of starting took, or the traceback if it failed to start
+    :param sock: optional listening socket shared with other workers to serve from instead of binding main_port
+    :param config: runserver config as passed to run_apps
+    """
+    timings = {IMPORTING: time.monotonic()}
+    profiler = ImportProfiler() if config['profile_imports'] else None
+    if profiler:
+        profiler.install()
+    try:
+        loop, app, handler, srv = _start_main_app(conn, sock, timings, config)
+    except Exception:
+        if not conn:
+            raise
+        # the parent reports the error
+        conn.send(('error', traceback.format_exc()))
+        flush_logs()
+        raise SystemExit(1)
+    finally:
+        if profiler:
+            profiler.uninstall()
+    # SIGINT may be delivered to the log writer's thread, then KeyboardInterrupt isn't raised until something
+    # else wakes the loop, the loop's own handler wakes it whichever thread gets the signal
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    if conn:
+        conn.send(('ready', timings))
+        loop.add_reader(conn.fileno(), _on_control, conn, loop, app, config)
+    if profiler:
+        profiler.report()
+
+    watchdog = None
+    if config['block_threshold']:
+        watchdog = LoopWatchdog(loop, config['block_threshold'], config['code_path'])
+        watchdog.start()
+        if conn:
+            _report_blocking(conn, loop, watchdog)
 
     try:
         loop.run_forever()
     except KeyboardInterrupt:  # pragma: no branch
         pass
     finally:
+        if watchdog:
+            watchdog.stop()
         srv.close()
         loop.run_until_complete(srv.wait_closed())
         loop.run_until_complete(app.shutdown())
         loop.run_until_complete(handler.finish_connections(4))
         loop.run_until_complete(app.cleanup())
     loop.close()
+    flush_logs()
+
+
+# key of the error app's (message, details) describing why the server is down
+SERVER_ERROR = 'server_error'
+ERROR_PAGE = """\
+<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="utf-8">
+  <title>Server error</title>
+</head>
+<body>
+  <h1>{message}</h1>
+  <pre>{details}</pre>
+</body>
+</html>
+"""
+
+
+async def error_page(request):
+    message, details = request.app[SERVER_ERROR]
+    body = ERROR_PAGE.format(message=html.escape(message), details=html.escape(details)).encode()
+    snippet = request.app['live_reload_snippet']
+    if snippet:
+        body = body.replace(BODY_END, snippet + BODY_END, 1)
+    response = web.Response(body=body, status=500, content_type='text/html')
+    response.headers[CACHE_CONTROL] = 'no-store'
+    return response
+
+
+def create_error_app(loop, config):
+    """
+    App served on main_port by runserver itself while the server processes are down, so browsers get the error
+    rather than a refused connection and, with livereload, reload once the servers are back.
+    """
+    app = web.Application(loop=loop)
+    app[SERVER_ERROR] = ('', '')
+    app['live_reload_snippet'] = config['livereload'] and _live_reload_snippet(config)
+    app.router.add_route('*', '/{path:.*}', error_page)
+    return app
 
 
+# livereload clients keyed by websocket
 WS = 'websockets'
+# messages a browser may have waiting before it's considered too slow and disconnected
+WS_QUEUE_SIZE = 16
+WS_SEND_TIMEOUT = 5
+# set of project files imported by the running server, None until the server has reported them
+IMPORTED_FILES = 'imported_files'
+STATIC_CACHE = 'static_cache'
+LIVE_RELOAD_JS = 'livereload_js'
+
+
+class LiveReloadClient:
+    """
+    A browser connected to the livereload websocket. Messages are sent by the client's own task from a bounded
+    queue so a slow client can't hold up the others; clients which fall behind or don't accept a message within
+    WS_SEND_TIMEOUT are dropped.
+    """
+    def __init__(self, ws, url, clients, loop):
+        """
+        :param ws: the client's WebSocketResponse
+        :param url: path of the page the client is showing
+        :param clients: registry of clients keyed by websocket which this client is removed from when dropped
+        """
+        self.ws = ws
+        self.url = url
+        self._clients = clients
+        self._loop = loop
+        self._queue = asyncio.Queue(WS_QUEUE_SIZE, loop=loop)
+        self._task = loop.create_task(self._send_messages())
+
+    def send(self, message):
+        """
+        Queue a message for sending, the client is dropped if its queue is full.
+        """
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            aux_logger.warning('browser at %s is not keeping up, disconnecting it', self.url)
+            self.drop()
+
+    def drop(self):
+        if self._clients.get(self.ws) is self:
+            del self._clients[self.ws]
+        self._task.cancel()
+        if not self.ws.closed:
+            self._loop.create_task(self.ws.close())
+
+    async def _send_messages(self):
+        while True:
+            message = await self._queue.get()
+            try:
+                self.ws.send_str(message)
+                await asyncio.wait_for(self.ws.drain(), WS_SEND_TIMEOUT, loop=self._loop)
+            except asyncio.TimeoutError:
+                aux_logger.warning('timed out sending to browser at %s, disconnecting it', self.url)
+                self.drop()
+                return
+            except (RuntimeError, ConnectionError) as e:
+                # "RuntimeError: websocket connection is closing" occurs if content type changes due to code change
+                aux_logger.error('error sending to browser at %s: %s', self.url, e)
+                self.drop()
+                return
+
+
+class ReloadQueue:
+    """
+    Hands reload requests from watcher threads to the aux app's loop. Requests are appended to a queue and the loop
+    is woken with call_soon_threadsafe at most once until it has run, it then coalesces everything pending into one
+    broadcast.
+
+    Queue depth and latency from the change being seen to the broadcast are recorded for each broadcast.
+    """
+    def __init__(self, loop, broadcast):
+        """
+        :param broadcast: called in the loop with a list of changed static paths, or None to reload whole pages
+        """
+        self._loop = loop
+        self._broadcast = broadcast
+        self._lock = threading.Lock()
+        self._pending = []
+        self._scheduled = False
+        self.requests = 0
+        self.broadcasts = 0
+        self.max_depth = 0
+        self.last_latency = None
+        self.max_latency = 0
+        self.total_latency = 0
+
+    def put(self, path=None, seen=None):
+        """
+        Request a reload, safe to call from any thread.
+
+        :param path: changed static path, None to reload whole pages
+        :param seen: time.monotonic() when the change was first seen, defaults to now
+        """
+        with self._lock:
+            self._pending.append((path, seen or time.monotonic()))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._loop.call_soon_threadsafe(self._flush)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'broadcasts': self.broadcasts,
+            'max_depth': self.max_depth,
+            'last_latency': self.last_latency,
+            'max_latency': self.max_latency,
+            'mean_latency': self.broadcasts and self.total_latency / self.broadcasts,
+        }
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._scheduled = False
+
+        paths = []
+        for path, _ in pending:
+            if path is None:
+                # the whole page is being reloaded anyway
+                paths = None
+                break
+            if path not in paths:
+                paths.append(path)
+        self._broadcast(paths)
+
+        latency = time.monotonic() - min(seen for _, seen in pending)
+        self.requests += len(pending)
+        self.broadcasts += 1
+        self.max_depth = max(self.max_depth, len(pending))
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+        aux_logger.debug('broadcast %d reload request%s %0.3fs after the change was seen', len(pending),
+                         '' if len(pending) == 1 else 's', latency)
 
 
 class AuxiliaryApplication(web.Application):
-    def static_reload(self, change_path):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reload_queue = ReloadQueue(self.loop, self._broadcast_change)
+
+    def static_reload(self, change_path, seen=None):
         config = self['config']
         static_root = config['static_path']
         change_path = Path(change_path).relative_to(static_root)
 
         path = Path(config['static_url']) / change_path
-        self._broadcast_change(path=str(path))
+        self.reload_queue.put(str(path), seen)
+
+    def src_reload(self, seen=None):
+        self.reload_queue.put(None, seen)
 
-    def src_reload(self):
-        self._broadcast_change()
+    def _broadcast_change(self, paths=None):
+        """
+        Queue reload messages for every client, each distinct message is only serialised once. Called by
+        reload_queue in the app's loop.
 
-    def _broadcast_change(self, path=None):
+        :param paths: changed static paths, if None clients reload their page
+        """
         cli_count = len(self[WS])
         if cli_count == 0:
+            self[METRICS].finish()
             return
         s = '' if cli_count == 1 else 's'
-        aux_logger.info('prompting reload of %s on %d client%s', path or 'page', cli_count, s)
-        for ws, url in self[WS]:
-            data = {
-                'command': 'reload',
-                'path': path or url,
-                'liveCSS': True,
-                'liveImg': True,
-            }
-            try:
-                ws.send_str(json.dumps(data))
-            except RuntimeError as e:
-                # "RuntimeError: websocket connection is closing" occurs if content type changes due to code change
-                aux_logger.error(str(e))
+        aux_logger.info('prompting reload of %s on %d client%s', ', '.join(paths or ['page']), cli_count, s)
+        self[METRICS].record(BROADCAST)
+        messages = {}
+        for client in list(self[WS].values()):
+            for reload_path in paths or [client.url]:
+                message = messages.get(reload_path)
+                if message is None:
+                    message = messages[reload_path] = json.dumps({
+                        'command': 'reload',
+                        'path': reload_path,
+                        'liveCSS': True,
+                        'liveImg': True,
+                    })
+                client.send(message)
 
     async def close_websockets(self):
-        aux_logger.debug('closing %d websockets...', len(self[WS]))
-        for ws, _ in self[WS]:
-            await ws.close()
+        clients = list(self[WS].values())
+        aux_logger.debug('closing %d websockets...', len(clients))
+        for client in clients:
+            client.drop()
+        await asyncio.gather(*(c.ws.close() for c in clients), loop=self.loop, return_exceptions=True)
 
 
 def create_auxiliary_app(*, loop=None, **config):
     loop = loop or asyncio.new_event_loop()
     app = AuxiliaryApplication(loop=loop)
-    app[WS] = []
+    app[WS] = {}
+    app[IMPORTED_FILES] = None
+    app[STATIC_CACHE] = StaticFileCache()
+    app[METRICS] = ReloadMetrics(loop)
+    app[WORKER_REQUESTS] = OrderedDict()
+    app[WATCH_ROOTS] = OrderedDict()
+    app[LIVE_RELOAD_JS] = _load_livereload_js()
     app['config'] = config
 
     app.router.add_route('GET', '/livereload.js', livereload_js)
     app.router.add_route('GET', '/livereload', websocket_handler)
+    app.router.add_route('GET', '/_runserver/metrics', metrics_handler)
 
     static_path = config['static_path']
     if static_path:
         static_root = static_path + '/'
-        app.router.register_route(CustomStaticRoute('static-router', config['static_url'], static_root))
+        route = CustomStaticRoute('static-router', config['static_url'], static_root, cache=app[STATIC_CACHE])
+        app.router.register_route(route)
     return app
 
 
+def _livereload_js_version():
+    with LIVE_RELOAD_JS_PATH.open('rb') as f:
+        return '{:08x}'.format(zlib.crc32(f.read()))
+
+
+def _load_livereload_js():
+    """
+    Read livereload.js and compress it with every encoding the aux app supports, done once when the aux app is
+    created so serving it never touches the disk.
+
+    :return: (StaticEntry, {encoding: body})
+    """
+    st = LIVE_RELOAD_JS_PATH.stat()
+    with LIVE_RELOAD_JS_PATH.open('rb') as f:
+        body = f.read()
+    etag = '"{:08x}"'.format(zlib.crc32(body))
+    entry = StaticEntry(str(LIVE_RELOAD_JS_PATH), body, etag, st.st_mtime, len(body), 'application/javascript', None,
+                        (st.st_mtime_ns, st.st_size))
+    variants = {encoding: encode(body) for encoding, encode in ENCODERS.items()}
+    return entry, variants
+
+
 async def livereload_js(request):
-    if request.if_modified_since:
+    entry, variants = request.app[LIVE_RELOAD_JS]
+    encoding = next((e for e in _accepted_encodings(request) if e in variants), None)
+    etag = entry.etag if encoding is None else '{}-{}"'.format(entry.etag[:-1], encoding)
+    if _not_modified(request, [etag], entry.mtime):
         aux_logger.debug('> %s %s %s 0', request.method, request.path, 304)
         raise HTTPNotModified()
 
-    script_key = 'livereload_script'
-    lr_script = request.app.get(script_key)
-    if lr_script is None:
-        lr_path = Path(__file__).absolute().parent.joinpath('livereload.js')
-        with lr_path.open('rb') as f:
-            lr_script = f.read()
-            request.app[script_key] = lr_script
-
-    aux_logger.debug('> %s %s %s %s', request.method, request.path, 200, fmt_size(len(lr_script)))
-    return web.Response(body=lr_script, content_type='application/javascript',
-                        headers={LAST_MODIFIED: 'Fri, 01 Jan 2016 00:00:00 GMT'})
+    body = entry.body if encoding is None else variants[encoding]
+    aux_logger.debug('> %s %s %s %s', request.method, request.path, 200, fmt_size(len(body)))
+    response = web.Response(body=body, content_type=entry.content_type)
+    response.headers[ETAG] = etag
+    # the snippet's url changes with the script's contents
+    response.headers[CACHE_CONTROL] = 'public, max-age=31536000, immutable'
+    response.headers[VARY] = ACCEPT_ENCODING
+    response.last_modified = entry.mtime
+    if encoding:
+        response.headers[CONTENT_ENCODING] = encoding
+    return response
 
 
 async def websocket_handler(request):
     ws = web.WebSocketResponse()
-    url = None
     await ws.prepare(request)
     ws_type_lookup = {k.value: v for v, k in MsgType.__members__.items()}
 
@@ -165,8 +707,13 @@ async def websocket_handler(request):
                         ws.send_str(json.dumps(handshake))
                 elif command == 'info':
                     aux_logger.debug('browser connected: %s', data)
+                    request.app[METRICS].record(RECONNECT)
                     url = data['url'].split('/', 3)[-1]
-                    request.app[WS].append((ws, url))
+                    clients = request.app[WS]
+                    if ws in clients:
+                        clients[ws].url = url
+                    else:
+                        clients[ws] = LiveReloadClient(ws, url, clients, request.app.loop)
                 else:
                     aux_logger.error('Unknown ws message %s', msg.data)
         elif msg.tp == MsgType.error:
@@ -175,34 +722,236 @@ async def websocket_handler(request):
             aux_logger.error('unknown websocket message type %s, data: %s', ws_type_lookup[msg.tp], msg.data)
 
     aux_logger.debug('browser disconnected')
-    if url:
-        request.app[WS].remove((ws, url))
+    client = request.app[WS].get(ws)
+    if client:
+        client.drop()
     return ws
 
 
+# stamp is the file's (mtime_ns, size) when it was loaded
+StaticEntry = namedtuple('StaticEntry', ['path', 'body', 'etag', 'mtime', 'size', 'content_type', 'encoding',
+                                         'stamp'])
+
+# encodings the static server can negotiate in order of preference, and the suffix of precompressed siblings
+ENCODING_SUFFIXES = OrderedDict([('br', '.br'), ('gzip', '.gz')])
+ENCODERS = {'gzip': lambda data: gzip.compress(data, compresslevel=6)}
+if brotli is not None:
+    # quality 11 takes seconds on a large bundle, 5 compresses about as well as gzip -9 and faster than gzip -6
+    ENCODERS['br'] = lambda data: brotli.compress(data, quality=5)
+COMPRESSIBLE_TYPES = {'application/javascript', 'application/json', 'application/xml', 'image/svg+xml'}
+# smaller files aren't worth compressing
+MIN_COMPRESS_SIZE = 1024
+# cached in place of a compressed variant which can't be created, eg. brotli for an image without a .br sibling
+NOT_ENCODED = object()
+# seconds, cache hits are checked against the file in case the watcher missed a change at most this often
+REVALIDATE_INTERVAL = 1
+# bytes written at a time when large files can't be sent with sendfile
+SEND_CHUNK_SIZE = 256 * 1024
+
+
+def _guess_type(path):
+    content_type, encoding = mimetypes.guess_type(str(path))
+    return content_type or 'application/octet-stream', encoding
+
+
+def _not_modified(request, etags, mtime):
+    """
+    Whether the client's copy is still valid, If-None-Match takes precedence over If-Modified-Since.
+
+    :param etags: ETags of the representations the client could have
+    """
+    if_none_match = request.headers.get(IF_NONE_MATCH)
+    if if_none_match is not None:
+        tags = {t.strip() for t in if_none_match.split(',')}
+        return '*' in tags or any(etag in tags or 'W/' + etag in tags for etag in etags)
+    modified_since = request.if_modified_since
+    return modified_since is not None and mtime <= modified_since.timestamp()
+
+
+def _variant_etag(entry, encoding):
+    # each variant needs its own ETag otherwise caches might serve one in response to a request for another
+    return entry.etag if encoding is None else '{}-{}"'.format(entry.etag[:-1], encoding)
+
+
+def _accepted_encodings(request):
+    """
+    :return: encodings from ENCODING_SUFFIXES accepted by the client in our order of preference
+    """
+    accepted = set()
+    for item in request.headers.get(ACCEPT_ENCODING, '').split(','):
+        coding, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return [e for e in ENCODING_SUFFIXES if e in accepted]
+
+
+def _encode(entry, encoding):
+    """
+    Get the body of a file with the given encoding, either from a precompressed sibling eg. "app.js.gz" which is at
+    least as new as the file or by compressing it. Run in a thread pool.
+
+    :return: encoded body or NOT_ENCODED
+    """
+    sibling = entry.path + ENCODING_SUFFIXES[encoding]
+    try:
+        if os.stat(sibling).st_mtime >= entry.mtime:
+            with open(sibling, 'rb') as f:
+                return f.read()
+    except OSError:
+        pass
+
+    compressible = entry.content_type.startswith('text/') or entry.content_type in COMPRESSIBLE_TYPES
+    if not compressible or encoding not in ENCODERS:
+        return NOT_ENCODED
+    body = entry.body
+    if body is None:
+        with open(entry.path, 'rb') as f:
+            body = f.read()
+    return ENCODERS[encoding](body)
+
+
+class StaticFileCache:
+    """
+    LRU cache for the static server bounded by total size. It holds an entry for each requested filename with the
+    file's metadata, ETag and, for small files, contents; plus compressed variants keyed by
+    (path, mtime, encoding).
+
+    Items are invalidated by the static file watcher, but it doesn't see every file (eg. those without an
+    extension or matching PathMatcher's ignore patterns) nor changes lost when inotify's queue overflows, so
+    CustomStaticRoute also checks hits are current with a stat in a thread pool, at most once every
+    `revalidate_interval` seconds for each file.
+    """
+    def __init__(self, max_bytes=64 * 1024 ** 2, max_file_size=256 * 1024, revalidate_interval=REVALIDATE_INTERVAL):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.revalidate_interval = revalidate_interval
+        self.size = 0
+        # key: (value, size, file path)
+        self._items = OrderedDict()
+        # file path: set of keys derived from it, eg. "foo/", "foo/index.html" and compressed variants
+        self._keys = {}
+        # file path: time.monotonic() it was last loaded or checked
+        self._checked = {}
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        self._items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, path, value, size=0):
+        self._remove(key)
+        if size > self.max_bytes:
+            return
+        self._items[key] = value, size, path
+        self._keys.setdefault(path, set()).add(key)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._items)))
+
+    def load(self, filepath, st):
+        """
+        Create the entry for a file, large files are served with sendfile so their contents aren't kept. Reads the
+        file so is run in a thread pool, it doesn't touch the cache itself.
+        """
+        content_type, encoding = _guess_type(filepath)
+        if st.st_size > self.max_file_size:
+            body, size = None, st.st_size
+            etag = '"{:x}-{:x}"'.format(st.st_mtime_ns, st.st_size)
+        else:
+            with filepath.open('rb') as f:
+                body = f.read()
+            size = len(body)
+            etag = '"{:08x}"'.format(zlib.crc32(body))
+        return StaticEntry(str(filepath), body, etag, st.st_mtime, size, content_type, encoding,
+                           (st.st_mtime_ns, st.st_size))
+
+    def add(self, filename, entry):
+        self.put(filename, entry.path, entry, 0 if entry.body is None else entry.size)
+        if entry.path in self._keys:
+            self._checked[entry.path] = time.monotonic()
+
+    def revalidate_due(self, entry):
+        """
+        Whether a hit on entry should be checked with is_current, if so it's not due again for revalidate_interval
+        so concurrent hits don't each check.
+        """
+        now = time.monotonic()
+        if now - self._checked.get(entry.path, 0) < self.revalidate_interval:
+            return False
+        self._checked[entry.path] = now
+        return True
+
+    @staticmethod
+    def is_current(entry):
+        """
+        Whether the file an entry was loaded from still has the same mtime and size, run in a thread pool.
+        """
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            return False
+        return (st.st_mtime_ns, st.st_size) == entry.stamp
+
+    def invalidate(self, paths):
+        """
+        Remove items for files which have changed, called by the static file watcher. A change to a precompressed
+        sibling also invalidates the variants of the file it was created from.
+        """
+        for path in paths:
+            root, ext = os.path.splitext(path)
+            for p in (path, root) if ext in ENCODING_SUFFIXES.values() else (path,):
+                self._checked.pop(p, None)
+                for key in self._keys.pop(p, ()):
+                    self._remove(key)
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            _, size, path = item
+            self.size -= size
+            keys = self._keys.get(path)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._keys[path]
+                    self._checked.pop(path, None)
+
+
 class CustomStaticRoute(StaticRoute):
-    def __init__(self, *args, **kwargs):
+    """
+    Static route which serves small files from an in memory cache and larger ones with sendfile, with ETags and
+    conditional requests answered from the cache where possible.
+
+    Responses are compressed with brotli or gzip if the client accepts it, using precompressed siblings where they
+    exist or compressing in a thread pool, either way compressed bodies are cached.
+    """
+    def __init__(self, *args, cache=None, **kwargs):
         self._asset_path = None  # TODO
+        self._cache = cache or StaticFileCache()
+        # compressions in progress so concurrent requests for a file don't each compress it
+        self._encoding = {}
         super().__init__(*args, **kwargs)
 
     async def handle(self, request):
-        filename = request.match_info['filename']
-        try:
-            filepath = self._directory.joinpath(filename).resolve()
-        except (ValueError, FileNotFoundError, OSError):
-            pass
-        else:
-            if filepath.is_dir():
-                request.match_info['filename'] = str(filepath.joinpath('index.html').relative_to(self._directory))
         status, length = 'unknown', ''
         try:
-            response = await super().handle(request)
+            response = await self._serve(request)
         except HTTPNotModified:
             status, length = 304, 0
             raise
         except HTTPNotFound:
-            _404_msg = '404: Not Found\n\n' + _get_asset_content(self._asset_path)
-            response = web.Response(body=_404_msg.encode(), status=404)
+            asset_content = ''
+            if self._asset_path:
+                asset_content = await request.app.loop.run_in_executor(None, _get_asset_content, self._asset_path)
+            response = web.Response(body='404: Not Found\n\n{}'.format(asset_content).encode(), status=404)
             status, length = response.status, response.content_length
         else:
             status, length = response.status, response.content_length
@@ -211,10 +960,119 @@ class CustomStaticRoute(StaticRoute):
             l('> %s %s %s %s', request.method, request.path, status, fmt_size(length))
         return response
 
+    async def _serve(self, request):
+        filename = request.match_info['filename']
+        entry = self._cache.get(filename)
+        if entry is not None and self._cache.revalidate_due(entry):
+            if not await request.app.loop.run_in_executor(None, self._cache.is_current, entry):
+                # changed without the watcher seeing it
+                self._cache.invalidate([entry.path])
+                entry = None
+        if entry is None:
+            # resolving the path and reading the file happen off the loop so a slow disk can't hold up broadcasts
+            entry = await request.app.loop.run_in_executor(None, self._load, filename)
+            self._cache.add(filename, entry)
+
+        encodings = []
+        if entry.encoding is None and entry.size >= MIN_COMPRESS_SIZE:
+            encodings = _accepted_encodings(request)
+        # checked before compressing anything, variants' ETags are derived from the file's so any of them will do
+        if _not_modified(request, [_variant_etag(entry, e) for e in encodings] + [entry.etag], entry.mtime):
+            raise HTTPNotModified()
+
+        encoding, body = None, entry.body
+        for encoding in encodings:
+            body = await self._get_encoded(request.app.loop, entry, encoding)
+            if body is not NOT_ENCODED:
+                break
+        else:
+            encoding, body = None, entry.body
+
+        etag = _variant_etag(entry, encoding)
+        if body is None:
+            return await self._sendfile_response(request, entry, etag)
+        response = web.Response(body=body, content_type=entry.content_type)
+        self._set_headers(response, entry, etag, encoding)
+        return response
+
+    async def _get_encoded(self, loop, entry, encoding):
+        key = entry.path, entry.mtime, encoding
+        body = self._cache.get(key)
+        if body is None:
+            future = self._encoding.get(key)
+            if future is None:
+                future = self._encoding[key] = loop.run_in_executor(None, _encode, entry, encoding)
+            try:
+                body = await asyncio.shield(future)
+            except OSError as e:
+                # deleted since it was cached
+                self._cache.invalidate([entry.path])
+                raise HTTPNotFound() from e
+            finally:
+                self._encoding.pop(key, None)
+            # mtime is part of the key so if the file changed while it was compressed this item is never used
+            self._cache.put(key, entry.path, body, 0 if body is NOT_ENCODED else len(body))
+        return body
+
+    def _load(self, filename):
+        return self._cache.load(*self._resolve(filename))
+
+    def _resolve(self, filename):
+        try:
+            filepath = self._directory.joinpath(filename).resolve()
+            if filepath.is_dir():
+                filepath = filepath.joinpath('index.html')
+            filepath.relative_to(self._directory)
+            st = filepath.stat()
+        except (ValueError, OSError) as e:
+            raise HTTPNotFound() from e
+        if not S_ISREG(st.st_mode):
+            raise HTTPNotFound()
+        return filepath, st
+
+    @staticmethod
+    def _set_headers(response, entry, etag, encoding):
+        response.headers[ETAG] = etag
+        # always revalidate, that's cheap since it's answered from the cache
+        response.headers[CACHE_CONTROL] = 'no-cache'
+        response.last_modified = entry.mtime
+        if entry.encoding:
+            response.headers[CONTENT_ENCODING] = entry.encoding
+        else:
+            response.headers[VARY] = ACCEPT_ENCODING
+            if encoding:
+                response.headers[CONTENT_ENCODING] = encoding
+
+    async def _sendfile_response(self, request, entry, etag):
+        response = web.StreamResponse()
+        response.content_type = entry.content_type
+        self._set_headers(response, entry, etag, None)
+        response.content_length = entry.size
+        # StaticRoute's sendfile implementation is private to aiohttp 0.21
+        sendfile = getattr(self, '_sendfile', None)
+        response.set_tcp_cork(True)
+        try:
+            await response.prepare(request)
+            with open(entry.path, 'rb') as f:
+                if sendfile:
+                    await sendfile(request, response, f, entry.size)
+                else:
+                    await self._send_chunks(request.app.loop, response, f)
+        finally:
+            response.set_tcp_nodelay(True)
+        return response
+
+    @staticmethod
+    async def _send_chunks(loop, response, f):
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, SEND_CHUNK_SIZE)
+            if not chunk:
+                break
+            response.write(chunk)
+            await response.drain()
+
 
 def _get_asset_content(asset_path):
-    if not asset_path:
-        return ''
     with asset_path.open() as f:
         return 'Asset file contents:\n\n{}'.format(f.read())
 
@@ -1,24 +1,137 @@
+import asyncio
+import fnmatch
 import os
+import re
 import signal
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from multiprocessing import Pipe, Process, get_start_method, set_start_method
 
-from multiprocessing import Process, set_start_method
-from datetime import datetime
-
-from watchdog.events import PatternMatchingEventHandler, unicode_paths, match_any_paths
+from watchdog.events import FileSystemEventHandler, unicode_paths
 
+from .imports import precompile
 from .logs import dft_logger, MainAccessLogHandler
-from .serve import serve_main_app
+from .metrics import DEBOUNCE, METRICS, STOPPED, WATCH_ROOTS, WORKER_REQUESTS
+from .polling import RACY_NS
+from .serve import (IGNORE, IMPORTED_FILES, RELOAD, REUSE_PORT, SERVER_ERROR, STATIC_CACHE, create_error_app,
+                    serve_main_app)
+from .zygote import Zygote
 
 # specific to jetbrains I think, very annoying if not ignored
 JB_BACKUP_FILE = '*___jb_???___'
 
-# force a full reload to interpret an updated version of code:
-set_start_method('spawn')
+# force a full reload to interpret an updated version of code, already set when this is imported again in a
+# spawned process eg. by a script which imports run_apps
+if get_start_method(allow_none=True) != 'spawn':
+    set_start_method('spawn', force=True)
+
+# how long to wait for a new server to start before stopping the old one regardless
+STARTUP_TIMEOUT = 30
+# how long to wait for servers to update in place before restarting them instead
+HOT_RELOAD_TIMEOUT = 5
+# seconds before starting new servers after they fail, doubled with each consecutive failure up to the maximum
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 30
+# servers which stay up this long reset the retry delay when they fail
+RETRY_RESET = 30
+# how long a failed server has to finish exiting, eg. writing its traceback, before it's interrupted
+EXIT_TIMEOUT = 5
+
+
+class Debouncer:
+    """
+    Trailing edge debounce: paths are collected until no change has been seen for `delay` seconds, or until
+    `max_wait` seconds after the first change of the batch if changes keep arriving, then `callback` is called
+    once with all paths from the batch and the time.monotonic() at which the first of them was seen.
+
+    The callback is run in the debouncer's own thread, changes arriving while it runs form the next batch.
+    """
+    def __init__(self, callback, delay, max_wait, name):
+        self._callback = callback
+        self._delay = delay
+        self._max_wait = max(delay, max_wait)
+        self._name = name
+        self._cond = threading.Condition()
+        self._paths = []
+        self._path_set = set()
+        self._first = self._last = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def add(self, paths):
+        with self._cond:
+            now = time.monotonic()
+            if self._first is None:
+                self._first = now
+                dft_logger.debug('%s: change detected, waiting for %0.3fs of quiet, at most %0.3fs',
+                                 self._name, self._delay, self._max_wait)
+            self._last = now
+            for p in paths:
+                if p not in self._path_set:
+                    self._path_set.add(p)
+                    self._paths.append(p)
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._first is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                fire_at = min(self._last + self._delay, self._first + self._max_wait)
+                if now < fire_at:
+                    self._cond.wait(fire_at - now)
+                    continue
+                paths, first = self._paths, self._first
+                self._paths, self._path_set = [], set()
+                self._first = self._last = None
+
+            dft_logger.debug('%s: %d path%s changed in %0.3fs: %s', self._name, len(paths),
+                             '' if len(paths) == 1 else 's', now - first, ', '.join(paths))
+            try:
+                self._callback(paths, first)
+            except Exception:
+                dft_logger.exception('%s: error processing changes', self._name)
+
+
+CODE, TEMPLATE, STATIC = 'code', 'template', 'static'
+
 
+def compile_globs(patterns):
+    """
+    Combine glob patterns into one regex which matches a path if any of the patterns do.
+    """
+    parts = []
+    for pattern in patterns:
+        regex = fnmatch.translate(pattern)
+        # python 3.5 appends global flags, later versions use a scoped group which can be combined as is
+        if regex.endswith('(?ms)'):
+            regex = regex[:-5]
+        parts.append('(?:{})'.format(regex))
+    return re.compile('|'.join(parts), re.S)
 
-class _BaseEventHandler(PatternMatchingEventHandler):
-    patterns = ['*.*']
-    ignore_directories = True
+
+class PathMatcher:
+    """
+    Classifies each path once as code, template or static (or None if it should be ignored) using a single
+    precompiled regex for ignored paths and a suffix lookup table.
+
+    Files under --watch roots with the reload policy are all treated as templates, ie. they reload the browser,
+    and those under ignore roots are ignored; the innermost root containing a path applies.
+    """
     ignore_patterns = [
         '*/.git/*',
         '*/.idea/*',
@@ -26,22 +139,253 @@ class _BaseEventHandler(PatternMatchingEventHandler):
         '*/include/python*',
         '*/lib/python*',
         '*/aiohttp_runserver/*',
+        '*/node_modules/*',
+        '*/__pycache__/*',
         JB_BACKUP_FILE,
     ]
+    suffixes = {
+        '.py': CODE,
+        '.html': TEMPLATE,
+        '.jinja': TEMPLATE,
+        '.jinja2': TEMPLATE,
+    }
+
+    def __init__(self, static_path=None, roots=()):
+        """
+        :param static_path: directory of static files
+        :param roots: --watch roots as (path, policy)
+        """
+        self.ignore_regex = compile_globs(self.ignore_patterns)
+        self._jb_backup_regex = compile_globs([JB_BACKUP_FILE])
+        self._static_prefix = static_path and os.path.join(static_path, '')
+        # innermost first
+        self._roots = sorted(((os.path.join(path, ''), policy) for path, policy in roots),
+                             key=lambda root: len(root[0]), reverse=True)
+
+    def is_jb_backup(self, path):
+        return self._jb_backup_regex.match(path) is not None
+
+    def classify(self, path):
+        if self.ignore_regex.match(path):
+            return None
+        name = path.rpartition(os.sep)[2]
+        if self._static_prefix and path.startswith(self._static_prefix):
+            # any file with an extension
+            return STATIC if '.' in name else None
+        for prefix, policy in self._roots:
+            if path.startswith(prefix):
+                if policy == RELOAD:
+                    return TEMPLATE if '.' in name else None
+                if policy == IGNORE:
+                    return None
+                break
+        dot = name.rfind('.')
+        return self.suffixes.get(name[dot:]) if dot > 0 else None
+
+
+def _gitignore_globs(line):
+    """
+    :return: glob to match against names or None, and globs to match against paths relative to the .gitignore
+    """
+    line = line.rstrip('/')
+    # as git does, patterns with a slash other than at the end are relative to the .gitignore
+    anchored = '/' in line
+    if line.endswith('/**'):
+        # everything inside the directory, for watching that's the same as the directory itself
+        line = line[:-3]
+    paths = []
+    if line.startswith('**/'):
+        line = line[3:]
+        if '/' not in line:
+            return line, []
+        paths.append('*/' + line)
+    if not anchored:
+        return line, []
+    paths.append(line.lstrip('/'))
+    # "*" matches across directories so "/**/" only needs adding as zero directories
+    return None, paths + [p.replace('/**/', '/') for p in paths if '/**/' in p]
+
+
+def parse_gitignore(path):
+    """
+    Parse a .gitignore file into two regexes: one for patterns matched against names at any depth, one for
+    patterns anchored to the directory containing the .gitignore which are matched against relative paths.
+
+    "**/" at the start, "/**" at the end and "/**/" in the middle of patterns are supported. Negated patterns
+    can re-include anything under an ignored directory, so a file containing any isn't used at all.
+    """
+    name_patterns, anchored_patterns = [], []
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except (OSError, UnicodeDecodeError):
+        return None, None
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('!'):
+            dft_logger.warning('%s has negated patterns, not using it to skip directories', path)
+            return None, None
+        name, anchored = _gitignore_globs(line)
+        if name:
+            name_patterns.append(name)
+        anchored_patterns.extend(anchored)
+    return name_patterns and compile_globs(name_patterns), anchored_patterns and compile_globs(anchored_patterns)
+
+
+class IgnoredDirectories:
+    """
+    Decides which directories are never watched: those matching PathMatcher's ignore patterns or the .gitignore
+    file at the top of a watched root.
 
-    def __init__(self, aux_app, config, *args, **kwargs):
+    .gitignore is only applied to directories, never to individual files (eg. local settings modules are often
+    ignored but still imported), and never to `keep` or its parents so built static files are still watched.
+    Each root's .gitignore only applies within that root. Directories in `ignore` are always pruned.
+    """
+    def __init__(self, matcher, roots, keep=None, ignore=()):
+        self._ignore_regex = matcher.ignore_regex
+        self._keep = keep and os.path.join(keep, '')
+        self._ignore = tuple(os.path.join(p, '') for p in ignore)
+        self._gitignores = []
+        for root in roots:
+            name_regex, anchored_regex = parse_gitignore(os.path.join(root, '.gitignore'))
+            if name_regex or anchored_regex:
+                self._gitignores.append((os.path.join(root, ''), name_regex, anchored_regex))
+
+    def __call__(self, path):
+        dir_path = os.path.join(path, '')
+        if self._ignore_regex.match(dir_path) or dir_path.startswith(self._ignore):
+            return True
+        if self._keep and (dir_path.startswith(self._keep) or self._keep.startswith(dir_path)):
+            return False
+        for root, name_regex, anchored_regex in self._gitignores:
+            if not dir_path.startswith(root):
+                continue
+            # parents need checking too in case they weren't pruned because they contain `keep`
+            parts = path[len(root):].split(os.sep)
+            for i, name in enumerate(parts, start=1):
+                if name_regex and name_regex.match(name):
+                    return True
+                if anchored_regex and anchored_regex.match(os.sep.join(parts[:i])):
+                    return True
+        return False
+
+
+class ContentHashes:
+    """
+    Cache of file content hashes used to ignore writes which don't change a file, eg. "save all", touch or a
+    formatter which leaves the file as it was.
+
+    Files are only read and hashed when their mtime or size has changed, crc32 is used since it's fast and
+    collisions between two versions of the same file are vanishingly unlikely. As with PollingIndex, files whose
+    mtime was within RACY_NS of when they were hashed are always hashed again since they could have been
+    written again since without their mtime changing.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self):
+        # path: (mtime_ns, size, crc32, whether the mtime was racy when hashed)
+        self._cache = {}
+
+    def changed(self, path):
+        """
+        Whether the file's content has changed since it was last checked, files not seen before and deleted files
+        always count as changed.
+        """
+        try:
+            st = os.stat(path)
+            prev = self._cache.get(path)
+            if prev and not prev[3] and prev[:2] == (st.st_mtime_ns, st.st_size):
+                return False
+            crc = self._hash(path)
+        except OSError:
+            self._cache.pop(path, None)
+            return True
+        racy = int(time.time() * 10 ** 9) - st.st_mtime_ns < RACY_NS
+        self._cache[path] = st.st_mtime_ns, st.st_size, crc, racy
+        return prev is None or prev[2] != crc
+
+    def _hash(self, path):
+        crc = 0
+        with open(path, 'rb') as f:
+            chunk = f.read(self.chunk_size)
+            while chunk:
+                crc = zlib.crc32(chunk, crc)
+                chunk = f.read(self.chunk_size)
+        return crc
+
+
+class RootStats:
+    """
+    Number of watches and events seen for a watched root, shown by /_runserver/metrics. Events are counted before
+    being classified so a root generating lots of irrelevant events stands out.
+    """
+    # seconds over which the event rate is averaged
+    rate_window = 60
+
+    def __init__(self, policy):
+        self.policy = policy
+        # inotify watches or polled directories, None if not known
+        self.watches = None
+        self.events = 0
+        # [second, events] for recent seconds
+        self._recent = deque()
+
+    def event(self):
+        self.events += 1
+        second = int(time.monotonic())
+        if self._recent and self._recent[-1][0] == second:
+            self._recent[-1][1] += 1
+        else:
+            self._recent.append([second, 1])
+            while self._recent[0][0] <= second - self.rate_window:
+                self._recent.popleft()
+
+    def as_dict(self):
+        cutoff = time.monotonic() - self.rate_window
+        recent = sum(count for second, count in list(self._recent) if second > cutoff)
+        return OrderedDict([
+            ('policy', self.policy),
+            ('watches', self.watches),
+            ('events', self.events),
+            ('events_per_second', recent / self.rate_window),
+        ])
+
+
+class WatchDispatcher(FileSystemEventHandler):
+    """
+    Single watchdog event handler for all watched roots: classifies each event once and fans the paths out to the
+    consumers registered for that kind of change.
+    """
+    def __init__(self, aux_app, matcher, consumers, roots=()):
+        """
+        :param aux_app: auxiliary app, used to find which files the server has imported
+        :param matcher: PathMatcher instance
+        :param consumers: dict of change kind to list of consumers with an "add(paths)" method
+        :param roots: (path, policy) of each root to keep RootStats for in the app's WATCH_ROOTS, roots may be
+          nested in which case events count towards the innermost
+        """
         self._app = aux_app
-        self._config = config
+        self._matcher = matcher
+        self._consumers = consumers
+        self._hashes = ContentHashes()
+        self._root_stats = []
+        for path, policy in roots:
+            stats = aux_app[WATCH_ROOTS][path] = RootStats(policy)
+            self._root_stats.append((os.path.join(path, ''), stats))
+        self._root_stats.sort(key=lambda root: len(root[0]), reverse=True)
 
-        self._change_dt = datetime.now()
-        self._since_change = None
-        self._change_count = 0
-        super().__init__(*args, **kwargs)
+    def _count(self, path):
+        for prefix, stats in self._root_stats:
+            if path.startswith(prefix):
+                stats.event()
+                return
 
     def dispatch(self, event):
-
         if event.is_directory:
             return
+        self._count(unicode_paths.decode(event.src_path or ''))
 
         paths = []
         if getattr(event, 'dest_path', None) is not None:
@@ -49,70 +393,497 @@ class _BaseEventHandler(PatternMatchingEventHandler):
         if event.src_path:
             paths.append(unicode_paths.decode(event.src_path))
 
-        if match_any_paths(paths, included_patterns=[JB_BACKUP_FILE]):
+        if any(self._matcher.is_jb_backup(p) for p in paths):
             # special case for these fields if either path matches skip
             return
 
-        if not match_any_paths(paths, included_patterns=self.patterns, excluded_patterns=self.ignore_patterns):
-            return
+        by_kind = {}
+        for path in paths:
+            kind = self._matcher.classify(path)
+            if kind:
+                by_kind.setdefault(kind, []).append(path)
 
-        self._since_change = (datetime.now() - self._change_dt).total_seconds()
-        if self._since_change <= 1:
-            dft_logger.debug('%s | %0.3f seconds since last build, skipping', event, self._since_change)
-            return
+        code_paths = by_kind.get(CODE)
+        if code_paths and not self._imported(code_paths):
+            dft_logger.debug('%s | not imported by the server, skipping', event)
+            del by_kind[CODE]
+
+        for kind, kind_paths in by_kind.items():
+            kind_paths = [p for p in kind_paths if self._hashes.changed(p)]
+            if not kind_paths:
+                dft_logger.debug('%s | content unchanged, skipping', event)
+                continue
+            self._app[METRICS].event()
+            for consumer in self._consumers.get(kind, ()):
+                consumer.add(kind_paths)
+
+    def _imported(self, paths):
+        """
+        Whether any of the python files are imported by the running server, always true until the server has
+        reported what it imported. One set lookup per path.
+        """
+        imported = self._app[IMPORTED_FILES]
+        if imported is None:
+            return True
+        return any(os.path.abspath(p) in imported for p in paths)
 
-        self._change_dt = datetime.now()
+
+class _BaseEventHandler:
+    """
+    Consumer of classified changes, debounces them and calls on_event with each batch.
+    """
+    def __init__(self, aux_app, config):
+        self._app = aux_app
+        self._config = config
+
+        self._change_count = 0
+        # when the first change of the batch being processed was seen
+        self._batch_seen = None
+        self._debouncer = Debouncer(self._on_changes, config['debounce'], config['max_wait'], type(self).__name__)
+
+    def add(self, paths):
+        self._debouncer.add(paths)
+
+    def _on_changes(self, paths, first_seen):
         self._change_count += 1
-        self.on_event(event)
+        self._batch_seen = first_seen
+        self._app[METRICS].record(DEBOUNCE)
+        self.on_event(paths)
 
-    def on_event(self, event):
+    def on_event(self, paths):
+        """
+        Called with all the paths changed in a batch once the debounce period has passed.
+        """
         pass
 
+    def close(self):
+        self._debouncer.stop()
+
+
+class ErrorPage:
+    """
+    Serves create_error_app on main_port from the aux app's loop while the servers are down.
+
+    show and hide are called from the thread managing the servers and wait for the aux app's loop to do the work.
+    """
+    def __init__(self, aux_app, config, sock=None):
+        """
+        :param sock: listening socket shared by the servers, if any, to serve from instead of binding main_port
+        """
+        self._loop = aux_app.loop
+        self._config = config
+        self._sock = sock
+        self._app = create_error_app(self._loop, config)
+        self._handler = None
+        self._srv = None
+
+    def show(self, message, details):
+        self._app[SERVER_ERROR] = message, details
+        if self._srv is None:
+            self._run(self._start())
+
+    def hide(self):
+        if self._srv is not None:
+            self._run(self._stop())
+
+    def close(self):
+        # the aux app's loop isn't running by now
+        if self._srv is not None:
+            self._srv.close()
+
+    def _run(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        try:
+            future.result(STARTUP_TIMEOUT)
+        except Exception as e:
+            dft_logger.warning('error page on port %d: %s: %s', self._config['main_port'], e.__class__.__name__, e)
+
+    async def _start(self):
+        self._handler = self._app.make_handler(access_log=None)
+        if self._sock:
+            # closing the server closes its socket, the servers still need theirs
+            server = self._loop.create_server(self._handler, sock=self._sock.dup())
+        else:
+            server = self._loop.create_server(self._handler, '0.0.0.0', self._config['main_port'],
+                                              reuse_port=REUSE_PORT)
+        self._srv = await server
+
+    async def _stop(self):
+        srv, self._srv = self._srv, None
+        srv.close()
+        await srv.wait_closed()
+        await self._handler.finish_connections(1)
+
 
 class CodeFileEventHandler(_BaseEventHandler):
-    patterns = ['*.py']
+    """
+    Runs the main app in config['workers'] server processes which share main_port and restarts them together when
+    code changes.
 
+    If the servers fail to start or die, their error is served on main_port by ErrorPage and new servers are
+    started after a delay which doubles with each consecutive failure, or straight away when code changes.
+    Browsers are reloaded once new servers are ready.
+    """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._processes = []
+        # pipes to the current servers which haven't reported they're ready yet
+        self._starting = set()
+        self._conns = set()
+        self._ready = threading.Event()
+        self._server_ready = False
+        # traceback from a server which failed to start
+        self._server_error = None
+        self._zygote = Zygote(self._config) if self._config['preload'] else None
+        # without SO_REUSEPORT workers can only share main_port by inheriting a socket which stays open across
+        # restarts, the servers can't be forked from the zygote then as it doesn't pass sockets on
+        self._sock = None
+        if self._config['workers'] > 1 and not REUSE_PORT:
+            self._sock = socket.socket()
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind(('0.0.0.0', self._config['main_port']))
+            self._sock.listen(128)
+            if self._zygote:
+                dft_logger.warning('preloading is not supported with multiple workers without SO_REUSEPORT')
+                self._zygote = None
+        # with warmup changed modules are compiled to bytecode as soon as they're seen, while the batch is being
+        # debounced, so the new server doesn't have to
+        self._compiler = ThreadPoolExecutor(max_workers=2) if self._config['warmup'] else None
+        self._compiling = []
+        self._compiling_lock = threading.Lock()
+        # held while servers are being updated in place or restarted
+        self._hot_lock = threading.RLock()
+        self._hot_done = threading.Event()
+        self._hot_expected = 0
+        self._hot_replies = []
+        self._error_page = ErrorPage(self._app, self._config, self._sock)
+        # incremented each time servers are started, so retries can tell if they've been started since
+        self._generation = 0
+        # whether the current servers have failed
+        self._failed = False
+        self._failures = 0
+        self._ready_at = None
+        # set by changes and close() to end the wait before a retry, changes restart the servers themselves
+        self._retry_now = threading.Event()
+        self._closed = False
         self._start_process()
 
-    def on_event(self, event):
-        dft_logger.debug('%s | %0.3f seconds since last change, restarting server', event, self._since_change)
-        self.stop_process()
-        self._start_process()
+    def add(self, paths):
+        if self._compiler:
+            futures = [self._compiler.submit(precompile, p) for p in paths]
+            with self._compiling_lock:
+                self._compiling.extend(futures)
+        super().add(paths)
+
+    def on_event(self, paths):
+        self._retry_now.set()
+        with self._hot_lock:
+            if self._config['hot_reload'] and self.hot_reload('modules', paths):
+                self._app.src_reload(self._batch_seen)
+                return
+            ready = self._restart()
+        self._app[METRICS].record(STOPPED)
+        if ready:
+            # browsers are only told to reload once the new servers are the only ones answering
+            self._app.src_reload(self._batch_seen)
+
+    def _restart(self):
+        """
+        Replace the servers with new ones, called with _hot_lock held.
+
+        :return: whether the new servers are ready
+        """
+        if REUSE_PORT:
+            # the new servers share main_port with the old ones, or the error page, which keep serving until the
+            # new ones are ready
+            old_processes = self._processes
+            self._start_process()
+            ready = self._wait_ready()
+            self._stop(old_processes)
+        else:
+            self.stop_process()
+            self._error_page.hide()
+            self._start_process()
+            ready = self._wait_ready()
+        if ready:
+            self._error_page.hide()
+        return ready
+
+    def _retry(self, generation, index, error):
+        """
+        Run in its own thread once the current servers have failed: stops any still running, serves the error on
+        main_port and starts new servers after the retry delay unless a change has restarted them by then.
+
+        :param index: worker which failed
+        :param error: traceback if it failed to start, otherwise None
+        """
+        with self._hot_lock:
+            if self._closed or generation != self._generation:
+                return
+            # the failed reload's timings would otherwise be counted against the next one
+            self._app[METRICS].discard()
+            processes = self._processes
+            # its pipe has closed but it may still be writing its traceback, interrupting it would lose the end of
+            # that and replace its exit code with SIGINT's
+            processes[index].join(EXIT_TIMEOUT)
+            # the rest would otherwise keep serving alongside the error page
+            self.stop_process()
+            if error is None:
+                error = 'server process exited unexpectedly with code {}'.format(processes[index].exitcode)
+                dft_logger.error(error)
+            delay = self._retry_delay()
+            dft_logger.warning('starting server again in %0.0fs, or when code changes', delay)
+            self._error_page.show('Server failed, retrying in {:0.0f}s or when code changes'.format(delay), error)
+            self._retry_now.clear()
+
+        if self._retry_now.wait(delay):
+            # code changed, on_event restarts the servers
+            return
+        with self._hot_lock:
+            if self._closed or generation != self._generation:
+                return
+            ready = self._restart()
+        if ready:
+            self._app.src_reload()
+
+    def _retry_delay(self):
+        if self._ready_at is not None and time.monotonic() - self._ready_at > RETRY_RESET:
+            # not a crash loop
+            self._failures = 0
+        self._ready_at = None
+        self._failures += 1
+        return min(RETRY_DELAY * 2 ** (self._failures - 1), MAX_RETRY_DELAY)
+
+    def hot_reload(self, command, paths):
+        """
+        Ask the running servers to update themselves in place rather than being restarted.
+
+        :param command: "templates" to drop changed templates from their jinja cache or "modules" to reload changed
+          modules
+        :param paths: changed files
+        :return: whether all servers were updated, if not they need restarting
+        """
+        with self._hot_lock:
+            conns = list(self._conns)
+            if not self._server_ready or not conns:
+                return False
+            start = time.monotonic()
+            self._hot_done.clear()
+            self._hot_replies = []
+            self._hot_expected = len(conns)
+            try:
+                for conn in conns:
+                    conn.send((command, paths))
+            except OSError:
+                return False
+            if not self._hot_done.wait(HOT_RELOAD_TIMEOUT):
+                dft_logger.warning('servers took more than %ds to reload in place', HOT_RELOAD_TIMEOUT)
+                return False
+            replies = self._hot_replies
+        if len(replies) < len(conns):
+            # a server died
+            return False
+        reasons = [r for r in replies if r]
+        if reasons:
+            dft_logger.info('restarting server: %s', reasons[0])
+            return False
+        dft_logger.debug('servers updated %s in place in %0.3fs', command, time.monotonic() - start)
+        return True
+
+    def _wait_ready(self):
+        """
+        Wait for all new servers to report they're listening or for one to fail to start.
+        """
+        if self._ready.wait(STARTUP_TIMEOUT) and self._server_ready:
+            dft_logger.debug('new server ready')
+            return True
+        if self._server_error is None:
+            dft_logger.warning('new server failed to start')
+        self._app[METRICS].discard()
+        return False
+
+    def _wait_precompiled(self):
+        with self._compiling_lock:
+            futures, self._compiling = self._compiling, []
+        if futures:
+            start = time.monotonic()
+            done, _ = wait(futures, timeout=STARTUP_TIMEOUT)
+            dft_logger.debug('precompiled %d of %d changed modules in %0.3fs', sum(f.result() for f in done),
+                             len(futures), time.monotonic() - start)
 
     def _start_process(self):
+        workers = self._config['workers']
+        s = '' if workers == 1 else ' with {} workers'.format(workers)
         if self._change_count == 0:
             p = MainAccessLogHandler.prefix
-            dft_logger.info('Starting dev server at http://localhost:%s %s', self._config['main_port'], p)
+            dft_logger.info('Starting dev server at http://localhost:%s%s %s', self._config['main_port'], s, p)
         else:
-            dft_logger.info('Restarting dev server at http://localhost:%s', self._config['main_port'])
+            dft_logger.info('Restarting dev server at http://localhost:%s%s', self._config['main_port'], s)
+
+        self._wait_precompiled()
+        # modules the last server imported, the next one will most likely import the same
+        warm_files = self._config['warmup'] and self._app[IMPORTED_FILES]
+        self._app[IMPORTED_FILES] = None
+        # replaced rather than cleared as the aux app's loop may be reading it
+        worker_requests = self._app[WORKER_REQUESTS] = OrderedDict()
+        self._ready.clear()
+        self._server_ready = False
+        self._server_error = None
+        self._generation += 1
+        self._failed = False
+        self._starting = set()
+        self._conns = set()
+        self._processes = []
+        for index in range(workers):
+            conn, server_conn = Pipe()
+            process = self._fork(server_conn, warm_files)
+            if process is None:
+                kwargs = dict(self._config, sock=self._sock) if self._sock else self._config
+                process = Process(target=serve_main_app, args=(server_conn,), kwargs=kwargs)
+                process.start()
+            server_conn.close()
+            self._processes.append(process)
+            self._starting.add(conn)
+            self._conns.add(conn)
+            worker_requests[index] = {'pid': process.pid, 'requests': 0}
+            loop = self._app.loop
+            loop.call_soon_threadsafe(loop.add_reader, conn.fileno(), self._on_message, conn, index)
+
+    def _fork(self, server_conn, warm_files):
+        """
+        Fork a server from the zygote, if it can't be rebuilt after dying servers are started from scratch from
+        then on.
 
-        self._process = Process(target=serve_main_app, kwargs=self._config)
-        self._process.start()
+        :return: ForkedProcess or None if preloading isn't being used
+        """
+        if not self._zygote:
+            return None
+        try:
+            return self._zygote.fork(self._config, server_conn, warm_files and sorted(warm_files))
+        except (OSError, EOFError) as e:
+            dft_logger.warning('unable to start preloaded process, no longer preloading: %s: %s',
+                               e.__class__.__name__, e)
+            self._zygote.close()
+            self._zygote = None
+            return None
+
+    def _on_message(self, conn, index):
+        """
+        Called by the aux app's loop when a server process sends a message or closes its pipe.
+        """
+        try:
+            command, *args = conn.recv()
+        except (EOFError, OSError):
+            self._app.loop.remove_reader(conn.fileno())
+            conn.close()
+            if conn in self._starting:
+                # server died, don't keep anyone waiting for it to be ready
+                self._ready.set()
+            if conn in self._conns:
+                self._on_exit(conn, index)
+            self._hot_done.set()
+            return
+        if conn not in self._conns:
+            # message from a server which has since been replaced
+            return
+        if command == 'imports':
+            files, = args
+            dft_logger.debug('server has imported %d project files', len(files))
+            self._app[IMPORTED_FILES] = frozenset(files)
+        elif command == 'stats':
+            # requests handled, plus route timings and loop blocking if enabled
+            stats, = args
+            self._app[WORKER_REQUESTS][index].update(stats)
+        elif command == 'hot_reloaded':
+            self._hot_replies.append(args[0])
+            if len(self._hot_replies) >= self._hot_expected:
+                self._hot_done.set()
+        elif command == 'ready':
+            self._on_ready(conn, *args)
+        elif command == 'error':
+            self._server_error, = args
+            dft_logger.error('error starting server:\n%s', self._server_error)
+            self._ready.set()
+
+    def _on_exit(self, conn, index):
+        """
+        Called by the aux app's loop when one of the current servers exits without being stopped.
+        """
+        self._conns.discard(conn)
+        self._server_ready = False
+        if self._failed:
+            # already being dealt with
+            return
+        self._failed = True
+        # stopping processes blocks, so isn't done on the loop
+        threading.Thread(target=self._retry, args=(self._generation, index, self._server_error), name='retry',
+                         daemon=True).start()
+
+    def _on_ready(self, conn, timings):
+        for stage, at in timings.items():
+            self._app[METRICS].record(stage, at)
+        self._starting.discard(conn)
+        if not self._starting:
+            self._server_ready = True
+            self._ready_at = time.monotonic()
+            self._ready.set()
 
     def stop_process(self):
-        if self._process.is_alive():
-            dft_logger.debug('stopping server process...')
-            os.kill(self._process.pid, signal.SIGINT)
-            self._process.join(5)
-            dft_logger.debug('process stopped')
-        else:
-            dft_logger.warning('server process already dead, exit code: %d', self._process.exitcode)
+        # their pipes closing isn't a failure
+        self._conns = set()
+        self._stop(self._processes)
+
+    @staticmethod
+    def _stop(processes):
+        running = [p for p in processes if p.is_alive()]
+        for process in processes:
+            if process not in running:
+                dft_logger.debug('server process already dead, exit code: %d', process.exitcode)
+        if running:
+            dft_logger.debug('stopping %d server process%s...', len(running), '' if len(running) == 1 else 'es')
+            # signal them all first so they shut down concurrently
+            for process in running:
+                os.kill(process.pid, signal.SIGINT)
+            for process in running:
+                process.join(5)
+            dft_logger.debug('stopped')
+
+    def close(self):
+        super().close()
+        self._closed = True
+        self._retry_now.set()
+        self._error_page.close()
+        if self._compiler:
+            self._compiler.shutdown()
+        if self._zygote:
+            self._zygote.close()
+        if self._sock:
+            self._sock.close()
 
 
 class AllCodeEventEventHandler(_BaseEventHandler):
-    patterns = [
-        '*.py',
-        '*.html',
-        '*.jinja',
-        '*.jinja2',
-    ]
+    """
+    Reloads browsers when templates change, once the servers have dropped the old versions from their jinja cache.
+    """
+    def __init__(self, aux_app, config, servers):
+        """
+        :param servers: CodeFileEventHandler running the servers
+        """
+        super().__init__(aux_app, config)
+        self._servers = servers
 
-    def on_event(self, event):
-        self._app.src_reload()
+    def on_event(self, paths):
+        self._servers.hot_reload('templates', paths)
+        self._app.src_reload(self._batch_seen)
 
 
 class StaticFileEventEventHandler(_BaseEventHandler):
-    def on_event(self, event):
-        self._app.static_reload(event.src_path)
+    def add(self, paths):
+        # cached files are dropped straight away rather than after debouncing so they're never served stale
+        loop = self._app.loop
+        loop.call_soon_threadsafe(self._app[STATIC_CACHE].invalidate, paths)
+        super().add(paths)
+
+    def on_event(self, paths):
+        for path in paths:
+            self._app.static_reload(path, self._batch_seen)
@@ -0,0 +1,364 @@
+import os
+import signal
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+from importlib import invalidate_caches
+from importlib.machinery import all_suffixes
+from multiprocessing import Pipe, Process, reduction
+from multiprocessing.connection import Connection, wait
+
+from watchdog.events import EVENT_TYPE_MODIFIED, FileSystemEventHandler
+
+from .imports import module_file, warm_finders
+from .logs import dft_logger, flush_logs, setup_logging
+from .observers import start_observer
+from .serve import import_string, project_roots, serve_main_app
+
+STDLIB_PATHS = {os.path.realpath(sysconfig.get_path(name)) + os.sep for name in ('stdlib', 'platstdlib')}
+SITE_PATHS = {os.path.realpath(sysconfig.get_path(name)) + os.sep for name in ('purelib', 'platlib')}
+# files which add importable modules to a directory on sys.path, a .pth file can extend sys.path itself
+MODULE_SUFFIXES = tuple(all_suffixes()) + ('.pth',)
+
+
+def _resolved_roots(config):
+    return tuple(os.path.realpath(r) + os.sep for r in project_roots(config))
+
+
+def _is_project_file(path, roots):
+    """
+    Whether a module file belongs to the project being served rather than a dependency, virtualenvs inside
+    the project's roots count as dependencies.
+    """
+    return path.startswith(roots) and not any(path.startswith(p) for p in SITE_PATHS)
+
+
+def _exit_code(status):
+    # same convention as multiprocessing.Process.exitcode
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _system_exit_status(code):
+    """
+    Exit status for SystemExit's code, worked out the way the interpreter does: None is success, a message is
+    written to stderr and counts as failure.
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def _preload(config):
+    """
+    Import the app to pull in all its dependencies, then drop the project's own modules from sys.modules so forked
+    servers import fresh copies of them.
+
+    :return: list of dependency files which were preloaded, excluding the standard library
+    """
+    try:
+        import_string(config['app_path'], config['app_factory'])
+    except Exception as e:
+        # whatever was imported before the error is still preloaded, the server will report the error itself
+        dft_logger.warning('error importing app while preloading: %s: %s', e.__class__.__name__, e)
+
+    roots = _resolved_roots(config)
+    dep_files = []
+    for name, module in list(sys.modules.items()):
+        path = module_file(module)
+        if not path:
+            continue
+        if _is_project_file(path, roots):
+            del sys.modules[name]
+        elif not any(path.startswith(p) for p in STDLIB_PATHS):
+            dep_files.append(path)
+    invalidate_caches()
+    dft_logger.debug('preloaded %d dependency modules', len(dep_files))
+    return dep_files
+
+
+def _fork_server(conn, server_fd, config, warm_files=None):
+    """
+    :return: tuple (pid, sentinel) where sentinel is the read end of a pipe whose write end only the server holds,
+      so it becomes readable when the server exits
+    """
+    if warm_files:
+        start = time.monotonic()
+        warm_finders(warm_files)
+        dft_logger.debug('warmed finder caches for %d files in %0.3fs', len(warm_files), time.monotonic() - start)
+    sentinel, sentinel_w = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(server_fd)
+        os.close(sentinel_w)
+        return pid, sentinel
+
+    # in the new server process, sentinel_w is left open until it exits
+    conn.close()
+    os.close(sentinel)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    code = 0
+    try:
+        serve_main_app(Connection(server_fd), **config)
+    except SystemExit as e:
+        code = _system_exit_status(e.code)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        flush_logs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def _poll_child(pid):
+    """
+    :return: exit code of the child or None if it's still running
+    """
+    try:
+        _pid, status = os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        # already reaped
+        return 0
+    return None if _pid == 0 else _exit_code(status)
+
+
+def zygote_main(conn, config):
+    """
+    Entry point of the zygote process: preload dependencies then fork servers on request until the pipe is closed.
+    """
+    # ctrl+c is sent to the whole process group, servers deal with it themselves, the zygote waits for the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(config['verbose'])
+    conn.send(_preload(config))
+
+    while True:
+        try:
+            command, *args = conn.recv()
+        except EOFError:
+            break
+        if command == 'fork':
+            pid, sentinel = _fork_server(conn, reduction.recv_handle(conn), *args)
+            conn.send(pid)
+            reduction.send_handle(conn, sentinel, os.getppid())
+            os.close(sentinel)
+        elif command == 'poll':
+            conn.send(_poll_child(*args))
+        elif command == 'exit':
+            break
+
+    # a server may outlive the zygote when it's rebuilt, wait for the parent to stop it, reaping promptly
+    # means the parent can tell it's gone with os.kill(pid, 0)
+    conn.close()
+    while True:
+        try:
+            os.wait()
+        except ChildProcessError:
+            break
+
+
+class ForkedProcess:
+    """
+    Server process forked from the zygote, provides the subset of multiprocessing.Process's interface used by
+    CodeFileEventHandler.
+
+    Like multiprocessing.Process.sentinel, `sentinel` becomes readable when the server exits, so checking on it and
+    waiting for it don't involve the zygote, which is only asked for the exit code.
+    """
+    def __init__(self, zygote, pid, sentinel):
+        self._zygote = zygote
+        self.pid = pid
+        self.sentinel = sentinel
+        self.exitcode = None
+
+    def is_alive(self):
+        if self.exitcode is None and wait([self.sentinel], 0):
+            self.exitcode = self._zygote.poll(self.pid)
+            if self.exitcode is not None:
+                os.close(self.sentinel)
+        return self.exitcode is None
+
+    def join(self, timeout=None):
+        end = None if timeout is None else time.monotonic() + timeout
+        while self.is_alive():
+            remaining = None if end is None else end - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return
+            if wait([self.sentinel], remaining) and self.is_alive():
+                # its end of the pipe is closed just before it can be reaped
+                time.sleep(0.001)
+
+
+class _DependencyChanges(FileSystemEventHandler):
+    """
+    Tells the zygote when a preloaded file changes, or when a module or package is added to or removed from one of
+    the watched directories. Anything else happening there doesn't change what the zygote would import.
+    """
+    def __init__(self, zygote, dep_files, dirs):
+        self._zygote = zygote
+        self._dep_files = set(dep_files)
+        self._dirs = dirs
+
+    def dispatch(self, event):
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            if path and self._affects_imports(event, path):
+                self._zygote.dependency_changed(path)
+                return
+
+    def _affects_imports(self, event, path):
+        if path in self._dep_files:
+            return True
+        if event.event_type == EVENT_TYPE_MODIFIED or os.path.dirname(path) not in self._dirs:
+            return False
+        if event.is_directory:
+            return os.path.basename(path) != '__pycache__'
+        return path.endswith(MODULE_SUFFIXES)
+
+
+class Zygote:
+    """
+    Long lived process with the app's third party dependencies already imported, server processes are forked
+    from it so each restart only has to import the project's own modules.
+
+    The zygote is rebuilt if any of the preloaded dependency files or directories on sys.path change, they're
+    watched while it's running so forking doesn't have to check them.
+    """
+    def __init__(self, config):
+        self._config = config
+        self._lock = threading.Lock()
+        self._process = None
+        self._conn = None
+        self._observer = None
+        self._changed = None
+        self._dep_files = []
+        # pids forked by the current zygote, and zygotes which have been replaced
+        self._pids = set()
+        self._retired = []
+        self._roots = _resolved_roots(config)
+
+    def fork(self, config, server_conn, warm_files=None):
+        """
+        Fork a new server.
+
+        :param config: config for serve_main_app
+        :param server_conn: server's end of the pipe to the parent, its file descriptor is passed to the zygote
+        :param warm_files: optional project files the server is likely to import, the zygote populates import
+          finder caches for them before forking
+        :return: ForkedProcess instance
+        """
+        with self._lock:
+            if self._process is not None and not self._process.is_alive():
+                dft_logger.warning('preloaded process died, exit code %s, rebuilding it', self._process.exitcode)
+                self._close()
+            if self._process is None:
+                self._start()
+            elif self._changed:
+                dft_logger.info('dependencies changed, rebuilding preloaded process')
+                self._close()
+                self._start()
+            try:
+                pid, sentinel = self._fork(config, server_conn, warm_files)
+            except (OSError, EOFError) as e:
+                # died since the check above, if rebuilding it fails too the error reaches the caller
+                dft_logger.warning('lost preloaded process (%s), rebuilding it', e.__class__.__name__)
+                self._close()
+                self._start()
+                pid, sentinel = self._fork(config, server_conn, warm_files)
+            self._pids.add(pid)
+        return ForkedProcess(self, pid, sentinel)
+
+    def _fork(self, config, server_conn, warm_files):
+        self._conn.send(('fork', config, warm_files))
+        reduction.send_handle(self._conn, server_conn.fileno(), self._process.pid)
+        pid = self._conn.recv()
+        return pid, reduction.recv_handle(self._conn)
+
+    def dependency_changed(self, path):
+        """
+        Called by the dependency observer's thread.
+        """
+        if not self._changed:
+            dft_logger.debug('preloaded dependency changed: %s', path)
+            self._changed = path
+
+    def poll(self, pid):
+        with self._lock:
+            if pid in self._pids:
+                try:
+                    self._conn.send(('poll', pid))
+                    exitcode = self._conn.recv()
+                except (OSError, EOFError):
+                    # the zygote has died, its servers carry on without it
+                    self._pids.discard(pid)
+                else:
+                    if exitcode is not None:
+                        self._pids.discard(pid)
+                    return exitcode
+
+        # forked by a retired zygote which reaps its servers as soon as they exit, or a dead one whose servers are
+        # reaped by init, exit code is lost
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return 0
+
+    def close(self):
+        with self._lock:
+            if self._process is not None:
+                self._close()
+            for process in self._retired:
+                process.join(5)
+
+    def _start(self):
+        start = time.monotonic()
+        self._conn, child_conn = Pipe()
+        self._process = Process(target=zygote_main, args=(child_conn, self._config))
+        self._process.start()
+        child_conn.close()
+        self._dep_files = self._conn.recv()
+        self._changed = None
+        self._observer = self._watch_dependencies()
+        dft_logger.debug('preloaded process started in %0.3fs', time.monotonic() - start)
+
+    def _close(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        try:
+            self._conn.send(('exit',))
+        except (BrokenPipeError, EOFError):
+            pass
+        self._conn.close()
+        # don't wait for the old zygote, it only exits once its servers have been stopped
+        self._retired = [p for p in self._retired if p.is_alive()] + [self._process]
+        self._pids = set()
+        self._process = self._conn = None
+
+    def _watch_dependencies(self):
+        """
+        Watch the directories of the preloaded files, and the directories on sys.path for packages being installed
+        or removed. Each sys.path root is watched recursively but everything under it which doesn't lead to a
+        preloaded file is pruned, so there's one watch per directory of interest.
+        """
+        dirs = {os.path.dirname(f) for f in self._dep_files}
+        dirs.update(os.path.realpath(p) for p in sys.path if p and os.path.isdir(p))
+        dirs = {d for d in dirs if not os.path.join(d, '').startswith(self._roots)}
+        keep = set()
+        for d in dirs:
+            while d not in keep and os.path.dirname(d) != d:
+                keep.add(d)
+                d = os.path.dirname(d)
+        roots = []
+        for d in sorted(dirs, key=len):
+            if not d.startswith(tuple(os.path.join(r, '') for r in roots)):
+                roots.append(d)
+        return start_observer(_DependencyChanges(self, self._dep_files, dirs), roots, lambda path: path not in keep,
+                              polling=self._config['poll'])
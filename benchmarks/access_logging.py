@@ -0,0 +1,78 @@
+"""
+Cost of access logging to the server's event loop.
+
+Compares the previous handler, which formatted, regex matched, styled and echoed each record in the logging thread,
+with the background writer, and with --access-log-limit summarising most requests. Output goes to /dev/null; the
+total includes waiting for the writer to catch up.
+
+    python benchmarks/access_logging.py --records 100000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+import click
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from aiohttp_runserver.logs import AccessLog, MainAccessLogHandler, flush_logs, fmt_size  # noqa: E402
+
+MESSAGE = 'GET /items/{}/?page=2 HTTP/1.1 200 {} 1234'
+
+
+class RegexAccessLogHandler(logging.Handler):
+    prefix = click.style('●', fg='blue')
+
+    def emit(self, record):
+        log_entry = self.format(record)
+        m = re.match(r'^(\[.*?\] )', log_entry)
+        msg = log_entry[m.end():]
+        method, path, _, code, size, _ = msg.split(' ')
+        click.echo(click.style(m.groups()[0], fg='magenta') + '{} {} {} {} {}'.format(
+            self.prefix, method, path, code, fmt_size(int(size))))
+
+
+def run(logger, access_log, records):
+    start = time.perf_counter()
+    for i in range(records):
+        access_log.info(MESSAGE.format(i, i % 5000))
+    logged = time.perf_counter() - start
+    flush_logs()
+    return logged, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--records', type=int, default=100000)
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    sys.stdout = open(os.devnull, 'w')
+
+    logger = logging.getLogger('aiohttp.access')
+    logger.setLevel(logging.INFO)
+    results = []
+
+    old = RegexAccessLogHandler()
+    old.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', datefmt='%H:%M:%S'))
+    logger.addHandler(old)
+    results.append(('regex handler', run(logger, logger, args.records)))
+    logger.removeHandler(old)
+
+    logger.addHandler(MainAccessLogHandler())
+    results.append(('background writer', run(logger, AccessLog(), args.records)))
+    results.append(('limit 100/s', run(logger, AccessLog(100, loop), args.records)))
+
+    sys.stdout = sys.__stdout__
+    print('{} records'.format(args.records))
+    print('{:<20} {:>12} {:>12}'.format('', 'in loop', 'total'))
+    for name, (logged, total) in results:
+        print('{:<20} {:10.2f}us {:10.2f}us'.format(name, logged / args.records * 1e6, total / args.records * 1e6))
+
+
+if __name__ == '__main__':
+    main()
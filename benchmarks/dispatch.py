@@ -0,0 +1,108 @@
+"""
+Microbenchmark of the cost of dispatching one filesystem event.
+
+Compares WatchDispatcher, which classifies each event once with a precompiled matcher, with the previous setup of
+three pattern matching handlers each running fnmatch globs over every event.
+
+    python benchmarks/dispatch.py --events 100000
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from pathlib import Path
+
+from watchdog.events import FileModifiedEvent, FileMovedEvent, match_any_paths, unicode_paths
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from aiohttp_runserver.metrics import METRICS, ReloadMetrics  # noqa: E402
+from aiohttp_runserver.serve import IMPORTED_FILES  # noqa: E402
+from aiohttp_runserver.watch import CODE, STATIC, TEMPLATE, JB_BACKUP_FILE, PathMatcher, WatchDispatcher  # noqa: E402
+
+ROOT = '/home/user/project'
+STATIC_ROOT = ROOT + '/static'
+
+PATHS = [
+    ROOT + '/app/views.py',
+    ROOT + '/app/models/user.py',
+    ROOT + '/templates/base.html',
+    ROOT + '/templates/emails/welcome.jinja',
+    ROOT + '/.git/objects/ab/cdef0123',
+    ROOT + '/env/lib/python3.5/site-packages/aiohttp/web.py',
+    ROOT + '/app/views.py___jb_tmp___',
+    STATIC_ROOT + '/css/main.css',
+    STATIC_ROOT + '/js/bundle.js',
+    ROOT + '/README.md',
+]
+
+OLD_HANDLERS = [
+    # (patterns, ignore_patterns) of the code, all code and static handlers
+    (['*.py'], PathMatcher.ignore_patterns),
+    (['*.py', '*.html', '*.jinja', '*.jinja2'], PathMatcher.ignore_patterns),
+    (['*.*'], PathMatcher.ignore_patterns),
+]
+
+
+class Counter:
+    def __init__(self):
+        self.count = 0
+
+    def add(self, paths):
+        self.count += 1
+
+
+def old_dispatch(event):
+    # approximately what the three PatternMatchingEventHandler subclasses each did per event
+    matched = 0
+    for patterns, ignore_patterns in OLD_HANDLERS:
+        paths = []
+        if getattr(event, 'dest_path', None) is not None:
+            paths.append(unicode_paths.decode(event.dest_path))
+        if event.src_path:
+            paths.append(unicode_paths.decode(event.src_path))
+        if match_any_paths(paths, included_patterns=[JB_BACKUP_FILE]):
+            continue
+        if match_any_paths(paths, included_patterns=patterns, excluded_patterns=ignore_patterns):
+            matched += 1
+    return matched
+
+
+def make_events(n):
+    rand = random.Random(123)
+    events = []
+    for _ in range(n):
+        if rand.random() < 0.1:
+            events.append(FileMovedEvent(rand.choice(PATHS), rand.choice(PATHS)))
+        else:
+            events.append(FileModifiedEvent(rand.choice(PATHS)))
+    return events
+
+
+def time_per_event(func, events):
+    start = time.perf_counter()
+    for event in events:
+        func(event)
+    return (time.perf_counter() - start) / len(events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--events', type=int, default=100000)
+    args = parser.parse_args()
+    events = make_events(args.events)
+
+    consumers = {CODE: [Counter(), Counter()], TEMPLATE: [Counter()], STATIC: [Counter()]}
+    app = {IMPORTED_FILES: None, METRICS: ReloadMetrics(asyncio.new_event_loop())}
+    dispatcher = WatchDispatcher(app, PathMatcher(STATIC_ROOT), consumers)
+
+    old = time_per_event(old_dispatch, events)
+    new = time_per_event(dispatcher.dispatch, events)
+    print('three handlers:  {:6.2f}µs per event'.format(old * 1e6))
+    print('one dispatcher:  {:6.2f}µs per event'.format(new * 1e6))
+    print('speedup:         {:6.1f}x'.format(old / new))
+
+
+if __name__ == '__main__':
+    main()
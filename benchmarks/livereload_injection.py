@@ -0,0 +1,107 @@
+"""
+Per-request cost of adding the livereload snippet to large server rendered pages.
+
+Compares the previous approach of concatenating the snippet onto the body with inject_snippet, for both a
+Response written in one go and a StreamResponse written in chunks. Writes go to a sink so only the cost of
+injection is measured.
+
+    python benchmarks/livereload_injection.py --size 5
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from aiohttp_runserver.serve import LIVE_RELOAD_SNIPPET, inject_snippet  # noqa: E402
+
+SNIPPET = LIVE_RELOAD_SNIPPET % b'http://localhost:8001/livereload.js?v=0123abcd'
+ROW = b'<tr><td class="name">item</td><td class="value">1234.56</td><td><a href="/items/1/">view</a></td></tr>\n'
+CHUNK_SIZE = 64 * 1024
+
+
+def build_page(size):
+    rows = ROW * (size // len(ROW))
+    return b'<!DOCTYPE html>\n<html>\n<body>\n<table>\n' + rows + b'</table>\n</body>\n</html>\n'
+
+
+def sink(response):
+    written = [0]
+
+    def write(data):
+        written[0] += len(data)
+        return ()
+
+    async def write_eof():
+        pass
+    response.write = write
+    response.write_eof = write_eof
+    return written
+
+
+def concatenate(page):
+    response = web.Response(body=page, content_type='text/html')
+    written = sink(response)
+    response.body += SNIPPET
+    response.write(response.body)
+    return written[0]
+
+
+def inject(page):
+    response = web.Response(body=page, content_type='text/html')
+    written = sink(response)
+    inject_snippet(response, SNIPPET)
+    response.write(response.body)
+    return written[0]
+
+
+def stream(page, loop, with_snippet):
+    response = web.StreamResponse()
+    response.content_type = 'text/html'
+    written = sink(response)
+    if with_snippet:
+        inject_snippet(response, SNIPPET)
+    view = memoryview(page)
+    for i in range(0, len(page), CHUNK_SIZE):
+        response.write(bytes(view[i:i + CHUNK_SIZE]))
+    loop.run_until_complete(response.write_eof())
+    return written[0]
+
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=float, default=5, help='page size in MB')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    page = build_page(int(args.size * 1024 ** 2))
+    loop = asyncio.new_event_loop()
+
+    assert concatenate(page) == inject(page) == stream(page, loop, True) == len(page) + len(SNIPPET)
+
+    results = [
+        ('concatenate body', timeit(lambda: concatenate(page), args.repeat)),
+        ('inject into body', timeit(lambda: inject(page), args.repeat)),
+        ('stream, no snippet', timeit(lambda: stream(page, loop, False), args.repeat)),
+        ('stream with snippet', timeit(lambda: stream(page, loop, True), args.repeat)),
+    ]
+    print('{:.1f}MB page'.format(len(page) / 1024 ** 2))
+    for name, t in results:
+        print('{:<20} {:8.3f}ms'.format(name, t * 1000))
+
+
+if __name__ == '__main__':
+    main()
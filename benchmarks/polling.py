@@ -0,0 +1,93 @@
+"""
+Cost of polling a large tree with PollingIndex compared to naively walking and stat'ing everything.
+
+    python benchmarks/polling.py --files 100000
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from aiohttp_runserver.polling import PollingIndex  # noqa: E402
+
+
+def build_tree(root, file_count, files_per_dir=100, dirs_per_dir=10):
+    """
+    Create file_count empty python files in a tree of directories each holding files_per_dir files.
+    """
+    dirs = [root]
+    created, i = 0, 0
+    while created < file_count:
+        d = dirs[i]
+        i += 1
+        for n in range(min(files_per_dir, file_count - created)):
+            with open(os.path.join(d, 'module_{}.py'.format(n)), 'w'):
+                pass
+            created += 1
+        for n in range(dirs_per_dir):
+            sub = os.path.join(d, 'package_{}'.format(n))
+            os.mkdir(sub)
+            dirs.append(sub)
+    return [os.path.join(d, 'module_0.py') for d in dirs[:i]]
+
+
+def naive_scan(root):
+    states = {}
+    for dir_path, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dir_path, name)
+            st = os.stat(path)
+            states[path] = st.st_ino, st.st_mtime_ns, st.st_size
+    return states
+
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='runserver_polling_')
+    try:
+        sample_files = build_tree(root, args.files)
+        start = time.perf_counter()
+        index = PollingIndex(root)
+        index_time = time.perf_counter() - start
+        # let directory mtimes age so they're not treated as racy
+        time.sleep(2.1)
+        index.scan()
+
+        print('{} files in {} directories'.format(index.file_count, index.dir_count))
+        print('initial index:       {:8.1f}ms'.format(index_time * 1000))
+        print('naive walk and stat: {:8.1f}ms'.format(timeit(lambda: naive_scan(root), args.repeat) * 1000))
+        print('idle scan:           {:8.1f}ms'.format(timeit(index.scan, args.repeat) * 1000))
+
+        def modify_and_scan():
+            for path in sample_files[:10]:
+                with open(path, 'a') as f:
+                    f.write('#')
+            changes = index.scan()
+            assert len(changes) >= 10, changes
+
+        print('scan with 10 edits:  {:8.1f}ms'.format(timeit(modify_and_scan, args.repeat) * 1000))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Compare restart latency of the default spawn path with forking servers from a preloaded zygote.
+
+A throwaway project is created whose app imports a "heavy" dependency living outside code_path, each round
+measures the time from starting a server process until main_port accepts connections.
+
+    python benchmarks/restart_latency.py --rounds 10 --import-delay 2
+"""
+import argparse
+import os
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from multiprocessing import Pipe, get_context
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from aiohttp_runserver.serve import serve_main_app  # noqa: E402
+from aiohttp_runserver.zygote import Zygote  # noqa: E402
+
+HEAVY_DEP = """\
+import time
+import aiohttp.web
+# stand in for an ORM, template engine etc.
+time.sleep({delay})
+"""
+
+APP = """\
+import heavy_dep
+from aiohttp import web
+
+
+async def index(request):
+    return web.Response(text='hello')
+
+
+def create_app(loop):
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/', index)
+    return app
+"""
+
+
+def wait_for_port(port, timeout=60):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            with socket.create_connection(('localhost', port), timeout=0.1):
+                return
+        except OSError:
+            time.sleep(0.005)
+    raise RuntimeError('server never started on port {}'.format(port))
+
+
+def time_restarts(start, config, rounds):
+    """
+    :param start: callable returning a started process, either spawned or forked
+    :return: list of startup latencies in seconds
+    """
+    times = []
+    for _ in range(rounds):
+        t = time.monotonic()
+        process = start()
+        wait_for_port(config['main_port'])
+        times.append(time.monotonic() - t)
+        os.kill(process.pid, signal.SIGINT)
+        process.join(5)
+    return times
+
+
+def spawn(config):
+    # as run_apps does, the platform's default may be fork which would flatter the baseline
+    p = get_context('spawn').Process(target=serve_main_app, kwargs=config)
+    p.start()
+    return p
+
+
+def fork(zygote, config):
+    conn, server_conn = Pipe()
+    p = zygote.fork(config, server_conn)
+    server_conn.close()
+    return p
+
+
+def report(name, times):
+    print('{:>8}: mean {:7.1f}ms, median {:7.1f}ms, min {:7.1f}ms, max {:7.1f}ms'.format(
+        name, *(f(times) * 1000 for f in (statistics.mean, statistics.median, min, max))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--import-delay', type=float, default=1, help='seconds taken to import the heavy dependency')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    tmp = Path(tempfile.mkdtemp(prefix='runserver_bench_'))
+    deps, project = tmp / 'deps', tmp / 'project'
+    deps.mkdir()
+    project.mkdir()
+    (deps / 'heavy_dep.py').write_text(HEAVY_DEP.format(delay=args.import_delay))
+    (project / 'app.py').write_text(APP)
+    sys.path.insert(0, str(deps))
+    os.chdir(str(project))
+
+    config = dict(
+        app_path='app.py',
+        app_factory='create_app',
+        code_path=str(project),
+        static_path=None,
+        static_url='/static/',
+        livereload=False,
+        main_port=args.port,
+        aux_port=args.port + 1,
+        preload=False,
+        workers=1,
+        warmup=False,
+        hot_reload=False,
+        profile_imports=False,
+        access_log_limit=None,
+        profile_requests=False,
+        slow_request=0.5,
+        block_threshold=None,
+        watch=[],
+        poll=False,
+        verbose=False,
+    )
+    report('spawn', time_restarts(lambda: spawn(config), config, args.rounds))
+
+    zygote = Zygote(config)
+    # the first fork also starts the zygote, time it separately
+    t = time.monotonic()
+    time_restarts(lambda: fork(zygote, config), config, 1)
+    print('zygote first start {:0.1f}ms'.format((time.monotonic() - t) * 1000))
+    try:
+        report('fork', time_restarts(lambda: fork(zygote, config), config, args.rounds))
+    finally:
+        zygote.close()
+
+
+if __name__ == '__main__':
+    main()
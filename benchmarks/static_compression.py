@@ -0,0 +1,125 @@
+"""
+Transfer size and latency of a large JS bundle from the auxiliary static server with each content encoding.
+
+A synthetic bundle is served by the aux app, each encoding is requested once cold (compressed on the fly or read
+from a precompressed sibling) then repeatedly warm (from the cache). Transfer time over a slow link, eg. an SSH
+tunnel, is estimated from the response size and --bandwidth.
+
+    python benchmarks/static_compression.py --size 5 --bandwidth 20
+"""
+import argparse
+import asyncio
+import gzip
+import http.client
+import random
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from aiohttp_runserver.serve import ENCODERS, create_auxiliary_app  # noqa: E402
+
+MODULE = """\
+define('module_{n}', ['require', 'exports', 'module_{dep}'], function (require, exports, dep) {{
+    'use strict';
+    function {name}(options) {{
+        var result = dep.{other}(options.value * {n}, '{word}');
+        if (result === undefined) {{
+            throw new Error('{name} failed for ' + JSON.stringify(options));
+        }}
+        return result;
+    }}
+    exports.{name} = {name};
+}});
+"""
+
+WORDS = ['render', 'update', 'fetch', 'parse', 'format', 'validate', 'submit', 'toggle', 'select', 'filter']
+
+
+def build_bundle(path, size):
+    rand = random.Random(123)
+    with path.open('w') as f:
+        n = 0
+        while f.tell() < size:
+            name = '{}{}{}'.format(rand.choice(WORDS), rand.choice(WORDS).title(), n)
+            f.write(MODULE.format(n=n, dep=rand.randrange(n + 1), name=name, other=rand.choice(WORDS),
+                                  word=rand.choice(WORDS)))
+            n += 1
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def start_server(static_path, port):
+    loop = asyncio.new_event_loop()
+    app = create_auxiliary_app(loop=loop, static_path=str(static_path), static_url='/static/')
+    handler = app.make_handler(access_log=None)
+    server = loop.run_until_complete(loop.create_server(handler, 'localhost', port))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+    return stop
+
+
+def fetch(port, path, accept_encoding):
+    conn = http.client.HTTPConnection('localhost', port)
+    start = time.perf_counter()
+    conn.request('GET', path, headers={'Accept-Encoding': accept_encoding})
+    r = conn.getresponse()
+    body = r.read()
+    latency = time.perf_counter() - start
+    conn.close()
+    assert r.status == 200, r.status
+    return latency, len(body), r.getheader('Content-Encoding') or 'identity'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', type=float, default=5, help='bundle size in MB')
+    parser.add_argument('--bandwidth', type=float, default=20, help='link speed in Mbit/s for the transfer estimate')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    static_path = Path(tempfile.mkdtemp(prefix='runserver_static_'))
+    port = free_port()
+    stop = start_server(static_path, port)
+    try:
+        build_bundle(static_path / 'bundle.js', int(args.size * 1024 ** 2))
+        precompressed = static_path / 'precompressed.js'
+        shutil.copy(str(static_path / 'bundle.js'), str(precompressed))
+        with precompressed.open('rb') as fr, gzip.open(str(precompressed) + '.gz', 'wb', compresslevel=9) as fw:
+            shutil.copyfileobj(fr, fw)
+
+        cases = [('identity', 'bundle.js'), ('gzip', 'bundle.js'), ('gzip', 'precompressed.js')]
+        if 'br' in ENCODERS:
+            cases.append(('br', 'bundle.js'))
+
+        print('{:<18} {:<9} {:>10} {:>10} {:>10} {:>14}'.format(
+            'file', 'encoding', 'size', 'cold', 'warm', 'est. transfer'))
+        for accept, filename in cases:
+            path = '/static/' + filename
+            cold, size, encoding = fetch(port, path, accept)
+            warm = statistics.median(fetch(port, path, accept)[0] for _ in range(args.repeat))
+            transfer = size * 8 / (args.bandwidth * 10 ** 6)
+            print('{:<18} {:<9} {:>8.0f}KB {:>8.1f}ms {:>8.1f}ms {:>12.0f}ms'.format(
+                filename, encoding, size / 1024, cold * 1000, warm * 1000, transfer * 1000))
+    finally:
+        stop()
+        shutil.rmtree(str(static_path))
+
+
+if __name__ == '__main__':
+    main()
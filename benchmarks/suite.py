@@ -0,0 +1,363 @@
+"""
+End to end benchmarks of the reload pipeline, run against synthetic projects and reported as JSON.
+
+For each project size a tree of python files is generated alongside an app which imports --import-modules of
+them, run_apps is started in its own process as the cli would and the following are measured:
+
+* watcher: time to start the observer on the project and the number of inotify watches it registers
+* startup: time from starting run_apps until main_port answers
+* restart: time from changing a module the app imports until the new server answers with the change, plus the
+  reload stage timings reported by /_runserver/metrics
+* static: requests per second and throughput of a static file from CustomStaticRoute
+* websocket: time from changing a static file until each of --clients livereload clients receives the reload
+
+Results go to stdout or --output, pass several --files values to compare project sizes:
+
+    python benchmarks/suite.py --files 1000 10000 100000 --output results.json
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import Process
+from pathlib import Path
+
+import aiohttp
+from watchdog.events import FileSystemEventHandler
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from aiohttp_runserver.logs import setup_logging  # noqa: E402
+from aiohttp_runserver.main import cli, run_apps  # noqa: E402
+from aiohttp_runserver.observers import start_observer  # noqa: E402
+from aiohttp_runserver.watch import IgnoredDirectories, PathMatcher  # noqa: E402
+from polling import build_tree  # noqa: E402
+
+APP = """\
+import time
+from aiohttp import web
+
+import views
+{imports}
+
+time.sleep({delay})
+
+
+async def index(request):
+    return web.Response(text=views.VERSION)
+
+
+def create_app(loop):
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/', index)
+    return app
+"""
+
+MODULE = """\
+import collections
+
+
+class Model{n}(collections.namedtuple('Model{n}', 'id name value')):
+    def describe(self):
+        return '{{}}: {{}}'.format(self.name, self.value)
+
+
+def helper_{n}(items):
+    return [Model{n}(i, str(i), i * {n}) for i in items]
+"""
+
+LIVERELOAD_HELLO = json.dumps({'command': 'hello', 'protocols': ['http://livereload.com/protocols/official-7']})
+LIVERELOAD_INFO = json.dumps({'command': 'info', 'url': 'http://localhost/', 'plugins': {}})
+
+
+def summary(values):
+    if not values:
+        return None
+    return {
+        'min': min(values),
+        'median': statistics.median(values),
+        'mean': statistics.mean(values),
+        'max': max(values),
+        'count': len(values),
+    }
+
+
+def build_project(root, args, file_count):
+    """
+    Create a project with file_count python files under lib/ and an app importing args.import_modules modules
+    from heavy/, plus static files.
+    """
+    project = root / 'project'
+    (project / 'lib').mkdir(parents=True)
+    build_tree(str(project / 'lib'), file_count)
+
+    heavy = project / 'heavy'
+    heavy.mkdir()
+    (heavy / '__init__.py').write_text('')
+    for n in range(args.import_modules):
+        (heavy / 'module_{}.py'.format(n)).write_text(MODULE.format(n=n))
+    imports = '\n'.join('import heavy.module_{}'.format(n) for n in range(args.import_modules))
+    (project / 'app.py').write_text(APP.format(imports=imports, delay=args.import_delay))
+    (project / 'views.py').write_text("VERSION = '0'\n")
+
+    static = project / 'static'
+    static.mkdir()
+    (static / 'bundle.js').write_bytes(os.urandom(args.static_size * 1024 // 2).hex().encode())
+    (static / 'styles.css').write_text('body { color: #000; }\n')
+    return project
+
+
+def make_config(project, args):
+    # parsed by the cli itself so new options and their callbacks don't need adding here
+    ctx = cli.make_context('aiohttp-runserver', [str(project / 'app.py'), 'create_app'])
+    config = dict(ctx.params)
+    config.update(
+        static_path=str(project / 'static'),
+        main_port=args.port,
+        aux_port=args.port + 1,
+        preload=args.preload,
+        warmup=args.warmup,
+    )
+    return config
+
+
+def bench_watcher(project):
+    matcher = PathMatcher(str(project / 'static'))
+    prune = IgnoredDirectories(matcher, [str(project)], keep=str(project / 'static'))
+    start = time.perf_counter()
+    observer = start_observer(FileSystemEventHandler(), [str(project)], prune)
+    elapsed = time.perf_counter() - start
+    watches = [getattr(getattr(e, '_inotify', None), 'watch_count', None) for e in observer.emitters]
+    observer.stop()
+    observer.join()
+    return {'start_seconds': elapsed, 'watches': sum(w for w in watches if w is not None) if any(watches) else None}
+
+
+def run(config, quiet):
+    if quiet:
+        # also silences the server processes run_apps starts
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+    setup_logging(config['verbose'])
+    run_apps(**config)
+
+
+def get(port, path='/', timeout=1):
+    conn = http.client.HTTPConnection('localhost', port, timeout=timeout)
+    try:
+        conn.request('GET', path)
+        r = conn.getresponse()
+        return r.status, r.read()
+    finally:
+        conn.close()
+
+
+def wait_for(predicate, timeout=60, interval=0.005):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            if predicate():
+                return time.monotonic()
+        except (OSError, ValueError, http.client.HTTPException):
+            pass
+        time.sleep(interval)
+    raise RuntimeError('timed out after {}s'.format(timeout))
+
+
+def reload_metrics(config):
+    _, body = get(config['aux_port'], '/_runserver/metrics')
+    return json.loads(body.decode())
+
+
+def bench_restart(project, config, rounds):
+    """
+    Change views.VERSION and wait for the app to serve the new value, also collecting how long each stage took
+    from the aux app's metrics.
+    """
+    latencies = []
+    before = reload_metrics(config)['stages']
+    for n in range(1, rounds + 1):
+        version = str(n).encode()
+        start = time.monotonic()
+        (project / 'views.py').write_text("VERSION = '{}'\n".format(n))
+        end = wait_for(lambda: get(config['main_port']) == (200, version))
+        latencies.append(end - start)
+        # let the old server go away before the next change
+        time.sleep(0.5)
+
+    after = reload_metrics(config)['stages']
+    stages = {}
+    for stage, h in after.items():
+        count = h['count'] - before[stage]['count']
+        if count:
+            stages[stage] = (h['sum'] - before[stage]['sum']) / count
+    return {'seconds': summary(latencies), 'mean_stage_seconds': stages}
+
+
+def bench_static(config, requests, concurrency):
+    path = '{}bundle.js'.format(config['static_url'])
+    counts = [0] * concurrency
+    sizes = [0] * concurrency
+
+    def client(i):
+        conn = http.client.HTTPConnection('localhost', config['aux_port'], timeout=10)
+        for _ in range(requests // concurrency):
+            conn.request('GET', path, headers={'Accept-Encoding': 'identity'})
+            r = conn.getresponse()
+            sizes[i] += len(r.read())
+            counts[i] += 1
+        conn.close()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': sum(counts),
+        'concurrency': concurrency,
+        'requests_per_second': sum(counts) / elapsed,
+        'megabytes_per_second': sum(sizes) / elapsed / 1024 ** 2,
+    }
+
+
+async def _ws_fanout(project, config, clients, loop):
+    url = 'http://localhost:{}/livereload'.format(config['aux_port'])
+    sockets = []
+    for _ in range(clients):
+        ws = await aiohttp.ws_connect(url, loop=loop)
+        ws.send_str(LIVERELOAD_HELLO)
+        await ws.receive()
+        ws.send_str(LIVERELOAD_INFO)
+        sockets.append(ws)
+    # give the server a moment to register every client
+    await asyncio.sleep(0.5, loop=loop)
+
+    async def receive(ws):
+        msg = await ws.receive()
+        assert 'reload' in msg.data, msg.data
+        return time.monotonic()
+
+    waiters = [loop.create_task(receive(ws)) for ws in sockets]
+    start = time.monotonic()
+    (project / 'static' / 'styles.css').write_text('body {{ color: #{:06x}; }}\n'.format(int(start) % 0xffffff))
+    received = await asyncio.gather(*waiters, loop=loop)
+    for ws in sockets:
+        await ws.close()
+    return start, received
+
+
+def bench_websocket(project, config, clients):
+    loop = asyncio.new_event_loop()
+    try:
+        start, received = loop.run_until_complete(_ws_fanout(project, config, clients, loop))
+    finally:
+        loop.close()
+    latencies = [t - start for t in received]
+    return {
+        'clients': clients,
+        'seconds': summary(latencies),
+        # time between the first and last client receiving the reload
+        'spread_seconds': max(received) - min(received),
+    }
+
+
+def bench_project(args, file_count):
+    tmp = Path(tempfile.mkdtemp(prefix='runserver_suite_'))
+    process = None
+    try:
+        project = build_project(tmp, args, file_count)
+        results = {'files': file_count, 'import_modules': args.import_modules, 'import_delay': args.import_delay}
+        results['watcher'] = bench_watcher(project)
+
+        config = make_config(project, args)
+        process = Process(target=run, args=(config, not args.verbose))
+        start = time.monotonic()
+        process.start()
+        ready = wait_for(lambda: get(config['main_port'])[0] == 200)
+        # metrics is served by the aux app
+        wait_for(lambda: 'stages' in reload_metrics(config))
+        results['startup'] = {'seconds': ready - start}
+
+        # the server reports what it's imported every couple of seconds, until then every change restarts it
+        time.sleep(3)
+        results['restart'] = bench_restart(project, config, args.rounds)
+        results['static'] = bench_static(config, args.static_requests, args.concurrency)
+        results['websocket'] = bench_websocket(project, config, args.clients)
+        return results
+    finally:
+        if process and process.is_alive():
+            os.kill(process.pid, signal.SIGINT)
+            process.join(10)
+        shutil.rmtree(str(tmp), ignore_errors=True)
+
+
+def meta():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(Path(__file__).parent),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def port_free(port):
+    with socket.socket() as s:
+        return s.connect_ex(('localhost', port)) != 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, nargs='+', default=[1000], help='python files in each project')
+    parser.add_argument('--import-modules', type=int, default=50, help='modules imported by the app')
+    parser.add_argument('--import-delay', type=float, default=0, help='extra seconds the app takes to import')
+    parser.add_argument('--rounds', type=int, default=5, help='restarts to time')
+    parser.add_argument('--static-size', type=int, default=512, help='size of the static file in KB')
+    parser.add_argument('--static-requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--clients', type=int, default=50, help='livereload websocket clients')
+    parser.add_argument('--preload', action='store_true')
+    parser.add_argument('--warmup', action='store_true')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--output', help='file to write results to, default stdout')
+    parser.add_argument('--verbose', action='store_true', help="show runserver's output")
+    args = parser.parse_args()
+
+    for port in (args.port, args.port + 1):
+        if not port_free(port):
+            parser.error('port {} is in use'.format(port))
+
+    results = {
+        'meta': meta(),
+        'params': vars(args),
+        'projects': [bench_project(args, n) for n in args.files],
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
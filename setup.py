@@ -69,5 +69,9 @@ setup(
         'aiohttp>=0.21.6',
         'click>=6.2',
         'watchdog==0.8.3',
-    ]
+    ],
+    extras_require={
+        # brotli compression of static files, otherwise only gzip is used
+        'brotli': ['brotli'],
+    },
 )
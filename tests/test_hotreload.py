@@ -0,0 +1,95 @@
+import asyncio
+import sys
+
+import pytest
+
+from aiohttp_runserver.hotreload import reload_modules
+
+APP = """\
+from aiohttp import web
+from views import index
+
+
+def create_app(loop):
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/', index)
+    return app
+"""
+VIEWS = """\
+from aiohttp import web
+import helpers
+
+
+async def index(request):
+    return web.Response(text=helpers.greeting())
+"""
+HELPERS = """\
+def greeting():
+    return 'hello'
+"""
+
+
+@pytest.fixture
+def project(tmpdir, monkeypatch):
+    tmpdir.join('app.py').write(APP)
+    tmpdir.join('views.py').write(VIEWS)
+    tmpdir.join('helpers.py').write(HELPERS)
+    # rewritten modules often have the same size and mtime second, so their bytecode would look current
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    loop = asyncio.new_event_loop()
+    import app
+    yield tmpdir, app.create_app(loop)
+    loop.close()
+    for name in ('app', 'views', 'helpers', 'other'):
+        sys.modules.pop(name, None)
+
+
+def reload(project, *names):
+    tmpdir, app = project
+    return reload_modules(app, [str(tmpdir.join(n)) for n in names], [str(tmpdir)], str(tmpdir.join('app.py')))
+
+
+def test_reload_helper(project):
+    tmpdir, _ = project
+    helpers = sys.modules['helpers']
+    tmpdir.join('helpers.py').write(HELPERS.replace('hello', 'howdy'))
+    assert reload(project, 'helpers.py') is None
+    assert sys.modules['helpers'] is helpers
+    assert sys.modules['views'].helpers.greeting() == 'howdy'
+
+
+def test_app_refers_to_module(project):
+    tmpdir, _ = project
+    index = sys.modules['views'].index
+    tmpdir.join('views.py').write(VIEWS + '\n\nx = 1\n')
+    assert reload(project, 'views.py') == 'app refers to views.index'
+    # not reloaded
+    assert sys.modules['views'].index is index
+    assert not hasattr(sys.modules['views'], 'x')
+
+
+def test_name_imported_elsewhere(project):
+    tmpdir, _ = project
+    tmpdir.join('other.py').write('from helpers import greeting\n')
+    import other  # noqa
+    tmpdir.join('helpers.py').write(HELPERS.replace('hello', 'howdy'))
+    assert reload(project, 'helpers.py') == 'other imports greeting from helpers'
+    assert sys.modules['helpers'].greeting() == 'hello'
+
+
+def test_app_module_changed(project):
+    assert reload(project, 'app.py') == 'app module changed'
+
+
+def test_not_imported(project):
+    tmpdir, _ = project
+    tmpdir.join('unused.py').write('x = 1\n')
+    assert reload(project, 'unused.py') is None
+    assert 'unused' not in sys.modules
+
+
+def test_reload_error(project):
+    tmpdir, _ = project
+    tmpdir.join('helpers.py').write('def greeting(:\n')
+    assert reload(project, 'helpers.py').startswith('error reloading helpers: SyntaxError')
@@ -0,0 +1,76 @@
+import importlib.abc
+import importlib.util
+import sys
+
+import pytest
+
+from aiohttp_runserver.imports import ImportProfiler, module_file
+
+
+class SharedLoader(importlib.abc.Loader):
+    """
+    One loader instance for several modules, as six's meta path importer and zipimporter are.
+    """
+    def __init__(self, sources):
+        self.sources = sources
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname in self.sources:
+            return importlib.util.spec_from_loader(fullname, self)
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        exec(self.sources[module.__name__], vars(module))
+
+
+@pytest.fixture
+def shared_loader():
+    loader = SharedLoader({
+        'profiled_a': 'import profiled_b\nvalue = profiled_b.value + 1\n',
+        'profiled_b': 'value = 1\n',
+    })
+    sys.meta_path.insert(0, loader)
+    yield loader
+    sys.meta_path.remove(loader)
+    for name in loader.sources:
+        sys.modules.pop(name, None)
+
+
+def test_profiler_shared_loader(shared_loader):
+    profiler = ImportProfiler()
+    profiler.install()
+    try:
+        import profiled_a
+    finally:
+        profiler.uninstall()
+
+    assert profiled_a.value == 2
+    assert [name for name, _, _ in profiler.timings] == ['profiled_b', 'profiled_a']
+    (_, b_self, b_cumulative), (_, a_self, a_cumulative) = profiler.timings
+    assert b_self == b_cumulative
+    assert a_cumulative >= b_cumulative + a_self - 1e-9
+    # the loader isn't modified and modules see their real loader and spec
+    assert 'exec_module' not in vars(shared_loader)
+    assert profiled_a.__loader__ is shared_loader
+    assert profiled_a.__spec__.loader is shared_loader
+    assert sys.modules['profiled_b'].__spec__.loader is shared_loader
+
+
+def test_profiler_file_modules(tmpdir):
+    tmpdir.join('profiled_c.py').write('X = 1\n')
+    sys.path.insert(0, str(tmpdir))
+    profiler = ImportProfiler()
+    profiler.install()
+    try:
+        import profiled_c
+    finally:
+        profiler.uninstall()
+        sys.path.remove(str(tmpdir))
+        sys.modules.pop('profiled_c', None)
+    assert profiled_c.X == 1
+    assert [name for name, _, _ in profiler.timings] == ['profiled_c']
+    assert module_file(profiled_c) == str(tmpdir.join('profiled_c.py').realpath())
+    assert type(profiled_c.__loader__).__name__ == 'SourceFileLoader'
+    assert profiler not in sys.meta_path
@@ -0,0 +1,50 @@
+import os
+
+import click
+import pytest
+
+from aiohttp_runserver.main import parse_watch
+
+
+def test_parse_watch(tmpdir):
+    lib = tmpdir.mkdir('lib')
+    content = tmpdir.mkdir('content')
+    roots = parse_watch(None, None, (str(lib), '{}:reload'.format(content), '{}:ignore'.format(lib)))
+    assert roots == [
+        (str(lib.realpath()), 'restart'),
+        (str(content.realpath()), 'reload'),
+        (str(lib.realpath()), 'ignore'),
+    ]
+
+
+def test_parse_watch_relative(tmpdir):
+    tmpdir.mkdir('lib')
+    cwd = os.getcwd()
+    os.chdir(str(tmpdir))
+    try:
+        roots = parse_watch(None, None, ('lib:restart',))
+    finally:
+        os.chdir(cwd)
+    assert roots == [(str(tmpdir.join('lib').realpath()), 'restart')]
+
+
+def test_parse_watch_colon_in_path(tmpdir):
+    d = tmpdir.mkdir('a:b')
+    assert parse_watch(None, None, (str(d),)) == [(str(d.realpath()), 'restart')]
+
+
+@pytest.mark.parametrize('value', ['missing', 'missing:reload'])
+def test_parse_watch_missing(tmpdir, value):
+    with pytest.raises(click.BadParameter):
+        parse_watch(None, None, (str(tmpdir.join(value)),))
+
+
+def test_parse_watch_unknown_policy(tmpdir):
+    tmpdir.mkdir('lib')
+    # treated as part of the path
+    with pytest.raises(click.BadParameter):
+        parse_watch(None, None, (str(tmpdir.join('lib')) + ':bogus',))
+
+
+def test_parse_watch_default():
+    assert parse_watch(None, None, ()) == []
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import pytest
+
+from aiohttp_runserver.metrics import (BROADCAST, DEBOUNCE, IMPORTING, RECONNECT, STOPPED, Histogram,
+                                       ReloadMetrics)
+
+
+def run_callbacks(loop):
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_histogram():
+    h = Histogram((1, 5))
+    for value in (0.5, 1, 3, 10):
+        h.observe(value)
+    d = h.as_dict()
+    assert d['count'] == 4
+    assert d['sum'] == 14.5
+    assert d['mean'] == 14.5 / 4
+    assert list(d['buckets'].items()) == [('1', 2), ('5', 3), ('+Inf', 4)]
+
+
+def test_histogram_empty():
+    assert Histogram().as_dict()['mean'] == 0
+
+
+def test_reload_metrics(loop):
+    metrics = ReloadMetrics(loop)
+    metrics.event()
+    start = time.monotonic()
+    metrics.record(DEBOUNCE, start + 0.1)
+    metrics.record(DEBOUNCE, start + 0.5)
+    metrics.record(STOPPED)
+    # another event while the reload is in progress is part of the same one
+    metrics.event()
+    metrics.record(RECONNECT)
+    run_callbacks(loop)
+
+    d = metrics.as_dict()
+    assert d['reloads'] == 1
+    stages = d['stages']
+    assert stages[DEBOUNCE]['count'] == 1
+    assert 0.05 < stages[DEBOUNCE]['sum'] < 0.5
+    assert stages[STOPPED]['count'] == 1
+    assert stages[BROADCAST]['count'] == 0
+
+    # the reconnect closed the timeline
+    metrics.record(STOPPED)
+    assert metrics.as_dict()['stages'][STOPPED]['count'] == 1
+    metrics.event()
+    assert metrics.as_dict()['reloads'] == 2
+
+
+def test_reload_metrics_finish(loop):
+    metrics = ReloadMetrics(loop)
+    metrics.event()
+    metrics.record(BROADCAST)
+    metrics.finish()
+    metrics.record(RECONNECT)
+    assert metrics.as_dict()['stages'][RECONNECT]['count'] == 0
+
+
+def test_failed_reload_discarded(loop):
+    metrics = ReloadMetrics(loop)
+    metrics.event()
+    metrics.record(DEBOUNCE)
+    metrics.record(STOPPED)
+    time.sleep(0.2)
+    # the new server failed to start
+    metrics.discard()
+    metrics.record(IMPORTING)
+
+    # the fix
+    metrics.event()
+    metrics.record(DEBOUNCE)
+    metrics.record(IMPORTING)
+    metrics.finish()
+
+    d = metrics.as_dict()
+    assert d['reloads'] == 2
+    stages = d['stages']
+    assert stages[DEBOUNCE]['count'] == 1
+    assert stages[DEBOUNCE]['sum'] < 0.1
+    assert stages[STOPPED]['count'] == 0
+    assert stages[IMPORTING]['count'] == 1
+    assert stages[IMPORTING]['sum'] < 0.1
+
+
+def test_stages_counted_when_closed(loop):
+    metrics = ReloadMetrics(loop)
+    metrics.event()
+    metrics.record(DEBOUNCE)
+    assert metrics.as_dict()['stages'][DEBOUNCE]['count'] == 0
+    metrics.finish()
+    assert metrics.as_dict()['stages'][DEBOUNCE]['count'] == 1
+
+
+def test_record_without_event(loop):
+    metrics = ReloadMetrics(loop)
+    metrics.record(DEBOUNCE)
+    assert metrics.as_dict()['stages'][DEBOUNCE]['count'] == 0
@@ -0,0 +1,61 @@
+import os
+
+from aiohttp_runserver.polling import CREATED, DELETED, MODIFIED, PollingIndex
+
+
+def test_initial_index(tmpdir):
+    tmpdir.join('a.py').write('a')
+    tmpdir.mkdir('pkg').join('b.py').write('b')
+    index = PollingIndex(str(tmpdir))
+    assert index.file_count == 2
+    assert index.dir_count == 2
+    assert index.scan() == []
+
+
+def test_created_modified_deleted(tmpdir):
+    tmpdir.join('a.py').write('a')
+    tmpdir.join('b.py').write('b')
+    index = PollingIndex(str(tmpdir))
+    tmpdir.join('a.py').write('aa')
+    tmpdir.join('b.py').remove()
+    tmpdir.join('c.py').write('c')
+    assert sorted(index.scan()) == [
+        (CREATED, str(tmpdir.join('c.py'))),
+        (DELETED, str(tmpdir.join('b.py'))),
+        (MODIFIED, str(tmpdir.join('a.py'))),
+    ]
+    assert index.scan() == []
+
+
+def test_directories(tmpdir):
+    old = tmpdir.mkdir('old')
+    old.join('x.py').write('x')
+    index = PollingIndex(str(tmpdir))
+    old.remove()
+    new = tmpdir.mkdir('new')
+    new.mkdir('sub').join('y.py').write('y')
+    assert sorted(index.scan()) == [
+        (CREATED, str(new.join('sub', 'y.py'))),
+        (DELETED, str(old.join('x.py'))),
+    ]
+    assert index.dir_count == 3
+
+
+def test_renamed(tmpdir):
+    tmpdir.join('a.py').write('a')
+    index = PollingIndex(str(tmpdir))
+    os.rename(str(tmpdir.join('a.py')), str(tmpdir.join('b.py')))
+    assert sorted(index.scan()) == [
+        (CREATED, str(tmpdir.join('b.py'))),
+        (DELETED, str(tmpdir.join('a.py'))),
+    ]
+
+
+def test_prune(tmpdir):
+    tmpdir.mkdir('node_modules').join('x.js').write('x')
+    tmpdir.join('a.py').write('a')
+    index = PollingIndex(str(tmpdir), prune=lambda path: path.endswith('node_modules'))
+    assert index.file_count == 1
+    tmpdir.join('node_modules', 'y.js').write('y')
+    tmpdir.mkdir('src').mkdir('node_modules').join('z.js').write('z')
+    assert index.scan() == []
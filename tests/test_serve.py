@@ -0,0 +1,360 @@
+import asyncio
+import os
+import socket
+import time
+from collections import namedtuple
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+from aiohttp.hdrs import CONTENT_ENCODING, IF_NONE_MATCH
+
+from aiohttp_runserver import serve
+from aiohttp_runserver.serve import (MAX_BODY_TAIL, WS_QUEUE_SIZE, CustomStaticRoute, LiveReloadClient, ReloadQueue,
+                                     SnippetInjector, StaticFileCache, _not_modified, _variant_etag, inject_snippet,
+                                     ports_in_use)
+
+Request = namedtuple('Request', 'headers if_modified_since')
+
+
+def load(cache, path):
+    entry = cache.load(Path(path), os.stat(path))
+    cache.add(os.path.basename(path), entry)
+    return entry
+
+
+def test_ports_in_use():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        free_port = sock.getsockname()[1]
+    with socket.socket() as sock:
+        sock.bind(('0.0.0.0', 0))
+        sock.listen(1)
+        port = sock.getsockname()[1]
+        assert ports_in_use(port, free_port) == [port]
+    assert ports_in_use(port, free_port) == []
+
+
+def test_static_cache_hit(tmpdir):
+    p = tmpdir.join('app.js')
+    p.write('console.log(1)')
+    cache = StaticFileCache()
+    entry = load(cache, str(p))
+    assert entry.body == b'console.log(1)'
+    assert cache.get('app.js') is entry
+    assert cache.is_current(entry)
+    assert cache.size == 14
+
+
+def test_static_cache_changed_without_event(tmpdir):
+    # no extension so the watcher never reports it
+    p = tmpdir.join('LICENSE')
+    p.write('v1')
+    cache = StaticFileCache()
+    entry = load(cache, str(p))
+    p.write('v2 longer')
+    assert not cache.is_current(entry)
+    p.remove()
+    assert not cache.is_current(entry)
+
+
+def test_static_cache_same_size_rewrite(tmpdir):
+    p = tmpdir.join('robots')
+    p.write('v1')
+    cache = StaticFileCache()
+    entry = load(cache, str(p))
+    st = os.stat(str(p))
+    p.write('v2')
+    os.utime(str(p), ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert not cache.is_current(entry)
+
+
+def test_static_cache_revalidate_due(tmpdir):
+    p = tmpdir.join('LICENSE')
+    p.write('v1')
+    cache = StaticFileCache(revalidate_interval=0.05)
+    entry = load(cache, str(p))
+    # just loaded
+    assert not cache.revalidate_due(entry)
+    time.sleep(0.05)
+    assert cache.revalidate_due(entry)
+    # the next hits are served without checking
+    assert not cache.revalidate_due(entry)
+    cache.invalidate([entry.path])
+    entry = load(cache, str(p))
+    assert not cache.revalidate_due(entry)
+
+
+def test_static_cache_invalidate(tmpdir):
+    p = tmpdir.join('app.css')
+    p.write('body {}')
+    cache = StaticFileCache()
+    entry = load(cache, str(p))
+    cache.put((entry.path, entry.mtime, 'gzip'), entry.path, b'compressed', 10)
+    cache.invalidate([str(p) + '.gz'])
+    assert cache.get('app.css') is None
+    assert cache.get((entry.path, entry.mtime, 'gzip')) is None
+    assert cache.size == 0
+
+
+def test_static_cache_evicts_least_recently_used(tmpdir):
+    cache = StaticFileCache(max_bytes=25)
+    entries = []
+    for name in 'abc':
+        p = tmpdir.join(name + '.txt')
+        p.write(name * 10)
+        entries.append(load(cache, str(p)))
+        cache.get('a.txt')
+    assert cache.get('a.txt') is entries[0]
+    assert cache.get('b.txt') is None
+    assert cache.get('c.txt') is entries[2]
+    assert cache.size == 20
+
+
+def test_static_cache_large_file(tmpdir):
+    p = tmpdir.join('bundle.js')
+    p.write('x' * 100)
+    cache = StaticFileCache(max_file_size=50)
+    entry = load(cache, str(p))
+    assert entry.body is None
+    assert entry.size == 100
+    assert cache.size == 0
+    assert cache.is_current(entry)
+
+
+class ChunkResponse:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    async def drain(self):
+        pass
+
+
+def test_send_chunks(tmpdir, monkeypatch):
+    monkeypatch.setattr('aiohttp_runserver.serve.SEND_CHUNK_SIZE', 4)
+    p = tmpdir.join('bundle.js')
+    p.write('x' * 10)
+    loop = asyncio.new_event_loop()
+    response = ChunkResponse()
+    with open(str(p), 'rb') as f:
+        loop.run_until_complete(CustomStaticRoute._send_chunks(loop, response, f))
+    loop.close()
+    assert response.chunks == [b'xxxx', b'xxxx', b'xx']
+
+
+def test_not_modified_variants(tmpdir):
+    p = tmpdir.join('app.css')
+    p.write('body {}')
+    entry = StaticFileCache().load(Path(str(p)), os.stat(str(p)))
+    gzip_etag = _variant_etag(entry, 'gzip')
+    assert gzip_etag == entry.etag[:-1] + '-gzip"'
+    etags = [gzip_etag, entry.etag]
+    assert _not_modified(Request({IF_NONE_MATCH: gzip_etag}, None), etags, entry.mtime)
+    assert _not_modified(Request({IF_NONE_MATCH: '"x", W/' + entry.etag}, None), etags, entry.mtime)
+    assert not _not_modified(Request({IF_NONE_MATCH: '"x"'}, None), etags, entry.mtime)
+
+
+class FakeWebSocket:
+    def __init__(self, loop, drained=True, error=None):
+        self.sent = []
+        self.closed = False
+        self._loop = loop
+        self._drained = drained
+        self._error = error
+
+    def send_str(self, message):
+        if self._error:
+            raise self._error
+        self.sent.append(message)
+
+    async def drain(self):
+        if not self._drained:
+            # never completes, like a client which has stopped reading
+            await asyncio.Future(loop=self._loop)
+
+    async def close(self):
+        self.closed = True
+
+
+def run_client(**ws_kwargs):
+    """
+    Connect a LiveReloadClient to a fake websocket, send it three messages and run the loop briefly.
+    """
+    loop = asyncio.new_event_loop()
+    ws = FakeWebSocket(loop, **ws_kwargs)
+    clients = {}
+    clients[ws] = LiveReloadClient(ws, '/', clients, loop)
+    for message in ('a', 'b', 'c'):
+        clients[ws].send(message)
+    loop.run_until_complete(asyncio.sleep(0.05, loop=loop))
+    if ws in clients:
+        clients[ws].drop()
+    loop.run_until_complete(asyncio.sleep(0, loop=loop))
+    loop.close()
+    return ws, clients
+
+
+def test_livereload_client_sends():
+    ws, clients = run_client()
+    assert ws.sent == ['a', 'b', 'c']
+    assert ws.closed
+
+
+def test_livereload_client_send_timeout(monkeypatch):
+    monkeypatch.setattr(serve, 'WS_SEND_TIMEOUT', 0.01)
+    ws, clients = run_client(drained=False)
+    # dropped after the first message
+    assert ws.sent == ['a']
+    assert ws not in clients
+    assert ws.closed
+
+
+def test_livereload_client_send_error():
+    ws, clients = run_client(error=RuntimeError('websocket connection is closing'))
+    assert ws.sent == []
+    assert ws not in clients
+    assert ws.closed
+
+
+def test_livereload_client_queue_full():
+    loop = asyncio.new_event_loop()
+    ws = FakeWebSocket(loop)
+    clients = {}
+    clients[ws] = client = LiveReloadClient(ws, '/', clients, loop)
+    # the loop doesn't run so nothing is taken off the queue
+    for i in range(WS_QUEUE_SIZE):
+        client.send(str(i))
+    assert clients == {ws: client}
+    client.send('one too many')
+    assert clients == {}
+    loop.run_until_complete(asyncio.sleep(0, loop=loop))
+    loop.close()
+    assert ws.sent == []
+    assert ws.closed
+
+
+def test_reload_queue_coalesces():
+    loop = asyncio.new_event_loop()
+    broadcasts = []
+    queue = ReloadQueue(loop, broadcasts.append)
+    seen = time.monotonic() - 0.1
+    queue.put('/static/a.css', seen)
+    queue.put('/static/b.css')
+    queue.put('/static/a.css')
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+    assert broadcasts == [['/static/a.css', '/static/b.css']]
+
+    queue.put('/static/a.css')
+    queue.put()
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+    loop.close()
+    assert broadcasts[1] is None
+
+    stats = queue.stats()
+    assert stats['requests'] == 5
+    assert stats['broadcasts'] == 2
+    assert stats['max_depth'] == 3
+    assert stats['max_latency'] >= 0.1
+
+
+SNIPPET = b'<script src="livereload.js"></script>'
+
+
+def sink(response):
+    written = []
+
+    async def write_eof():
+        written.append(None)
+    response.write = written.append
+    response.write_eof = write_eof
+    return written
+
+
+def stream(chunks):
+    loop = asyncio.new_event_loop()
+    response = web.StreamResponse()
+    written = sink(response)
+    injector = SnippetInjector(response, SNIPPET)
+    for chunk in chunks:
+        injector.write(chunk)
+    loop.run_until_complete(injector.write_eof())
+    loop.close()
+    assert written.pop() is None
+    return b''.join(written)
+
+
+@pytest.mark.parametrize('chunks', [
+    [b'<html><body>hi</body></html>'],
+    [b'<html><body>hi</bo', b'dy></html>'],
+    [b'<html><body>hi<', b'/', b'body></html>'],
+    [b'<html><body>hi', b'</body>', b'</html>'],
+])
+def test_stream_injected_before_body_end(chunks):
+    assert stream(chunks) == b'<html><body>hi' + SNIPPET + b'</body></html>'
+
+
+def test_stream_no_body_end():
+    assert stream([b'<p>hi</p>', b'<p>there</b']) == b'<p>hi</p><p>there</b' + SNIPPET
+
+
+def test_stream_last_body_end():
+    page = [b'<html><head><script>s = "</body>";</script></head>', b'<body>hi', b'</body></html>']
+    assert stream(page) == page[0] + page[1] + SNIPPET + page[2]
+
+
+def test_stream_long_tail():
+    page = [b'<script>s = "</body>";</script>', b'x' * MAX_BODY_TAIL, b'<p>hi</p>']
+    assert stream(page) == b''.join(page) + SNIPPET
+
+
+def inject_body(page):
+    response = web.Response(body=page, content_type='text/html')
+    written = sink(response)
+    inject_snippet(response, SNIPPET)
+    response.write(response.body)
+    return response, b''.join(written)
+
+
+@pytest.mark.parametrize('page,expected', [
+    (b'<body>hi</body></html>\n', b'<body>hi</body></html>\n' + SNIPPET),
+    (b'<body>hi</body><!-- end -->', b'<body>hi' + SNIPPET + b'</body><!-- end -->'),
+    (b'<script>s = "</body>";</script><body>hi</body><p>', b'<script>s = "</body>";</script><body>hi' + SNIPPET +
+     b'</body><p>'),
+    (b'<p>hi</p>', b'<p>hi</p>' + SNIPPET),
+])
+def test_inject_into_body(page, expected):
+    response, written = inject_body(page)
+    assert written == expected
+    assert response.content_length == len(expected)
+
+
+@pytest.mark.parametrize('page', [
+    b'<body>hi</body><!-- end -->',
+    b'<script>s = "</body>";</script><body>hi</body><!-- end -->',
+])
+def test_body_and_stream_agree(page):
+    _, written = inject_body(page)
+    assert stream([page[:20], page[20:]]) == written
+
+
+def test_inject_stream_content_length():
+    response = web.StreamResponse()
+    response.content_type = 'text/html'
+    response.content_length = 20
+    sink(response)
+    inject_snippet(response, SNIPPET)
+    assert response.content_length == 20 + len(SNIPPET)
+
+
+def test_inject_compressed():
+    response = web.Response(body=b'<body></body>', headers={CONTENT_ENCODING: 'gzip'}, content_type='text/html')
+    written = sink(response)
+    inject_snippet(response, SNIPPET)
+    response.write(response.body)
+    assert written == [b'<body></body>']
+    assert response.content_length == 13
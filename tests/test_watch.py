@@ -0,0 +1,278 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from types import SimpleNamespace
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+import pytest
+
+from aiohttp_runserver.metrics import DEBOUNCE, METRICS, ReloadMetrics
+from aiohttp_runserver.polling import RACY_NS
+from aiohttp_runserver.watch import (CODE, MAX_RETRY_DELAY, RETRY_RESET, STATIC, TEMPLATE, CodeFileEventHandler,
+                                     ContentHashes, Debouncer, ErrorPage, IgnoredDirectories, PathMatcher,
+                                     compile_globs, parse_gitignore)
+
+
+class Batches:
+    def __init__(self):
+        self.batches = []
+        self.called = threading.Event()
+
+    def __call__(self, paths, first_seen):
+        self.batches.append((paths, first_seen))
+        self.called.set()
+
+
+def test_debouncer_batches():
+    batches = Batches()
+    debouncer = Debouncer(batches, 0.05, 1, 'test')
+    start = time.monotonic()
+    debouncer.add(['a.py'])
+    debouncer.add(['b.py', 'a.py'])
+    assert batches.called.wait(2)
+    debouncer.stop()
+    (paths, first_seen), = batches.batches
+    assert paths == ['a.py', 'b.py']
+    assert start <= first_seen <= time.monotonic()
+
+
+def test_debouncer_max_wait():
+    batches = Batches()
+    debouncer = Debouncer(batches, 0.1, 0.2, 'test')
+    start = time.monotonic()
+    # changes keep arriving more often than the delay
+    while not batches.called.is_set() and time.monotonic() - start < 2:
+        debouncer.add(['a.py'])
+        time.sleep(0.02)
+    elapsed = time.monotonic() - start
+    debouncer.stop()
+    assert batches.called.is_set()
+    assert 0.2 <= elapsed < 0.5
+
+
+def test_debouncer_separate_batches():
+    batches = Batches()
+    debouncer = Debouncer(batches, 0.02, 1, 'test')
+    debouncer.add(['a.py'])
+    assert batches.called.wait(2)
+    batches.called.clear()
+    debouncer.add(['b.py'])
+    assert batches.called.wait(2)
+    debouncer.stop()
+    assert [paths for paths, _ in batches.batches] == [['a.py'], ['b.py']]
+
+
+def test_compile_globs():
+    regex = compile_globs(['*/.git/*', '*.pyc'])
+    assert regex.match('/x/.git/config')
+    assert regex.match('/x/y.pyc')
+    assert not regex.match('/x/y.py')
+    assert not regex.match('/x/git/config')
+
+
+@pytest.mark.parametrize('path,kind', [
+    ('/project/app.py', CODE),
+    ('/project/templates/index.html', TEMPLATE),
+    ('/project/templates/base.jinja2', TEMPLATE),
+    ('/project/README', None),
+    ('/project/.env', None),
+    ('/project/notes.txt', None),
+    ('/project/static/app.js', STATIC),
+    ('/project/static/fonts/x.woff2', STATIC),
+    ('/project/static/LICENSE', None),
+    ('/project/static/node_modules/x/y.js', None),
+    ('/project/__pycache__/app.cpython-35.pyc', None),
+    ('/project/.git/HEAD', None),
+    ('/project/app.py___jb_tmp___', None),
+])
+def test_classify(path, kind):
+    assert PathMatcher('/project/static').classify(path) == kind
+
+
+@pytest.mark.parametrize('path,kind', [
+    ('/project/app.py', CODE),
+    ('/project/content/post.md', TEMPLATE),
+    ('/project/content/post.html', TEMPLATE),
+    ('/project/content/drafts/post.py', CODE),
+    ('/project/data/app.py', None),
+    ('/lib/models.py', CODE),
+    ('/lib/README', None),
+])
+def test_classify_roots(path, kind):
+    matcher = PathMatcher('/project/static', [
+        ('/project/content', 'reload'),
+        ('/project/content/drafts', 'restart'),
+        ('/project/data', 'ignore'),
+        ('/lib', 'restart'),
+    ])
+    assert matcher.classify(path) == kind
+
+
+def write_gitignore(tmpdir, *lines):
+    tmpdir.join('.gitignore').write('\n'.join(lines) + '\n')
+    return str(tmpdir.join('.gitignore'))
+
+
+@pytest.mark.parametrize('line,ignored,kept', [
+    ('build/', ['build', 'src/build'], ['builder', 'src']),
+    ('/dist', ['dist'], ['src/dist']),
+    ('foo/**', ['foo'], ['src/foo']),
+    ('**/foo', ['foo', 'src/foo', 'src/a/foo'], ['food']),
+    ('**/a/b', ['a/b', 'src/a/b'], ['a', 'b']),
+    ('a/**/b', ['a/b', 'a/x/b', 'a/x/y/b'], ['a', 'b', 'x/a/b']),
+    ('node_*', ['node_modules', 'src/node_x'], ['nodes']),
+])
+def test_gitignore_patterns(tmpdir, line, ignored, kept):
+    write_gitignore(tmpdir, '# comment', '', line)
+    prune = IgnoredDirectories(PathMatcher(), [str(tmpdir)])
+    for path in ignored:
+        assert prune(os.path.join(str(tmpdir), path)), path
+    for path in kept:
+        assert not prune(os.path.join(str(tmpdir), path)), path
+
+
+def test_gitignore_negation_not_used(tmpdir):
+    path = write_gitignore(tmpdir, '/*', '!/src')
+    assert parse_gitignore(path) == (None, None)
+    prune = IgnoredDirectories(PathMatcher(), [str(tmpdir)])
+    assert not prune(str(tmpdir.join('src')))
+    assert not prune(str(tmpdir.join('docs')))
+
+
+def test_gitignore_missing(tmpdir):
+    assert parse_gitignore(str(tmpdir.join('.gitignore'))) == (None, None)
+
+
+def test_gitignore_keep(tmpdir):
+    write_gitignore(tmpdir, 'build')
+    keep = str(tmpdir.join('build', 'static'))
+    prune = IgnoredDirectories(PathMatcher(), [str(tmpdir)], keep=keep)
+    assert not prune(str(tmpdir.join('build')))
+    assert not prune(keep)
+    assert prune(str(tmpdir.join('src', 'build')))
+
+
+def test_gitignore_only_within_root(tmpdir):
+    root = tmpdir.mkdir('project')
+    write_gitignore(root, 'lib')
+    prune = IgnoredDirectories(PathMatcher(), [str(root)])
+    assert prune(str(root.join('lib')))
+    assert not prune(str(tmpdir.join('other', 'lib')))
+
+
+def test_ignore_roots(tmpdir):
+    prune = IgnoredDirectories(PathMatcher(), [str(tmpdir)], ignore=[str(tmpdir.join('data'))])
+    assert prune(str(tmpdir.join('data')))
+    assert prune(str(tmpdir.join('data', 'x')))
+    assert not prune(str(tmpdir.join('database')))
+    assert prune(str(tmpdir.join('node_modules')))
+
+
+def test_content_hashes(tmpdir):
+    p = tmpdir.join('views.py')
+    p.write('a = 1\n')
+    hashes = ContentHashes()
+    assert hashes.changed(str(p))
+    assert not hashes.changed(str(p))
+    p.write('a = 1\n')
+    assert not hashes.changed(str(p))
+    p.write('a = 2\n')
+    assert hashes.changed(str(p))
+    p.remove()
+    assert hashes.changed(str(p))
+
+
+def test_content_hashes_racy_mtime(tmpdir):
+    p = tmpdir.join('views.py')
+    p.write('a = 1\n')
+    st = os.stat(str(p))
+    hashes = ContentHashes()
+    assert hashes.changed(str(p))
+    # rewritten with the same size within the filesystem's mtime resolution
+    p.write('a = 2\n')
+    os.utime(str(p), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert hashes.changed(str(p))
+
+
+def test_content_hashes_trusts_old_mtime(tmpdir):
+    p = tmpdir.join('views.py')
+    p.write('a = 1\n')
+    old = int(time.time() * 10 ** 9) - 2 * RACY_NS
+    os.utime(str(p), ns=(old, old))
+    hashes = ContentHashes()
+    assert hashes.changed(str(p))
+    p.write('a = 2\n')
+    os.utime(str(p), ns=(old, old))
+    # same mtime and size long after the mtime, so not read again
+    assert not hashes.changed(str(p))
+
+
+def test_failed_start_discards_timings():
+    loop = asyncio.new_event_loop()
+    metrics = ReloadMetrics(loop)
+    ready = threading.Event()
+    ready.set()
+    handler = SimpleNamespace(_app={METRICS: metrics}, _ready=ready, _server_ready=False, _server_error='Traceback')
+    metrics.event()
+    assert not CodeFileEventHandler._wait_ready(handler)
+    metrics.record(DEBOUNCE)
+    metrics.event()
+    metrics.finish()
+    loop.close()
+    assert metrics.as_dict()['reloads'] == 2
+    assert metrics.as_dict()['stages'][DEBOUNCE]['count'] == 0
+
+
+def test_retry_delay():
+    handler = SimpleNamespace(_failures=0, _ready_at=None)
+    delays = [CodeFileEventHandler._retry_delay(handler) for _ in range(7)]
+    assert delays == [1, 2, 4, 8, 16, MAX_RETRY_DELAY, MAX_RETRY_DELAY]
+
+
+def test_retry_delay_reset():
+    handler = SimpleNamespace(_failures=0, _ready_at=None)
+    for _ in range(3):
+        CodeFileEventHandler._retry_delay(handler)
+    # came up briefly after the last retry, still a crash loop
+    handler._ready_at = time.monotonic() - 1
+    assert CodeFileEventHandler._retry_delay(handler) == 8
+    # stayed up long enough
+    handler._ready_at = time.monotonic() - RETRY_RESET - 1
+    assert CodeFileEventHandler._retry_delay(handler) == 1
+    assert CodeFileEventHandler._retry_delay(handler) == 2
+
+
+def get(port):
+    try:
+        urlopen('http://127.0.0.1:{}/foo'.format(port), timeout=5)
+    except HTTPError as e:
+        return e.code, e.read().decode()
+
+
+def test_error_page():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    page = ErrorPage(SimpleNamespace(loop=loop), {'main_port': port, 'livereload': False})
+    try:
+        page.show('Server failed', 'Traceback <module>')
+        status, body = get(port)
+        assert status == 500
+        assert 'Server failed' in body
+        assert 'Traceback &lt;module&gt;' in body
+        page.show('Server failed again', 'SyntaxError')
+        assert 'Server failed again' in get(port)[1]
+        page.hide()
+        with pytest.raises(URLError):
+            get(port)
+    finally:
+        page.close()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
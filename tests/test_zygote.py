@@ -0,0 +1,148 @@
+import os
+import signal
+import socket
+import time
+from multiprocessing import Pipe
+from types import SimpleNamespace
+from urllib.request import urlopen
+
+import pytest
+from watchdog.events import DirCreatedEvent, FileCreatedEvent, FileModifiedEvent, FileMovedEvent
+
+# importing watch makes processes spawned rather than forked from the test runner, as they are when running the app
+import aiohttp_runserver.watch  # noqa: F401
+from aiohttp_runserver.zygote import Zygote, _DependencyChanges
+
+APP = """\
+from aiohttp import web
+import zygote_dep
+
+
+async def index(request):
+    return web.Response(text=str(zygote_dep.VALUE))
+
+
+def create_app(loop):
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/', index)
+    return app
+"""
+
+
+@pytest.fixture
+def config(tmpdir, monkeypatch):
+    project, deps = tmpdir.mkdir('project'), tmpdir.mkdir('deps')
+    project.join('zygote_app.py').write(APP)
+    deps.join('zygote_dep.py').write('VALUE = 1\n')
+    monkeypatch.chdir(str(project))
+    monkeypatch.syspath_prepend(str(deps))
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    return dict(
+        app_path='zygote_app.py',
+        app_factory='create_app',
+        code_path=str(project),
+        static_path=None,
+        static_url='/static/',
+        livereload=False,
+        main_port=port,
+        aux_port=port + 1,
+        preload=True,
+        workers=1,
+        warmup=False,
+        hot_reload=False,
+        profile_imports=False,
+        access_log_limit=None,
+        profile_requests=False,
+        slow_request=0.5,
+        block_threshold=None,
+        watch=[],
+        poll=False,
+        verbose=False,
+    )
+
+
+@pytest.fixture
+def zygote(config):
+    zygote = Zygote(config)
+    yield zygote
+    zygote.close()
+
+
+def fork(zygote, config):
+    conn, server_conn = Pipe()
+    process = zygote.fork(config, server_conn)
+    server_conn.close()
+    while conn.poll(20):
+        command, *args = conn.recv()
+        if command == 'ready':
+            return process
+        assert command != 'error', args[0]
+    raise AssertionError('server not ready')
+
+
+def get(config):
+    with urlopen('http://127.0.0.1:{}/'.format(config['main_port']), timeout=5) as r:
+        return r.read().decode()
+
+
+def stop(process):
+    os.kill(process.pid, signal.SIGINT)
+    process.join(5)
+    assert not process.is_alive()
+
+
+def test_fork_and_stop(zygote, config):
+    process = fork(zygote, config)
+    assert process.is_alive()
+    assert get(config) == '1'
+    # times out while the server is running
+    process.join(0.05)
+    assert process.is_alive()
+    stop(process)
+    assert process.exitcode == 0
+    # importing and serving don't count as changing the dependencies
+    assert zygote._changed is None
+
+
+def test_dependency_changed(zygote, config, tmpdir):
+    stop(fork(zygote, config))
+    zygote_pid = zygote._process.pid
+    tmpdir.join('deps', 'zygote_dep.py').write('VALUE = 2\n')
+    for _ in range(50):
+        if zygote._changed:
+            break
+        time.sleep(0.1)
+    process = fork(zygote, config)
+    assert zygote._process.pid != zygote_pid
+    assert get(config) == '2'
+    stop(process)
+
+
+def test_dead_zygote(zygote, config):
+    stop(fork(zygote, config))
+    os.kill(zygote._process.pid, signal.SIGKILL)
+    zygote._process.join(5)
+    process = fork(zygote, config)
+    assert get(config) == '1'
+    stop(process)
+
+
+@pytest.mark.parametrize('event,changed', [
+    (FileModifiedEvent('/deps/dep.py'), True),
+    (FileModifiedEvent('/site/other.py'), False),
+    (FileCreatedEvent('/site/new.py'), True),
+    (FileCreatedEvent('/site/new.pth'), True),
+    (FileCreatedEvent('/site/notes.txt'), False),
+    (FileMovedEvent('/site/tmp123', '/site/new.py'), True),
+    (DirCreatedEvent('/site/package'), True),
+    (DirCreatedEvent('/site/__pycache__'), False),
+    # ancestors of watched directories are only watched to reach them
+    (FileCreatedEvent('/new.py'), False),
+])
+def test_dependency_events(event, changed):
+    paths = []
+    zygote = SimpleNamespace(dependency_changed=paths.append)
+    _DependencyChanges(zygote, ['/deps/dep.py'], {'/deps', '/site'}).dispatch(event)
+    assert bool(paths) == changed